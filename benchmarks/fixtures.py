@@ -0,0 +1,282 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Synthetic inputs and stand-in tool executables for the benchmarks.
+
+The fake tools are a single python script linked under the name of each tool (cutadapt, hisat2, samtools,
+featureCounts, stringtie, fastqc, gtf2bed). Each one parses the arguments scirnap gives the real tool, sleeps for
+SCIRNAP_FAKE_LATENCY seconds and writes its outputs (SCIRNAP_FAKE_SIZE bytes each, or the piped input) to where the
+real tool would, so that every pipeline (including the pipes, DAGs and caches) runs for real without the real tools.
+"""
+
+import gzip
+import os
+import random
+import stat
+import struct
+import sys
+
+import pandas as pd
+
+TOOLS = ['cutadapt', 'hisat2', 'samtools', 'featureCounts', 'stringtie', 'fastqc', 'gtf2bed']
+
+FAKE_TOOL = '''#!{python}
+import os
+import shutil
+import sys
+import time
+
+tool = os.path.basename(sys.argv[0])
+args = sys.argv[1:]
+if '--version' in args:
+    print(f'{{tool}} 0.0.0-fake')
+    sys.exit(0)
+if '--noop' in args:
+    sys.exit(0)
+time.sleep(float(os.environ.get('SCIRNAP_FAKE_LATENCY', '0')))
+size = int(os.environ.get('SCIRNAP_FAKE_SIZE', '1024'))
+
+
+def value(flag):
+    return args[args.index(flag) + 1] if flag in args else None
+
+
+def write(path, data=None):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size if data is None else data)
+
+
+def positionals(values, with_value=('-@', '-o', '-m', '-T', '-p')):
+    found, skip = [], False
+    for v in values:
+        if skip:
+            skip = False
+        elif v in with_value:
+            skip = True
+        elif not v.startswith('-') or v == '-':
+            found.append(v)
+    return found
+
+
+if tool == 'cutadapt':
+    if value('-o'):
+        write(value('-o'))
+    else:
+        sys.stdout.buffer.write(b'x' * size)  # Streamed into hisat2 (TrimAlign)
+    if value('-p'):
+        write(value('-p'))
+elif tool == 'hisat2':
+    # Reads have to be drained when they are piped (or in FIFOs) from cutadapt
+    for reads in [value('-U'), value('-1'), value('-2')]:
+        if reads == '-':
+            sys.stdin.buffer.read()
+        elif reads:
+            with open(reads, 'rb') as f:
+                f.read()
+    write(value('--summary-file'), b'100 reads; of these:\\n  100 (100.00%) were unpaired; of these:\\n'
+                                   b'    5 (5.00%) aligned 0 times\\n    90 (90.00%) aligned exactly 1 time\\n'
+                                   b'    5 (5.00%) aligned >1 times\\n95.00% overall alignment rate\\n')
+    sys.stdout.buffer.write(b'x' * size)
+elif tool == 'samtools':
+    command, rest = args[0], args[1:]
+    if command == 'view':
+        shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)
+    elif command == 'sort':
+        inputs = positionals(rest)
+        data = sys.stdin.buffer.read() if not inputs or inputs == ['-'] else None
+        write(value('-o'), data)
+    elif command == 'merge':
+        files = positionals(rest)
+        output = value('-o') or files[0]
+        if output == '-':
+            sys.stdout.buffer.write(b'x' * size)
+        else:
+            write(output)
+    elif command == 'index':
+        write(positionals(rest)[-1] + '.bai', b'')
+elif tool == 'featureCounts':
+    output = value('-o')
+    bams = args[args.index('-o') + 2:]
+    with open(output, 'w') as f:
+        f.write('# Program:featureCounts v0.0.0-fake\\n')
+        f.write('\\t'.join(['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length'] + bams) + '\\n')
+        for gene in range(int(os.environ.get('SCIRNAP_FAKE_GENES', '100'))):
+            f.write('\\t'.join([f'g{{gene}}', 'chr1', '1', '10', '+', '10'] + ['7'] * len(bams)) + '\\n')
+elif tool == 'stringtie':
+    write(value('-o'))
+    if value('-b'):
+        write(os.path.join(value('-b'), 't_data.ctab'), b't_id\\tFPKM\\n1\\t1.0\\n')
+elif tool == 'fastqc':
+    for f in positionals(args):
+        name = os.path.basename(f)
+        for ext in ['.gz', '.fastq', '.fq']:
+            name = name[:-len(ext)] if name.endswith(ext) else name
+        write(os.path.join(value('-o'), f'{{name}}_fastqc.html'))
+        write(os.path.join(value('-o'), f'{{name}}_fastqc.zip'))
+elif tool == 'gtf2bed':
+    # One line per transcript, as scirnap checks
+    with open(args[0]) as f:
+        transcripts = dict.fromkeys(line.split('transcript_id "')[1].split('"')[0] for line in f
+                                    if 'transcript_id "' in line and not line.startswith('#'))
+    sys.stdout.write(''.join(f'{{t}}\\t' + 'x' * (size // max(len(transcripts), 1)) + '\\n' for t in transcripts))
+'''
+
+
+def install_fake_tools(bin_dir: str) -> str:
+    """ Writes the fake tools to bin_dir, returns bin_dir (put it first on the PATH for Hisat2's samtools pipe). """
+    os.makedirs(bin_dir, exist_ok=True)
+    script = os.path.join(bin_dir, 'fake_tool')
+    with open(script, 'w') as f:
+        f.write(FAKE_TOOL.format(python=sys.executable))
+    os.chmod(script, os.stat(script).st_mode | stat.S_IEXEC)
+    for tool in TOOLS:
+        link = os.path.join(bin_dir, tool)
+        if not os.path.exists(link):
+            os.symlink('fake_tool', link)
+    return bin_dir
+
+
+def write_fastq(path: str, n_reads: int, read_length=100, mate='1', seed=0):
+    rng = random.Random(seed)
+    opener = gzip.open(path, 'wt', compresslevel=1) if path.endswith('.gz') else open(path, 'w')
+    quality = 'I' * read_length
+    with opener as f:
+        for i in range(n_reads):
+            seq = ''.join(rng.choices('ACGTN', weights=[30, 20, 20, 30, 1], k=read_length))
+            f.write(f'@read{i}/{mate}\n{seq}\n+\n{quality}\n')
+
+
+def write_fastqs(data_dir: str, n_samples: int, n_reads: int, paired=False) -> list:
+    os.makedirs(data_dir, exist_ok=True)
+    paths = []
+    for i in range(n_samples):
+        for mate in (['1', '2'] if paired else ['1']):
+            path = os.path.join(data_dir, f's{i}_R{mate}.fq.gz')
+            write_fastq(path, n_reads, mate=mate, seed=i)
+            paths.append(path)
+    return paths
+
+
+def write_bam(path: str, sort_order='coordinate', size=1024):
+    """ BAM-like file: a real BAM header (magic, @HD with the sort order, no reads) followed by padding. """
+    text = f'@HD\tVN:1.6\tSO:{sort_order}\n@SQ\tSN:chr1\tLN:1000\n'.encode()
+    with gzip.open(path, 'wb', compresslevel=1) as f:
+        f.write(b'BAM\x01' + struct.pack('<i', len(text)) + text + struct.pack('<i', 0) + b'\0' * size)
+
+
+def write_bams(data_dir: str, names: list, size=1024) -> list:
+    os.makedirs(data_dir, exist_ok=True)
+    paths = [os.path.join(data_dir, name) for name in names]
+    for path in paths:
+        write_bam(path, size=size)
+    return paths
+
+
+def write_gtf(path: str, n_genes: int, transcripts_per_gene=2, exons_per_transcript=4, n_chroms=4):
+    """ GTF with genes spread over n_chroms chromosomes (each in one block), gene/transcript/exon lines. """
+    with open(path, 'w') as f:
+        for g in range(n_genes):
+            chrom = f'chr{g * n_chroms // n_genes + 1}'
+            start = 1000 + (g % (n_genes // n_chroms or 1)) * 10000
+            strand = '+' if g % 2 else '-'
+            gene = f'gene_id "G{g}";'
+            f.write(f'{chrom}\tbench\tgene\t{start}\t{start + 5000}\t.\t{strand}\t.\t{gene}\n')
+            for t in range(transcripts_per_gene):
+                attributes = f'{gene} transcript_id "G{g}.T{t}";'
+                f.write(f'{chrom}\tbench\ttranscript\t{start}\t{start + 5000}\t.\t{strand}\t.\t{attributes}\n')
+                for e in range(exons_per_transcript):
+                    exon_start = start + e * 1000 + t * 10
+                    f.write(f'{chrom}\tbench\texon\t{exon_start}\t{exon_start + 500}\t.\t{strand}\t.\t'
+                            f'{attributes} exon_number "{e + 1}";\n')
+
+
+def write_hisat2_summaries(output_dir: str, n_files: int, paired=False) -> list:
+    os.makedirs(output_dir, exist_ok=True)
+    single = '{n} reads; of these:\n  {n} (100.00%) were unpaired; of these:\n    5 (0.05%) aligned 0 times\n' \
+             '    {u} (90.00%) aligned exactly 1 time\n    10 (0.10%) aligned >1 times\n99.95% overall alignment rate\n'
+    pair = '{n} reads; of these:\n  {n} (100.00%) were paired; of these:\n' \
+           '    5 (0.05%) aligned concordantly 0 times\n    {u} (90.00%) aligned concordantly exactly 1 time\n' \
+           '    10 (0.10%) aligned concordantly >1 times\n' \
+           '    ----\n    5 pairs aligned concordantly 0 times; of these:\n' \
+           '      1 (20.00%) aligned discordantly 1 time\n    ----\n    4 pairs aligned 0 times concordantly or ' \
+           'discordantly; of these:\n      8 mates make up the pairs; of these:\n        6 (75.00%) aligned 0 times\n' \
+           '        1 (12.50%) aligned exactly 1 time\n        1 (12.50%) aligned >1 times\n' \
+           '99.97% overall alignment rate\n'
+    paths = []
+    for i in range(n_files):
+        path = os.path.join(output_dir, f'HISAT2_s{i}.fq.gz_summary.txt')
+        with open(path, 'w') as f:
+            f.write((pair if paired else single).format(n=10000 + i, u=10000 + i - 15))
+        paths.append(path)
+    return paths
+
+
+def write_featurecounts_table(path: str, n_genes: int, n_samples: int, seed=0):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write('# Program:featureCounts v2.0.1; Command:"featureCounts" "-a" "bench.gtf"\n')
+        f.write('\t'.join(['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length'] +
+                          [f'bams/s{i}.bam' for i in range(n_samples)]) + '\n')
+        for g in range(n_genes):
+            # Mostly zeros, as in real count matrices
+            counts = [str(rng.randrange(1000) if rng.random() < 0.3 else 0) for _ in range(n_samples)]
+            f.write('\t'.join([f'G{g}', 'chr1', '1', '500', '+', '500'] + counts) + '\n')
+
+
+def write_ctabs(ctab_dir: str, n_samples: int, n_transcripts: int, seed=0) -> dict:
+    """ t_data.ctab of each sample (all with the same transcripts, as after stringtie -e), {sample: path}. """
+    rng = random.Random(seed)
+    columns = ['t_id', 'chr', 'strand', 'start', 'end', 't_name', 'num_exons', 'length', 'gene_id', 'gene_name', 'cov',
+               'FPKM']
+    rows = [[t + 1, 'chr1', '+', 1000 * t, 1000 * t + 500, f'G{t // 2}.T{t % 2}', 4, 2000, f'G{t // 2}', f'G{t // 2}']
+            for t in range(n_transcripts)]
+    paths = {}
+    for i in range(n_samples):
+        path = os.path.join(ctab_dir, f's{i}', 't_data.ctab')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('\t'.join(columns) + '\n')
+            for row in rows:
+                cov = rng.random() * 50 if rng.random() < 0.5 else 0
+                f.write('\t'.join(map(str, row + [f'{cov:.6f}', f'{cov * 3:.6f}'])) + '\n')
+        paths[f's{i}'] = path
+    return paths
+
+
+def write_multiqc_table(path: str, n_files: int, seed=0):
+    rng = random.Random(seed)
+    flags = ['pass', 'warn', 'fail']
+    metrics = ['per_base_sequence_quality', 'per_base_n_content', 'adapter_content', 'overrepresented_sequences']
+    rows = [{'Sample': f's{i}', 'Filename': f's{i}.fq.gz', 'Total Sequences': rng.randrange(10 ** 6, 10 ** 8),
+             **{m: rng.choices(flags, weights=[90, 7, 3])[0] for m in metrics}} for i in range(n_files)]
+    pd.DataFrame(rows).to_csv(path, sep='\t', index=False)
+
+
+def write_sample_sheet(path: str, n_samples: int, lanes=4):
+    rows = [{'Barcode': f'BC{i:05d}', 'Lane': f'L00{lane + 1}', 'SampleName': f'sample{i}'}
+            for i in range(n_samples) for lane in range(lanes)]
+    pd.DataFrame(rows).to_csv(path, index=False)
+
+
+def touch_files(data_dir: str, names: list) -> list:
+    """ Empty files (for discovery benchmarks where only the names matter). """
+    os.makedirs(data_dir, exist_ok=True)
+    paths = [os.path.join(data_dir, name) for name in names]
+    for path in paths:
+        open(path, 'w').close()
+    return paths
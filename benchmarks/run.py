@@ -0,0 +1,449 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Benchmarks of scirnap's own overhead, run against synthetic inputs and the fake tools in benchmarks.fixtures so the
+numbers don't depend on the real tools (or having them installed).
+
+    python -m benchmarks.run -o results.json                 # everything
+    python -m benchmarks.run --quick --only cmd discovery     # small inputs, some groups
+    python -m benchmarks.run -o new.json --compare old.json   # print the change against an earlier run
+
+Groups: cmd (cmd generation of every pipeline), scheduling (scheduler and process overhead per job), discovery
+(listing, pairing, grouping files), parsing (summaries, counts, QC, GTF), e2e (every pipeline run end to end on the fake
+tools, and a whole DAG). Each result is the min/median/max wall time over the repeats, plus per item times/throughput.
+The JSON has the scirnap version, python and machine so results from different versions can be compared.
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import scirnap
+from scirnap import Cutadapt, FastQC, FeatureCounts, FastqChunk, GTF2Bed, Hisat2, Job, JobScheduler, Pool, \
+    PipelineDAG, Sort, StringTie, TrimAlign
+from scirnap.annotation import GTFIndex
+from scirnap.cutadapt import QCSelector
+from scirnap.discovery import find_files, pair_files
+from scirnap.fastqc import scan_fastq
+from scirnap.featurecounts import load_counts
+from scirnap.gtf2bed import gtf_to_bed12
+from scirnap.hisat2 import summarise_summary_files
+from scirnap.pool import group_files
+from scirnap.stringtie import collate_ctabs
+
+from benchmarks import fixtures
+
+BENCHMARKS = []
+
+# Sizes (of the full run, --quick divides them by 10) and fake tool settings
+DEFAULT_CONFIG = {'files': 1000, 'discovery_files': 20000, 'jobs': 200, 'e2e_files': 16, 'reads': 20000,
+                  'genes': 20000, 'samples': 100, 'gtf_genes': 5000, 'summaries': 2000, 'cpus': 4, 'repeats': 3,
+                  'latency': 0.05, 'output_size': 1024}
+
+
+def benchmark(group: str):
+    """ Registers a benchmark, the function takes the Context and returns {name: result}. """
+    def register(fn):
+        BENCHMARKS.append((group, fn))
+        return fn
+    return register
+
+
+def timeit(fn, repeats: int, setup=None, n=None) -> dict:
+    """ Times fn (given what setup returns, if there is a setup, which isn't timed) over repeats runs. """
+    times = []
+    for _ in range(repeats):
+        args = (setup(), ) if setup else ()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    result = {'median_s': statistics.median(times), 'min_s': min(times), 'max_s': max(times), 'repeats': repeats}
+    if n:
+        result['n'] = n
+        result['per_item_us'] = result['median_s'] / n * 1e6
+        result['items_per_s'] = n / result['median_s'] if result['median_s'] else None
+    return result
+
+
+class Context:
+
+    def __init__(self, work_dir: str, config: dict):
+        self.work_dir, self.config = work_dir, config
+        self.bin_dir = fixtures.install_fake_tools(os.path.join(work_dir, 'bin'))
+        self._counter = 0
+
+    def __getattr__(self, name):
+        return self.config[name]
+
+    def path(self, *parts) -> str:
+        return os.path.join(self.work_dir, *parts)
+
+    def new_dir(self, name: str) -> str:
+        """ Fresh directory for each run, so outputs (and the run cache) of an earlier repeat aren't reused. """
+        self._counter += 1
+        path = self.path('runs', f'{name}_{self._counter}')
+        os.makedirs(path)
+        return path
+
+    def tool(self, name: str) -> str:
+        return os.path.join(self.bin_dir, name)
+
+
+def quiet(pipeline):
+    pipeline.verbose = False
+    pipeline.u.dp = pipeline.u.warn_p = lambda *args, **kwargs: None
+    return pipeline
+
+
+def make_pipelines(ctx: Context, data_dir: str, output_dir: str) -> dict:
+    """ One of every pipeline (with the fake tools) keyed by name, with the input files each is benchmarked on. """
+    gtf = ctx.path('bench.gtf')
+    ctab_dir = os.path.join(output_dir, 'ctab')
+    os.makedirs(ctab_dir, exist_ok=True)
+    return {
+        'cutadapt_se': Cutadapt(data_dir, ctx.tool('cutadapt'), '-q 20', None, output_dir, 's'),
+        'cutadapt_pe': Cutadapt(data_dir, ctx.tool('cutadapt'), '-q 20', None, output_dir, 'p'),
+        'hisat2_se': Hisat2(data_dir, ctx.tool('hisat2'), '', output_dir, ctx.path('idx'), 's'),
+        'hisat2_pe': Hisat2(data_dir, ctx.tool('hisat2'), '', output_dir, ctx.path('idx'), 'p', sort_threads=2,
+                            cpus_per_job=4),
+        'fastqc': FastQC(data_dir, ctx.tool('fastqc'), output_dir, '.fq.gz'),
+        'featurecounts': FeatureCounts(data_dir, ctx.tool('featureCounts'), '-T 1', output_dir, gtf),
+        'stringtie': StringTie(data_dir, ctx.tool('stringtie'), '', output_dir, gtf, ctab_dir),
+        'pool': Pool(data_dir, ctx.tool('samtools'), output_dir),
+        'pool_merge_sorted': Pool(data_dir, ctx.tool('samtools'), output_dir, merge_sorted=True, index=True),
+        'sort': Sort(data_dir, ctx.tool('samtools'), output_dir, index=True),
+        'gtf2bed': GTF2Bed(data_dir, ctx.tool('gtf2bed'), output_dir),
+        'gtf2bed_native': GTF2Bed(data_dir, None, output_dir, native=True),
+        'chunk': FastqChunk(data_dir, output_dir, 4, 'p'),
+        'trimalign_se': TrimAlign(Cutadapt(data_dir, ctx.tool('cutadapt'), '-q 20', None, output_dir, 's'),
+                                  Hisat2(data_dir, ctx.tool('hisat2'), '', output_dir, ctx.path('idx'), 's')),
+        'trimalign_pe': TrimAlign(Cutadapt(data_dir, ctx.tool('cutadapt'), '-q 20', None, output_dir, 'p'),
+                                  Hisat2(data_dir, ctx.tool('hisat2'), '', output_dir, ctx.path('idx'), 'p'),
+                                  keep_trimmed=True),
+    }
+
+
+def get_inputs(name: str, fastqs: list, pairs: list, bams: list, gtfs: list):
+    """ What each pipeline's jobs are run on: files, pairs, groups of files or (featureCounts) all files at once. """
+    if name in ('cutadapt_pe', 'hisat2_pe', 'chunk', 'trimalign_pe'):
+        return pairs
+    if name.startswith('pool'):
+        return [bams[i:i + 4] for i in range(0, len(bams), 4)]
+    if name == 'featurecounts':
+        return [bams]
+    if name in ('stringtie', 'sort'):
+        return bams
+    if name.startswith('gtf2bed'):
+        return gtfs
+    return fastqs
+
+
+def write_inputs(ctx: Context, data_dir: str, n: int, reads=0) -> tuple:
+    """ n single end FASTQs, n pairs, n BAMs and n GTFs (FASTQs only have reads if reads is set). """
+    if reads:
+        fastqs = fixtures.write_fastqs(os.path.join(data_dir, 'se'), n, reads)
+        paired = fixtures.write_fastqs(os.path.join(data_dir, 'pe'), n, reads, paired=True)
+    else:
+        fastqs = fixtures.touch_files(os.path.join(data_dir, 'se'), [f's{i}_R1.fq.gz' for i in range(n)])
+        paired = fixtures.touch_files(os.path.join(data_dir, 'pe'), [f's{i}_R{m}.fq.gz' for i in range(n)
+                                                                     for m in '12'])
+    bams = fixtures.write_bams(os.path.join(data_dir, 'bam'), [f'HISAT2_s{i}.fq.gz.sorted.bam' for i in range(n)],
+                               ctx.output_size)
+    gtfs = []
+    for i in range(n):
+        gtf = os.path.join(data_dir, f'annotation{i}.gtf')
+        shutil.copyfile(ctx.path('bench.gtf'), gtf)
+        gtfs.append(gtf)
+    pairs, _ = pair_files(paired)
+    return fastqs, pairs, bams, gtfs
+
+
+@benchmark('cmd')
+def bench_cmd_generation(ctx: Context) -> dict:
+    """ generate_cmd (and get_output_files, get_job_resources, as done for every job) of every pipeline. """
+    data_dir = ctx.path('cmd_inputs')
+    fastqs, pairs, bams, gtfs = write_inputs(ctx, data_dir, ctx.files)
+    results = {}
+    for name in make_pipelines(ctx, data_dir, ctx.new_dir('cmd')):
+        def setup(name=name):
+            # StringTie makes a ctab directory for each file as it generates the cmd, so each repeat needs new ones
+            return quiet(make_pipelines(ctx, data_dir, ctx.new_dir('cmd'))[name])
+
+        def run(pipeline, name=name):
+            for f in get_inputs(name, fastqs, pairs, bams, gtfs):
+                pipeline.get_job_resources(pipeline.generate_cmd(f))
+                pipeline.get_output_files(f)
+        results[f'cmd.{name}'] = timeit(run, ctx.repeats, setup, len(get_inputs(name, fastqs, pairs, bams, gtfs)))
+    return results
+
+
+async def _noop():
+    return None
+
+
+@benchmark('scheduling')
+def bench_scheduling(ctx: Context) -> dict:
+    """ Overhead of the scheduler per job (no-op coroutine jobs), and of starting a process (the fake tool). """
+    def run_noop():
+        scheduler = JobScheduler(max_cpus=ctx.cpus, max_mem='1G')
+        scheduler.run([Job(_noop, name=f'job{i}', mem='1M') for i in range(ctx.jobs * 10)])
+
+    def run_mixed():
+        # Jobs of different sizes, so most are queued behind larger ones
+        scheduler = JobScheduler(max_cpus=ctx.cpus, max_mem='1G')
+        scheduler.run([Job(_noop, name=f'job{i}', cpus=1 + i % ctx.cpus, mem=f'{1 + i % 3 * 100}M')
+                       for i in range(ctx.jobs * 10)])
+
+    def run_processes():
+        output_dir = ctx.new_dir('scheduling')
+        pipeline = quiet(Sort(output_dir, ctx.tool('samtools'), output_dir, nthreads=ctx.cpus))
+        pipeline.use_cache = False
+        pipeline.generate_cmd = lambda f: f'{ctx.tool("samtools")} --noop'
+        pipeline.run_per_file([f'f{i}' for i in range(ctx.jobs)])
+
+    def run_spawn():
+        for _ in range(ctx.jobs // 10 or 1):
+            os.system(f'{ctx.tool("samtools")} --noop')
+
+    return {'scheduling.noop_jobs': timeit(run_noop, ctx.repeats, n=ctx.jobs * 10),
+            'scheduling.mixed_jobs': timeit(run_mixed, ctx.repeats, n=ctx.jobs * 10),
+            'scheduling.process_jobs': timeit(run_processes, ctx.repeats, n=ctx.jobs),
+            # Baseline for process_jobs: just starting the fake tool, the difference is scirnap's overhead
+            'scheduling.tool_spawn': timeit(run_spawn, ctx.repeats, n=ctx.jobs // 10 or 1)}
+
+
+@benchmark('discovery')
+def bench_discovery(ctx: Context) -> dict:
+    """ Listing input files (cold and with a manifest), pairing mates and grouping files by sample. """
+    n = ctx.discovery_files
+    data_dir = ctx.path('discovery')
+    subdirs = 20
+    names = [os.path.join(f'lane{i % subdirs}', f'run1.BC{i // 4:05d}.L00{i % 4 + 1}_R{m}.fq.gz')
+             for i in range(n // 2) for m in '12']
+    for i in range(subdirs):
+        os.makedirs(os.path.join(data_dir, f'lane{i}'), exist_ok=True)
+    paths = fixtures.touch_files(data_dir, names)
+    # As the inputs of a real run, written well before it (directories changed just now are always listed again)
+    for dir_path in [data_dir] + [os.path.join(data_dir, f'lane{i}') for i in range(subdirs)]:
+        os.utime(dir_path, (time.time() - 3600, time.time() - 3600))
+    sheet = ctx.path('sample_sheet.csv')
+    fixtures.write_sample_sheet(sheet, n // 8)
+    manifest = ctx.path('discovery_manifest.json')
+    find_files(data_dir, '*.fq.gz', True, manifest)
+    return {
+        'discovery.find_files': timeit(lambda: find_files(data_dir, '*.fq.gz', True), ctx.repeats, n=n),
+        'discovery.find_files_manifest': timeit(lambda: find_files(data_dir, '*.fq.gz', True, manifest),
+                                                ctx.repeats, n=n),
+        'discovery.pair_files': timeit(lambda: pair_files(paths), ctx.repeats, n=n),
+        'discovery.group_files': timeit(lambda: group_files(paths, sheet, ['Barcode', 'Lane']), ctx.repeats, n=n),
+    }
+
+
+@benchmark('parsing')
+def bench_parsing(ctx: Context) -> dict:
+    """ Parsing tool outputs: HISAT2 summaries, featureCounts tables, MultiQC tables, FASTQs and GTFs. """
+    summaries = fixtures.write_hisat2_summaries(ctx.path('summaries'), ctx.summaries, paired=True)
+    counts = ctx.path('counts.txt')
+    fixtures.write_featurecounts_table(counts, ctx.genes, ctx.samples)
+    multiqc = ctx.path('multiqc_fastqc.txt')
+    fixtures.write_multiqc_table(multiqc, ctx.files * 10)
+    fastq = ctx.path('scan.fq.gz')
+    fixtures.write_fastq(fastq, ctx.reads)
+    ctabs = fixtures.write_ctabs(ctx.path('ctab'), ctx.samples, ctx.genes)
+    gtf = ctx.path('bench.gtf')
+    n_gtf_lines = sum(1 for _ in open(gtf))
+    metrics = ['per_base_sequence_quality', 'adapter_content']
+
+    def select():
+        selector = QCSelector(multiqc)
+        for metric in metrics:
+            selector.select(metric, 'fail')
+        selector.select(metrics, ['warn', 'fail'], how='any')
+
+    return {
+        'parsing.hisat2_summaries': timeit(lambda: summarise_summary_files(summaries), ctx.repeats, n=ctx.summaries),
+        'parsing.featurecounts': timeit(lambda: load_counts(counts), ctx.repeats, n=ctx.genes),
+        'parsing.featurecounts_sparse': timeit(lambda: load_counts(counts, sparse=True), ctx.repeats, n=ctx.genes),
+        'parsing.ctab_collate': timeit(lambda: collate_ctabs(ctabs), ctx.repeats, n=ctx.samples),
+        'parsing.multiqc_select': timeit(select, ctx.repeats, n=ctx.files * 10),
+        'parsing.fastq_scan': timeit(lambda: scan_fastq(fastq), ctx.repeats, n=ctx.reads),
+        'parsing.gtf_index': timeit(lambda: GTFIndex.parse(gtf), ctx.repeats, n=n_gtf_lines),
+        'parsing.gtf_to_bed12': timeit(lambda: gtf_to_bed12(gtf, os.devnull, 1), ctx.repeats, n=n_gtf_lines),
+    }
+
+
+def _overhead(result: dict, jobs: int, concurrency: int, latency: float) -> dict:
+    """ Wall time beyond the fake tools' latency, i.e. what scirnap (and starting the processes) added. """
+    ideal = math.ceil(jobs / max(concurrency, 1)) * latency
+    result.update({'jobs': jobs, 'ideal_s': ideal, 'overhead_s': result['median_s'] - ideal,
+                   'overhead_per_job_ms': (result['median_s'] - ideal) / jobs * 1e3 if jobs else None})
+    return result
+
+
+@benchmark('e2e')
+def bench_end_to_end(ctx: Context) -> dict:
+    """ Every pipeline run (run_per_file / run_on_files) on the fake tools, then a whole DAG. """
+    data_dir = ctx.path('e2e_inputs')
+    inputs = write_inputs(ctx, data_dir, ctx.e2e_files, reads=ctx.reads // 10)
+    results = {}
+    for name in make_pipelines(ctx, data_dir, ctx.new_dir('e2e')):
+        files = get_inputs(name, *inputs)
+        cpus = []
+
+        def setup(name=name):
+            return quiet(make_pipelines(ctx, data_dir, ctx.new_dir('e2e'))[name])
+
+        def run(pipeline):
+            pipeline.nthreads = ctx.cpus
+            cpus.append(pipeline.get_job_resources()[0])
+            jobs = pipeline.run_per_file(files)
+            failed = [job for job in jobs if job.status != 'done']
+            if failed:
+                raise RuntimeError(f'{name}: {len(failed)} jobs failed, first error: {failed[0].error}')
+        result = timeit(run, ctx.repeats, setup, len(files))
+        # The chunker and native gtf2bed are scirnap itself (no latency)
+        latency = 0 if name in ('chunk', 'gtf2bed_native') else ctx.latency
+        results[f'e2e.{name}'] = _overhead(result, len(files), ctx.cpus // min(cpus[0], ctx.cpus), latency)
+
+    def dag_setup():
+        output_dir = ctx.new_dir('dag')
+        pipelines = make_pipelines(ctx, data_dir, output_dir)
+        dag = PipelineDAG(JobScheduler(max_cpus=ctx.cpus, max_mem='64G'), verbose=False)
+        chunk, trim, align = [quiet(pipelines[n]) for n in ('chunk', 'cutadapt_pe', 'hisat2_pe')]
+        trim.output_dir = chunk.output_dir = os.path.join(output_dir, 'fq')
+        pool = quiet(Pool(output_dir, ctx.tool('samtools'), output_dir, merge_sorted=True))
+        counts = quiet(pipelines['featurecounts'])
+        dag.add_stage('chunk', chunk)
+        dag.add_stage('trim', trim, after='chunk')
+        dag.add_stage('align', align, after='trim')
+        dag.add_stage('pool', pool, after='align', mode='group', group_fn=pool.group_chunks)
+        dag.add_stage('count', counts, after='pool', mode='all')
+        return dag
+
+    def dag_run(dag):
+        # The DAG pairs the mates of its first (paired) stage itself
+        jobs = dag.run([f for pair in inputs[1] for f in pair])
+        failed = [job for stage_jobs in jobs.values() for job in stage_jobs if job.status != 'done']
+        if failed:
+            raise RuntimeError(f'dag: {len(failed)} jobs failed, first error: {failed[0].error}')
+
+    # chunk: one job per pair, trim and align: one per pair of chunks, pool: one per pair, count: one
+    n_jobs = len(inputs[1]) * (1 + 2 * 4 + 1) + 1
+    results['e2e.dag'] = timeit(dag_run, ctx.repeats, dag_setup, n_jobs)
+    return results
+
+
+def run_benchmarks(config=None, only=None, work_dir=None) -> dict:
+    """ Runs the benchmarks (the groups in only, or all) and returns the results with the environment they ran in. """
+    config = {**DEFAULT_CONFIG, **(config or {})}
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='scirnap_bench_')
+    cwd, env = os.getcwd(), dict(os.environ)
+    ctx = Context(work_dir, config)
+    # The fake samtools has to be first on the PATH for Hisat2's pipe, versions are cached in the work dir
+    os.environ['PATH'] = f'{ctx.bin_dir}{os.pathsep}{os.environ.get("PATH", "")}'
+    os.environ['SCIRNAP_CACHE_DIR'] = ctx.path('cache')
+    os.environ['SCIRNAP_FAKE_LATENCY'] = str(config['latency'])
+    os.environ['SCIRNAP_FAKE_SIZE'] = str(config['output_size'])
+    # Logfiles are written to the working directory
+    os.chdir(work_dir)
+    results = {}
+    try:
+        fixtures.write_gtf(ctx.path('bench.gtf'), config['gtf_genes'])
+        for group, fn in BENCHMARKS:
+            if only and group not in only:
+                continue
+            print(f'Running {group}: {fn.__name__}', file=sys.stderr)
+            results.update(fn(ctx))
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(env)
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return {'scirnap_version': scirnap.__version__, 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'date': datetime.now().isoformat(),
+            'config': config, 'results': results}
+
+
+def compare(new: dict, old: dict, threshold=0.1) -> list:
+    """ Change in median time of each benchmark in both runs, returns the names of those more than threshold slower. """
+    slower = []
+    print(f'{"benchmark":<40} {"old (s)":>10} {"new (s)":>10} {"change":>8}')
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before, after = old['results'][name]['median_s'], result['median_s']
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if change > threshold:
+            slower.append(name)
+            flag = '  slower'
+        print(f'{name:<40} {before:>10.4f} {after:>10.4f} {change:>+8.1%}{flag}')
+    if new['config'] != old['config']:
+        print('Warning: the runs were made with different configs.')
+    return slower
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of scirnap with synthetic inputs and fake tools.')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON file the results are written to.')
+    parser.add_argument('--only', nargs='+', default=None, choices=sorted({group for group, _ in BENCHMARKS}),
+                        help='Only run these groups.')
+    parser.add_argument('--quick', action='store_true', help='Inputs a tenth of the size (e.g. for CI).')
+    parser.add_argument('--compare', type=str, default=None, help='Earlier results JSON to compare with.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Slowdown reported as a regression (0.1=10%%).')
+    parser.add_argument('--repeats', type=int, default=None, help='Times each benchmark is run.')
+    parser.add_argument('--latency', type=float, default=None, help='Seconds each fake tool call takes.')
+    parser.add_argument('--output-size', type=int, default=None, help='Bytes of each file the fake tools write.')
+    parser.add_argument('--config', type=str, default=None, help='JSON of sizes to override e.g. \'{"files": 10}\'.')
+    parser.add_argument('--work-dir', type=str, default=None, help='Directory for the inputs (kept), default temp.')
+    args = parser.parse_args(args)
+    config = dict(DEFAULT_CONFIG)
+    if args.quick:
+        config.update({k: max(v // 10, 2) for k, v in config.items() if k in ('files', 'discovery_files', 'jobs',
+                                                                               'reads', 'genes', 'samples',
+                                                                               'gtf_genes', 'summaries')})
+        config['e2e_files'] = 4
+    for key in ('repeats', 'latency', 'output_size'):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    config.update(json.loads(args.config) if args.config else {})
+    output = run_benchmarks(config, args.only, args.work_dir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(output, json.load(f), args.threshold)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -23,13 +23,17 @@ __author__ = 'Ariane Mora'
 __author_email__ = 'ariane.n.mora@gmail.com'
 __license__ = 'GPL3'
 
+from scirnap.scheduler import Job, JobScheduler
 from scirnap.base import BasePipeline, PipelineException
 from scirnap.featurecounts import FeatureCounts
 from scirnap.cutadapt import Cutadapt
 from scirnap.fastqc import FastQC
 from scirnap.hisat2 import Hisat2
+from scirnap.trimalign import TrimAlign
 from scirnap.stringtie import StringTie
+from scirnap.chunk import FastqChunk
 from scirnap.pool import Pool
 from scirnap.sort import Sort
 from scirnap.gtf2bed import GTF2Bed
+from scirnap.dag import PipelineDAG, Stage
 
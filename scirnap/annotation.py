@@ -0,0 +1,215 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Parsed GTF annotation index.
+
+The GTF is parsed once into array backed columns (chrom, feature, start, end, strand, gene_id, transcript_id). String
+columns are stored as int32 codes into category arrays kept in first seen order (the order featureCounts uses for its
+rows). The arrays are saved as .npy files in a cache directory keyed by a hash of the GTF and are memory mapped when
+loaded again, so re-opening a 1.5G GTF takes milliseconds. Loaded indexes are also memoized per process so FeatureCounts,
+StringTie and GTF2Bed share one copy.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+
+from scirnap.cache import fingerprint, get_cache_dir as _get_cache_dir
+
+_GTF_COLUMNS = {0: 'chrom', 2: 'feature', 3: 'start', 4: 'end', 6: 'strand', 8: 'attributes'}
+_CODE_COLUMNS = ['chrom', 'feature', 'gene_id', 'transcript_id']
+_STRANDS = {'+': 1, '-': -1}
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def get_cache_dir() -> str:
+    """ Directory the indexes are cached in, set SCIRNAP_CACHE_DIR to move it (e.g. to shared storage). """
+    return _get_cache_dir('annotation')
+
+
+def _encode(values, lookup: dict) -> np.ndarray:
+    """ int32 codes for values, adding new values to lookup (value -> code) in the order they are first seen. """
+    codes, uniques = pd.factorize(values, sort=False)
+    mapping = np.array([lookup.setdefault(u, len(lookup)) for u in uniques], dtype=np.int32)
+    encoded = np.full(len(codes), -1, dtype=np.int32)  # -1 where the value is missing
+    found = codes >= 0
+    encoded[found] = mapping[codes[found]]
+    return encoded
+
+
+class GTFIndex:
+
+    def __init__(self, columns: dict, categories: dict, gtf_path=None):
+        self.columns, self.categories, self.gtf_path = columns, categories, gtf_path
+
+    def __len__(self):
+        return len(self.columns['start'])
+
+    def __getattr__(self, name):
+        # Columns are available as attributes e.g. index.start
+        columns = self.__dict__.get('columns', {})
+        if name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    @staticmethod
+    def get_key(gtf_path: str) -> str:
+        """
+        Hash of the GTF which names its cache directory: its path, size, mtime and inode as well as its first and last
+        MB, so a GTF edited in the middle (same size, same ends) still gets a new index.
+        """
+        stat = os.stat(gtf_path)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps(fingerprint(gtf_path, method='hash') + [stat.st_mtime_ns, stat.st_ino]).encode())
+        return h.hexdigest()
+
+    @classmethod
+    def load(cls, gtf_path: str, cache_dir=None, use_cache=True, chunksize=1000000):
+        """
+        Returns the index for the GTF, memory mapped from the cache if it has been parsed before, otherwise the GTF is
+        parsed and (if use_cache) saved to cache_dir (defaults to get_cache_dir()).
+        """
+        if not os.path.exists(gtf_path):
+            raise FileNotFoundError(f'GTF file does not exist: {gtf_path}')
+        key = cls.get_key(gtf_path)
+        with _loaded_lock:
+            if key in _loaded:
+                return _loaded[key]
+            index_dir = os.path.join(cache_dir or get_cache_dir(), key)
+            if use_cache and os.path.exists(os.path.join(index_dir, 'start.npy')):
+                index = cls.from_dir(index_dir, gtf_path)
+            else:
+                index = cls.parse(gtf_path, chunksize)
+                if use_cache:
+                    index.save(index_dir)
+            _loaded[key] = index
+            return index
+
+    @classmethod
+    def parse(cls, gtf_path: str, chunksize=1000000):
+        """ Parses the GTF (optionally gzipped) in chunks so the raw attribute strings are never all in memory. """
+        lookups = {col: {} for col in _CODE_COLUMNS}
+        chunks = {col: [] for col in ['chrom', 'feature', 'start', 'end', 'strand', 'gene_id', 'transcript_id']}
+        # Not comment='#', which would also cut off attribute values with a # in them, comment lines are dropped below
+        reader = pd.read_csv(gtf_path, sep='\t', header=None, usecols=list(_GTF_COLUMNS), names=list(range(9)),
+                             dtype={col: str for col in _GTF_COLUMNS}, chunksize=chunksize, quoting=3)
+        for chunk_df in reader:
+            chunk_df = chunk_df.rename(columns=_GTF_COLUMNS)
+            chunk_df = chunk_df[~chunk_df['chrom'].str.startswith('#', na=False)]
+            chunk_df = chunk_df.astype({'start': np.int64, 'end': np.int64})
+            attributes = chunk_df['attributes'].fillna('')
+            chunks['gene_id'].append(_encode(attributes.str.extract(r'gene_id "([^"]*)"')[0], lookups['gene_id']))
+            chunks['transcript_id'].append(_encode(attributes.str.extract(r'transcript_id "([^"]*)"')[0],
+                                                   lookups['transcript_id']))
+            chunks['chrom'].append(_encode(chunk_df['chrom'], lookups['chrom']))
+            chunks['feature'].append(_encode(chunk_df['feature'], lookups['feature']))
+            chunks['start'].append(chunk_df['start'].values)
+            chunks['end'].append(chunk_df['end'].values)
+            chunks['strand'].append(chunk_df['strand'].map(_STRANDS).fillna(0).values.astype(np.int8))
+        columns = {col: np.concatenate(values) if values else np.array([], dtype=np.int32)
+                   for col, values in chunks.items()}
+        categories = {col: np.array(list(lookup), dtype=str) for col, lookup in lookups.items()}
+        return cls(columns, categories, gtf_path)
+
+    def save(self, index_dir: str):
+        """ Saves every array as .npy, written to a temp directory first so a half written index is never loaded. """
+        tmp_dir = f'{index_dir}.tmp{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok=True)
+        for col, values in self.columns.items():
+            np.save(os.path.join(tmp_dir, f'{col}.npy'), values)
+        for col, values in self.categories.items():
+            np.save(os.path.join(tmp_dir, f'{col}_categories.npy'), values)
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+        os.rename(tmp_dir, index_dir)
+
+    @classmethod
+    def from_dir(cls, index_dir: str, gtf_path=None):
+        columns, categories = {}, {}
+        for filename in os.listdir(index_dir):
+            name = filename[:-4]
+            values = np.load(os.path.join(index_dir, filename), mmap_mode='r')
+            if name.endswith('_categories'):
+                categories[name[:-len('_categories')]] = values
+            else:
+                columns[name] = values
+        return cls(columns, categories, gtf_path)
+
+    def decode(self, col: str, codes=None) -> np.ndarray:
+        """ The string values of a coded column (chrom, feature, gene_id or transcript_id), '' where missing. """
+        codes = self.columns[col] if codes is None else codes
+        values = np.append(self.categories[col], '')
+        return values[codes]  # -1 picks the '' appended at the end
+
+    @property
+    def gene_ids(self) -> np.ndarray:
+        """ Gene ids in the order they first appear in the GTF (the row order of featureCounts). """
+        return np.asarray(self.categories['gene_id'])
+
+    @property
+    def transcript_ids(self) -> np.ndarray:
+        return np.asarray(self.categories['transcript_id'])
+
+    @property
+    def chroms(self) -> np.ndarray:
+        return np.asarray(self.categories['chrom'])
+
+    def get_gene_order(self, feature='exon') -> np.ndarray:
+        """ Gene ids in the order they first appear on rows of the feature type (the row order of featureCounts -t). """
+        mask = self.feature_mask(feature)
+        codes = np.asarray(self.columns['gene_id'])[mask]
+        return self.decode('gene_id', pd.unique(codes[codes >= 0]))
+
+    def has_feature(self, feature: str) -> bool:
+        return feature in set(self.categories['feature'])
+
+    def feature_mask(self, feature: str) -> np.ndarray:
+        features = list(self.categories['feature'])
+        if feature not in features:
+            return np.zeros(len(self), dtype=bool)
+        return np.asarray(self.columns['feature']) == features.index(feature)
+
+    def to_df(self) -> pd.DataFrame:
+        return pd.DataFrame({'chrom': self.decode('chrom'), 'feature': self.decode('feature'),
+                             'start': self.columns['start'], 'end': self.columns['end'],
+                             'strand': self.columns['strand'], 'gene_id': self.decode('gene_id'),
+                             'transcript_id': self.decode('transcript_id')})
+
+    def gene_summary(self, feature='exon') -> pd.DataFrame:
+        """ One row per gene (in GTF order) with its chrom, start, end, strand and number of transcripts/features. """
+        mask = self.feature_mask(feature) & (np.asarray(self.columns['gene_id']) >= 0)
+        df = pd.DataFrame({'gene_code': np.asarray(self.columns['gene_id'])[mask],
+                           'chrom': np.asarray(self.columns['chrom'])[mask],
+                           'start': np.asarray(self.columns['start'])[mask],
+                           'end': np.asarray(self.columns['end'])[mask],
+                           'strand': np.asarray(self.columns['strand'])[mask],
+                           'transcript_code': np.asarray(self.columns['transcript_id'])[mask]})
+        summary_df = df.groupby('gene_code', sort=True).agg(chrom=('chrom', 'first'), start=('start', 'min'),
+                                                            end=('end', 'max'), strand=('strand', 'first'),
+                                                            n_transcripts=('transcript_code', 'nunique'),
+                                                            n_features=('start', 'size'))
+        summary_df['chrom'] = self.decode('chrom', summary_df['chrom'].values)
+        summary_df.index = self.decode('gene_id', summary_df.index.values)
+        summary_df.index.name = 'gene_id'
+        return summary_df
@@ -14,14 +14,25 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
 #                                                                             #
 ###############################################################################
+import asyncio
 from datetime import datetime
 import os
-import subprocess
+import re
 import ntpath
-from multiprocessing.dummy import Pool as ThreadPool
 
 from sciutil import SciUtil, SciException
 
+from scirnap.cache import RunCache, CACHE_FILENAME
+from scirnap.discovery import ending_pattern, find_files, get_mate, pair_files, DEFAULT_MATE_PATTERN, \
+    MANIFEST_FILENAME
+from scirnap.executor import AsyncExecutor
+from scirnap.journal import JobJournal, JOURNAL_FILENAME
+from scirnap.metrics import MetricsWriter
+from scirnap.scheduler import Job, JobScheduler, parse_mem
+from scirnap.staging import Stager, rewrite_cmd
+from scirnap.version import get_program_version
+from scirnap.workqueue import QueueExecutor
+
 
 class PipelineException(SciException):
     def __init__(self, message=''):
@@ -30,30 +41,64 @@ class PipelineException(SciException):
 
 class BasePipeline:
 
+    # Resources needed by a single job, used by the scheduler. Subclasses declare the flags their program uses to set
+    # the number of threads (read from the param string), any extra processes piped in the command and the memory.
+    thread_flags = ()
+    extra_cpus = 0
+    mem_per_job = 0
+    # Paired end pipelines take a (R1, R2) tuple per job, the mates are matched on mate_pattern (see scirnap.discovery)
+    paired = False
+    mate_pattern = DEFAULT_MATE_PATTERN
+    # Failed jobs are run again up to retries times, waiting retry_delay seconds (doubled after each attempt) first
+    retries = 0
+    retry_delay = 10.0
+
     def __init__(self, data_dir: str, program_location: str, output_dir=None, logfile=None, verbose=True,
-                 file_ending=None, name=None, dryrun=False, nthreads=None):
+                 file_ending=None, name=None, dryrun=False, nthreads=None, use_cache=True):
         self.data_dir = data_dir
         self.output_dir = data_dir if output_dir is None else output_dir
         self.logfile_location = logfile or f'{name}_logfile-{datetime.now().strftime("%d%m%Y-%H%M%S")}.txt'
         self.logfile = open(self.logfile_location, 'a+')
+        # The stdout and stderr of each job are written to their own files next to the logfile
+        self.executor = AsyncExecutor(f'{os.path.splitext(self.logfile_location)[0]}_jobs')
+        # Wall time, CPU time, peak RSS and I/O of every cmd (see scirnap.metrics)
+        self.metrics = MetricsWriter(f'{os.path.splitext(self.logfile_location)[0]}_metrics.jsonl')
         self.u = SciUtil()
         self.verbose = verbose
         self.dryrun, self.nthreads = dryrun, nthreads
+        self.cpus_per_job = None  # Overrides the number of CPUs derived from the param string
         self.program_location = program_location
         # Check it is a location
         if not os.path.exists(self.data_dir):
             self.u.err_p([f'Error: checked for data location & directory does not exist.\n Please check '
                           f'{data_dir} and re-run.\nProgram terminating.'])
-        # Write the version of the program to the logfile
-        self.program_version = subprocess.Popen(f'{program_location} --version', shell=True,
-                                                stdout=subprocess.PIPE).stdout.read()  # Call subprocess
+        # Probed lazily (see scirnap.version) so creating a pipeline doesn't block on <program> --version
+        self._program_version = None
+        self.file_ending, self.name = file_ending, name
+        self.params = {}
+        # Skip jobs that already completed in a previous run (see scirnap.cache)
+        self.use_cache, self.cache = use_cache, None
+        # Job states are written to a journal (see scirnap.journal), with resume jobs it has as done are skipped
+        self.resume, self.journal = False, None
+        # Inputs and outputs copied through node-local scratch (see use_staging)
+        self.stager = None
+        # Every job of this pipeline's runs which failed, e.g. so the CLI exits with an error
+        self.failed_jobs = []
+
+    @property
+    def program_version(self) -> str:
+        """ Version of the program, probed the first time it is needed (and only once per executable). """
+        if self._program_version is None:
+            self._program_version = get_program_version(self.program_location)
+        return self._program_version
+
+    def add_version_to_logfile(self):
+        """ Write the version of the program to the logfile """
         if not self.program_version:
             self.u.warn_p([f'Warning: the version of your program could not be determined i.e.'
                            f' --version did not return. Continuing to run.'])
-        else:
-            self.logfile.write(f'# program version: {self.program_version}')
-        self.file_ending, self.name = file_ending, name
-        self.params = {}
+        elif self.logfile and not self.logfile.closed:
+            self.logfile.write(f'# program version: {self.program_version}\n')
 
     def print_params(self):
         for p, v in self.params.items():
@@ -73,80 +118,345 @@ class BasePipeline:
         for p, v in self.params.items():
             self.logfile.write(f'# {p}: {v}\n')
 
-    def exec_cmd(self, cmd):
+    def exec_cmd(self, cmd, job_name=None):
+        return asyncio.run(self.exec_cmd_async(cmd, job_name))
+
+    async def exec_cmd_async(self, cmd, job_name=None):
+        """ Runs the cmd on the event loop, raises a PipelineException if it exits with a non-zero code. """
         if self.logfile:
             self.logfile.write(f'{cmd}\t {datetime.now().strftime("%d/%m/%Y %H:%M:%S")}\n')
-        if not self.dryrun:
-            pid = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
-            if self.verbose:
-                print(pid)
-        else:
+        if self.dryrun:
             self.u.dp([f'Normally would be executing cmd:\n{cmd}'])
+            return None
+        cpus, mem = self.get_job_resources(cmd)
+        result = await self.executor.run_cmd(cmd, job_name or self.name, cpus=cpus, mem=mem)
+        self.metrics.write({'job': job_name or self.name, 'program': self.name, 'cpus': cpus, 'mem': mem,
+                            **result.get_metrics()})
+        if self.logfile:
+            self.logfile.write(f'# exit code: {result.returncode}\twall time: {result.wall_time:.2f}s\t'
+                               f'stdout: {result.stdout_path}\tstderr: {result.stderr_path}\n')
+        if self.verbose:
+            self.u.dp([f'Finished cmd with exit code {result.returncode} in {result.wall_time:.2f}s, output in: '
+                       f'{result.stdout_path}'])
+        if not result.ok:
+            raise PipelineException(f'Error: cmd exited with code {result.returncode}, see {result.stderr_path}:\n'
+                                    f'{cmd}')
+        return result
 
     def generate_cmd(self, filepath):
         return 'echo YouNeedToSelectAnOverridingClass'
 
-    def get_files_in_dir(self) -> list:
-        files = os.listdir(self.data_dir)
-        file_paths = []
-        for filename in files:
-            if self.file_ending in filename:
-                filepath = os.path.join(self.data_dir, filename)
-                file_paths.append(filepath)
+    def get_output_files(self, filepath) -> list:
+        """ The files written by the cmd for filepath which are passed on to the next stage of a pipeline. """
+        return []
+
+    def get_cache_inputs(self, file_path) -> list:
+        """ Files the run cache checks are unchanged before a job is skipped, the job's input file(s) by default. """
+        return list(file_path) if isinstance(file_path, (list, tuple)) else [file_path]
 
-        return file_paths
+    def get_files_in_dir(self, pattern=None, recursive=False, use_manifest=False) -> list:
+        """
+        Files in data_dir ending in file_ending (or file_ending.gz), or matching pattern (a glob e.g. '*_R1.fq.gz' or a
+        compiled regex) instead. recursive: also look in sub directories. use_manifest: keep the directory listings in
+        a manifest in the output directory so that later runs only list directories that have changed.
+        """
+        match = pattern if pattern is not None else ending_pattern(self.file_ending)
+        manifest_path = None
+        if use_manifest:
+            os.makedirs(self.output_dir, exist_ok=True)
+            manifest_path = os.path.join(self.output_dir, MANIFEST_FILENAME)
+        return find_files(self.data_dir, match, recursive, manifest_path)
+
+    def pair_files(self, file_paths) -> list:
+        """ Pairs the R1 and R2 files (one job per pair), files without a mate are left out with a warning. """
+        pairs, unpaired = pair_files(file_paths, self.mate_pattern)
+        if unpaired:
+            self.u.warn_p([f'Warning: could not find the mate of {len(unpaired)} files, these are not run:\n',
+                           '\n'.join(unpaired)])
+        return pairs
+
+    def get_pair_name(self, file_pair):
+        """ Name of a pair of files (R1 with the mate removed) e.g. s1.fq.gz for (s1_R1.fq.gz, s1_R2.fq.gz). """
+        return get_mate(file_pair[0], self.mate_pattern)[1] or file_pair[0]
 
     def run_on_files(self, file_paths):
         """ Since we run all files at once, we overwrite this method. """
+        self.check_inputs()
         cmd = self.generate_cmd(file_paths)
 
         if self.verbose:
             self.u.dp([f'Running {self.name} on files in: {self.data_dir}'])
 
-        self.exec_cmd(cmd)
+        self.add_version_to_logfile()
+        asyncio.run(self._exec_job(file_paths, cmd))
 
         # Close the logfile
         self.logfile.close()
 
     def run_on_file(self, file_path):
+        self.check_inputs()
         cmd = self.generate_cmd(file_path)
 
         if self.verbose:
             self.u.dp([f'Running {self.name} on files in: {self.data_dir}'])
 
-        self.exec_cmd(cmd)
+        self.add_version_to_logfile()
+        asyncio.run(self._exec_job(file_path, cmd))
         # Close the logfile
         self.logfile.close()
 
-    def _gen_and_exec_cmd(self, file_path):
-        cmd = self.generate_cmd(file_path)
-        if self.verbose:
-            self.u.dp([f'Running {self.name} on file: {file_path}'])
+    def get_job_resources(self, cmd=None) -> tuple:
+        """ Returns the (CPU slots, memory in bytes) that a single job of this program needs. """
+        cpus = self.cpus_per_job
+        if cpus is None:
+            cpus = self._get_threads_in_params() + self.extra_cpus
+        return cpus, parse_mem(self.mem_per_job)
+
+    def _get_threads_in_params(self) -> int:
+        """ Number of threads the program was asked to use in the param string (1 if not set). """
+        threads = self._get_param_value(self.thread_flags)
+        return int(threads) if threads and threads.isdigit() else 1
+
+    def _get_param_value(self, flags):
+        """ Value given to the first of flags (e.g. ('-p', '--threads')) found in the param string, None if not set. """
+        param_str = getattr(self, 'param_str', '') or ''
+        for flag in ([flags] if isinstance(flags, str) else flags):
+            match = re.search(rf'(?:^|\s){re.escape(flag)}[\s=]+(\S+)', param_str)
+            if match:
+                return match.group(1)
+        return None
+
+    def get_scheduler_resources(self, cmd=None) -> tuple:
+        """
+        The (CPU slots, memory) a job takes up in the scheduler here. Jobs sent to a work queue take no memory here,
+        the workers check the memory of their own node (the queue is still sent the job's memory).
+        """
+        cpus, mem = self.get_job_resources(cmd)
+        return cpus, 0 if isinstance(self.executor, QueueExecutor) else mem
+
+    def _strip_params(self, flags) -> str:
+        """ The param string without the flags (e.g. ('-p', '--threads')) and their values, e.g. to set them here. """
+        param_str = getattr(self, 'param_str', '') or ''
+        for flag in ([flags] if isinstance(flags, str) else flags):
+            param_str = re.sub(rf'(?:^|\s){re.escape(flag)}(?:=|\s+)\S+', '', param_str)
+        return param_str.strip()
 
-        self.exec_cmd(cmd)
+    def get_cache(self):
+        """ The run cache lives in the output directory, it is only created once the subclass has set output_dir. """
+        if self.cache is None and self.use_cache and not self.dryrun and os.path.isdir(self.output_dir):
+            self.cache = RunCache(os.path.join(self.output_dir, CACHE_FILENAME))
+        return self.cache
 
-    def run_per_file(self, file_paths):
-        if self.nthreads:
-            # https://stackoverflow.com/questions/2846653/how-can-i-use-threading-in-python
+    def use_queue(self, queue_dir: str, poll_interval=1.0, lease_timeout=60.0):
+        """
+        Sends the cmds to the work queue in queue_dir (on storage shared with the nodes) to be run by scirnap workers
+        instead of running them here, see scirnap.workqueue. nthreads is then the number of CPU slots of the workers
+        that this pipeline's jobs can take up at once. The logs are written next to the logfile, so on shared storage.
+        """
+        self.executor = QueueExecutor(queue_dir, os.path.abspath(self.executor.log_dir), poll_interval, lease_timeout)
+
+    def use_staging(self, scratch_dir: str, budget='100G', prefetch=2, verify=True):
+        """
+        Runs each cmd on copies of its inputs in node-local scratch (copied prefetch jobs ahead, in the background)
+        with its outputs written to scratch and copied back (checksum verified) once it succeeds, see scirnap.staging.
+        budget is the scratch space this can use (for the inputs and, estimated as the size of the inputs, the outputs),
+        jobs which don't fit are run on the original files.
+        """
+        self.stager = Stager(scratch_dir, budget, prefetch, verify)
+
+    def close_staging(self):
+        if self.stager:
+            self.stager.close()
+            self.stager = None
+
+    def get_journal(self):
+        """ The job journal lives in the output directory, like the run cache. """
+        if self.journal is None and not self.dryrun and os.path.isdir(self.output_dir):
+            self.journal = JobJournal(os.path.join(self.output_dir, JOURNAL_FILENAME))
+        return self.journal
+
+    def add_to_journal(self, cmd, state, file_path=None, attempt=0, error=None):
+        journal = self.get_journal()
+        if journal:
+            journal.record(cmd, state, self._gen_job_name(file_path) if file_path else self.name, attempt, error)
+
+    def validate_inputs(self) -> bool:
+        """ Checks made once before any job is submitted (e.g. that the GTF has the features counted), False fails. """
+        return True
+
+    def validate_output(self, file_path) -> bool:
+        """ Checks the outputs of a job once written (run in a thread pool), the job fails if this returns False. """
+        return True
+
+    async def _validate_output_async(self, file_path) -> bool:
+        # Off the event loop, a check may parse the outputs (e.g. GTF2Bed's) and the other jobs mustn't wait on it. Only
+        # for pipelines which check their outputs, so that hundreds of jobs don't each take a thread for nothing
+        if getattr(self.validate_output, '__func__', None) is BasePipeline.validate_output:
+            return True
+        return await asyncio.get_running_loop().run_in_executor(None, self.validate_output, file_path)
+
+    def check_inputs(self):
+        """ Raises a PipelineException if validate_inputs fails (not on a dry run, the inputs may not exist yet). """
+        if not self.dryrun and not self.validate_inputs():
+            raise PipelineException(f'Error: {self.name} was not run since its inputs failed validation, see above.')
+
+    def _is_resumed(self, cmd, output_files) -> bool:
+        journal = self.get_journal()
+        return bool(self.resume and journal and journal.is_done(cmd, output_files))
+
+    def _get_cache_key(self, file_path, cmd, output_files):
+        cache = self.get_cache() if output_files else None
+        return cache.get_key(self.get_cache_inputs(file_path), self.program_version, cmd) if cache else None
+
+    def will_run(self, file_path, cmd) -> bool:
+        """ False if the job would be skipped, as done in the run being resumed or cached. """
+        output_files = self.get_output_files(file_path)
+        if self._is_resumed(cmd, output_files):
+            return False
+        try:
+            key = self._get_cache_key(file_path, cmd, output_files)
+        except OSError:
+            return True  # e.g. the input isn't there yet
+        return not (key and self.cache.is_complete(key))
+
+    def plan_staging(self, file_paths: list, cmds: list):
+        """ Tells the stager (if there is one) the inputs of the jobs that will run, in order, so it can prefetch. """
+        if self.stager and not self.dryrun:
+            self.stager.plan([list(f) if isinstance(f, (list, tuple)) else [f]
+                              for f, cmd in zip(file_paths, cmds) if self.will_run(f, cmd)])
+
+    def _skip_staging(self, file_path):
+        if self.stager:
+            self.stager.skip(list(file_path) if isinstance(file_path, (list, tuple)) else [file_path])
+
+    async def _exec_job(self, file_path, cmd):
+        """
+        Runs the cmd for file_path unless the same cmd already completed on the same inputs in a previous run (or, when
+        resuming, the journal has it as done). A failed cmd is retried (see retries) before the job fails.
+        """
+        output_files = self.get_output_files(file_path)
+        if self._is_resumed(cmd, output_files):
             if self.verbose:
-                self.u.dp(['Running multithreaded, number of threads: ', self.nthreads])
-            # Make sure the number of threads doesn't exceed number of files (that would be dumb) but hey you never
-            # know the inputs people choose...
-            self.nthreads = self.nthreads if self.nthreads < len(file_paths) else len(file_paths)
-            pool = ThreadPool(self.nthreads)
-            results = pool.map(self._gen_and_exec_cmd, file_paths)
+                self.u.dp([f'Skipping {self.name} on file: {file_path}, done in the run being resumed.'])
+            if self.logfile:
+                self.logfile.write(f'# resumed: {cmd}\n')
+            self._skip_staging(file_path)
+            return None
+        key = self._get_cache_key(file_path, cmd, output_files)
+        cache = self.cache if key else None
+        if cache and cache.is_complete(key):
             if self.verbose:
-                self.u.dp(["Outputs from executing cmds: ", results])
+                self.u.dp([f'Skipping {self.name} on file: {file_path}, outputs are up to date.'])
+            if self.logfile:
+                self.logfile.write(f'# cached: {cmd}\n')
+            self.add_to_journal(cmd, 'done', file_path)
+            self._skip_staging(file_path)
+            return None
+
+        if self.verbose:
+            self.u.dp([f'Running {self.name} on file: {file_path}'])
+
+        if self.stager and not self.dryrun:
+            result = await self._exec_staged(file_path, cmd, output_files)
         else:
-            for f in file_paths:
-                cmd = self.generate_cmd(f)
-                if self.verbose:
-                    self.u.dp([f'Running {self.name} on file: {f}'])
+            result = await self._exec_with_retries(file_path, cmd)
+        if not self.dryrun and not await self._validate_output_async(file_path):
+            error = f'Error: the outputs of {self._gen_job_name(file_path)} failed validation, see above.'
+            self.add_to_journal(cmd, 'failed', file_path, error=error)
+            raise PipelineException(error)
+        if cache:
+            cache.add(key, cmd, output_files)
+        return result
 
-                self.exec_cmd(cmd)
+    async def _exec_staged(self, file_path, cmd, output_files):
+        """ Runs the cmd on the staged inputs, writing its outputs to scratch, then copies the outputs back. """
+        inputs = list(file_path) if isinstance(file_path, (list, tuple)) else [file_path]
+        try:
+            staged = await self.stager.stage_in(inputs)
+        except OSError as e:
+            self.stager.release(inputs)
+            self.u.warn_p([f'Warning: could not stage the inputs of {self._gen_job_name(file_path)}, running it on '
+                           f'the original files:\n{e}'])
+            staged = None
+        if staged is None:
+            return await self._exec_with_retries(file_path, cmd)
+        output_paths = self.stager.get_output_paths(output_files)
+        try:
+            result = await self._exec_with_retries(file_path, cmd, rewrite_cmd(cmd, {**staged, **output_paths}))
+            await self.stager.write_back(output_paths, inputs)
+        finally:
+            # The outputs are removed before the scratch reserved for them is freed
+            self.stager.discard(output_paths)
+            self.stager.release(inputs)
+        return result
+
+    async def _exec_with_retries(self, file_path, cmd, run_cmd=None):
+        """
+        Runs the cmd, retrying with backoff for failures that may be transient (e.g. I/O errors on a share). run_cmd is
+        what is actually run if it isn't the cmd itself (e.g. on staged files), the journal has the cmd.
+        """
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            self.add_to_journal(cmd, 'running', file_path, attempt)
+            try:
+                result = await self.exec_cmd_async(run_cmd or cmd, self._gen_job_name(file_path))
+            except (PipelineException, OSError) as e:
+                self.add_to_journal(cmd, 'failed', file_path, attempt, e)
+                if attempt == self.retries:
+                    raise
+                self.u.warn_p([f'Warning: {self._gen_job_name(file_path)} failed (attempt {attempt + 1} of '
+                               f'{self.retries + 1}), retrying in {delay:.1f}s:\n{e}'])
+                if self.logfile:
+                    self.logfile.write(f'# retry {attempt + 1} in {delay:.1f}s: {cmd}\n')
+                await asyncio.sleep(delay)
+                delay *= 2
+            else:
+                self.add_to_journal(cmd, 'done', file_path, attempt)
+                return result
+
+    def run_per_file(self, file_paths, scheduler=None):
+        """
+        Runs one job per file through a resource aware scheduler, nthreads is the number of CPU slots shared by the jobs.
+        Pass a scheduler to share a node between several pipelines (e.g. Hisat2 and Sort at the same time).
+        """
+        scheduler = scheduler or JobScheduler(max_cpus=self.nthreads or 1)
+        self.check_inputs()
+        self.get_cache()
+        self.add_version_to_logfile()
+        if self.verbose:
+            self.u.dp(['Running with CPU budget: ', scheduler.max_cpus, 'memory budget: ', scheduler.max_mem])
+        jobs = []
+        for f in file_paths:
+            cmd = self.generate_cmd(f)
+            self.add_to_journal(cmd, 'pending', f)
+            cpus, mem = self.get_scheduler_resources(cmd)
+            jobs.append(Job(self._exec_job, (f, cmd), name=self._gen_job_name(f), cpus=cpus, mem=mem))
+        self.plan_staging(file_paths, [job.args[1] for job in jobs])
+        scheduler.run(jobs)
+        self.add_jobs_to_logfile(jobs, scheduler)
+        self.close_staging()
 
         # Close the logfile
         self.logfile.close()
+        return jobs
+
+    def add_jobs_to_logfile(self, jobs, scheduler):
+        """ Writes the queue/wait/run times of each job to the logfile and reports any failed jobs. """
+        report = scheduler.report(jobs)
+        for row in report.itertuples():
+            self.logfile.write(f'# job: {row.name}\tstatus: {row.status}\tcpus: {row.cpus}\tmem: {row.mem}\t'
+                               f'wait: {row.wait_time:.2f}s\trun: {row.run_time:.2f}s\n')
+        failed = [job for job in jobs if job.status == 'failed']
+        self.failed_jobs.extend(failed)
+        for job in failed:
+            self.u.warn_p([f'Warning: job {job.name} failed with error:\n{job.error}'])
+        if self.verbose:
+            self.u.dp(['Job times: \n', report.to_string(index=False)])
+
+    def _gen_job_name(self, file_path):
+        # Pool jobs are given a list of files so we name those after the first one
+        file_path = file_path[0] if isinstance(file_path, (list, tuple)) else file_path
+        return f'{self.name}:{self._get_filename(file_path)}'
 
     @staticmethod
     def _get_filename(file_path):
@@ -154,5 +464,5 @@ class BasePipeline:
         return tail or ntpath.basename(head)
 
     def _gen_fname_str(self, file_path):
-        return f'{os.path.join(self.output_dir, self.name)}-' \
-               f'{datetime.now().strftime("%d%m%Y")}_{self._get_filename(file_path)}'
\ No newline at end of file
+        # No date in the name so that outputs are found (and reused) when the pipeline is re-run
+        return f'{os.path.join(self.output_dir, self.name)}_{self._get_filename(file_path)}'
\ No newline at end of file
@@ -0,0 +1,107 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Incremental re-run cache.
+
+Each completed job is recorded with a key made from the fingerprint of its input files, the version of the program
+and the full cmd. On a re-run a job whose key matches a record, and whose outputs are all still there, is skipped.
+Records are appended to a JSON lines file so a crash part way through a run keeps everything that finished.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+CACHE_FILENAME = '.scirnap_cache.jsonl'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'scirnap')
+
+
+def get_cache_dir(name=None) -> str:
+    """ scirnap's cache directory (or its sub directory name), set SCIRNAP_CACHE_DIR to move it. """
+    cache_dir = os.environ.get('SCIRNAP_CACHE_DIR', DEFAULT_CACHE_DIR)
+    return os.path.join(cache_dir, name) if name else cache_dir
+
+
+def fingerprint(file_path: str, method='stat') -> list:
+    """
+    Fingerprint of a file, either from stat (size and mtime) or a fast hash of the size, the first and last MB of the
+    file (hash, for file systems where the mtime isn't reliable e.g. after a copy).
+    """
+    file_path = os.path.abspath(file_path)
+    if not os.path.exists(file_path):
+        return [file_path, None]
+    stat = os.stat(file_path)
+    if method == 'stat':
+        return [file_path, stat.st_size, stat.st_mtime_ns]
+    block = 1024 * 1024
+    h = hashlib.blake2b(str(stat.st_size).encode(), digest_size=16)
+    with open(file_path, 'rb') as f:
+        h.update(f.read(block))
+        if stat.st_size > block:
+            f.seek(max(stat.st_size - block, block))
+            h.update(f.read(block))
+    return [file_path, stat.st_size, h.hexdigest()]
+
+
+class RunCache:
+
+    def __init__(self, cache_path: str, method='stat'):
+        """
+        cache_path: the JSON lines file with the completed jobs (created if it doesn't exist).
+        method: how input files are fingerprinted, stat (size & mtime) or hash.
+        """
+        self.cache_path = cache_path
+        self.method = method
+        self.records = {}
+        self._lock = threading.Lock()
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        record = json.loads(line)
+                        self.records[record['key']] = record
+
+    def get_key(self, input_files, program_version, cmd: str) -> str:
+        input_files = input_files if isinstance(input_files, (list, tuple)) else [input_files]
+        if isinstance(program_version, bytes):
+            program_version = program_version.decode(errors='replace')
+        key = {'inputs': [fingerprint(f, self.method) for f in input_files],
+               'version': str(program_version or '').strip(), 'cmd': cmd}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def is_complete(self, key: str) -> bool:
+        """ The job has been run before and all of its outputs still exist with the same size. """
+        record = self.records.get(key)
+        if record is None:
+            return False
+        for output_file, size in record['outputs'].items():
+            if not os.path.exists(output_file) or os.path.getsize(output_file) != size:
+                return False
+        return True
+
+    def add(self, key: str, cmd: str, output_files: list) -> bool:
+        """ Records a completed job, returns False (and records nothing) if any of its outputs are missing. """
+        if not all(os.path.exists(f) for f in output_files):
+            return False
+        record = {'key': key, 'cmd': cmd, 'outputs': {os.path.abspath(f): os.path.getsize(f) for f in output_files}}
+        with self._lock:
+            self.records[key] = record
+            with open(self.cache_path, 'a+') as f:
+                f.write(json.dumps(record) + '\n')
+        return True
@@ -0,0 +1,162 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Splits large FASTQs into chunks so one lane can be trimmed and aligned by many jobs at once.
+
+The FASTQ is streamed (memory is one batch of reads) and batches of whole records are dealt round robin to the chunks,
+so every chunk gets the same number of reads (give or take one batch) without knowing the number of reads up front.
+The mates of paired end reads are read in lockstep and each batch of R1 goes to the same chunk as the matching batch of
+R2, so the chunks stay in sync.
+
+Chunks are named <file>.chunk<i>.<ending> e.g. s1_R1.chunk003.fq.gz, the aligned chunks are merged back per file with
+Pool.group_chunks.
+"""
+
+import argparse
+import gzip
+import os
+import re
+import sys
+from itertools import islice
+
+from scirnap import BasePipeline, PipelineException, __version__
+
+FASTQ_ENDINGS = ('.fastq.gz', '.fq.gz', '.fastq', '.fq')
+CHUNK_PATTERN = re.compile(r'\.chunk\d+(?=\.|$)')
+
+
+def _split_ending(filename: str) -> tuple:
+    for ending in FASTQ_ENDINGS:
+        if filename.endswith(ending):
+            return filename[:-len(ending)], ending
+    return os.path.splitext(filename)
+
+
+def get_chunk_paths(fastq_path: str, output_dir: str, nchunks: int, prefix='') -> list:
+    """ Paths of the chunks split_fastq writes for the FASTQ. """
+    stem, ending = _split_ending(os.path.basename(fastq_path))
+    return [os.path.join(output_dir, f'{prefix}{stem}.chunk{i:03d}{ending}') for i in range(nchunks)]
+
+
+def get_chunk_source(file_path: str) -> str:
+    """ Name of the file a chunk (or a file made from a chunk e.g. its BAM) came from, without the chunk or .bam. """
+    filename = CHUNK_PATTERN.sub('', os.path.basename(file_path))
+    for ending in ('.sorted.bam', '.merged.bam', '.bam'):
+        if filename.endswith(ending):
+            return filename[:-len(ending)]
+    return filename
+
+
+def _open(path: str, mode: str, compresslevel=1):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=compresslevel) if 'w' in mode else gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _read_batch(f, batch_size: int, path: str) -> list:
+    """ The next batch_size records (4 lines each) of the FASTQ, checking each starts on a record boundary. """
+    lines = list(islice(f, batch_size * 4))
+    if len(lines) % 4:
+        raise PipelineException(f'Error: {path} ends part way through a record (not a multiple of 4 lines).')
+    if any(line[:1] != b'@' for line in lines[::4]) or any(line[:1] != b'+' for line in lines[2::4]):
+        raise PipelineException(f'Error: {path} is not a FASTQ with 4 line records (a header line does not start '
+                                f'with @ or a separator line with +).')
+    return lines
+
+
+def split_fastq(fastq_path: str, output_dir: str, nchunks: int, mate_path=None, prefix='', batch_size=10000,
+                compresslevel=1) -> list:
+    """
+    Splits the FASTQ (and its mate if paired) into nchunks chunks in output_dir, returns the chunk paths (a list of
+    (R1, R2) tuples if paired). Gzipped chunks are written at compresslevel 1, they are only read by the next stage.
+    """
+    paths = [fastq_path] if mate_path is None else [fastq_path, mate_path]
+    os.makedirs(output_dir, exist_ok=True)
+    chunk_paths = [get_chunk_paths(path, output_dir, nchunks, prefix) for path in paths]
+    inputs = [_open(path, 'rb') for path in paths]
+    outputs = [[_open(chunk_path, 'wb', compresslevel) for chunk_path in chunks] for chunks in chunk_paths]
+    try:
+        chunk = 0
+        while True:
+            batches = [_read_batch(f, batch_size, path) for f, path in zip(inputs, paths)]
+            if len({len(batch) for batch in batches}) > 1:
+                raise PipelineException(f'Error: the mates {fastq_path} and {mate_path} have a different number of '
+                                        f'reads.')
+            if not batches[0]:
+                break
+            for batch, chunk_files in zip(batches, outputs):
+                chunk_files[chunk].writelines(batch)
+            chunk = (chunk + 1) % nchunks
+    finally:
+        for f in inputs + [f for chunk_files in outputs for f in chunk_files]:
+            f.close()
+    return chunk_paths[0] if mate_path is None else list(zip(*chunk_paths))
+
+
+class FastqChunk(BasePipeline):
+
+    mem_per_job = '256M'
+
+    def __init__(self, data_dir: str, output_dir: str, nchunks: int, s_or_p='s', file_ending='.fq.gz', name='CHUNK',
+                 dryrun=False, nthreads=None, mate_pattern=None, batch_size=10000):
+        """
+        Pipeline stage which splits each FASTQ (or pair of FASTQs) into nchunks chunks, run in its own python process.
+        In a PipelineDAG each chunk is passed on to the next stage as its own job.
+        """
+        program_location = f'{sys.executable} -c "import sys; from scirnap.chunk import main; main(sys.argv[1:])"'
+        super().__init__(data_dir, program_location, output_dir=output_dir, file_ending=file_ending, name=name,
+                         dryrun=dryrun, nthreads=nthreads)
+        if s_or_p not in ['s', 'p']:
+            self.u.err_p([f'Error: passed an invalid parameter for s_or_p: {s_or_p}.\n'
+                          f'Please use "s" or "p" (s=single ended reads, p=paired ended reads in separate files.)'])
+            return
+        self.nchunks, self.batch_size = nchunks, batch_size
+        self.paired = s_or_p == 'p'
+        self.mate_pattern = mate_pattern or self.mate_pattern
+        self.params = {'Chunks': nchunks, 'Single or paired': s_or_p, 'Output dir': output_dir}
+        self.add_params_to_logfile()
+
+    def generate_cmd(self, filepath):
+        files = ' '.join(filepath) if isinstance(filepath, (list, tuple)) else filepath
+        return f'{self.program_location} --chunks {self.nchunks} --batch-size {self.batch_size} ' \
+               f'--prefix {self.name}_ {self.output_dir} {files}'
+
+    def get_output_files(self, filepath) -> list:
+        files = filepath if isinstance(filepath, (list, tuple)) else [filepath]
+        return [chunk for f in files for chunk in get_chunk_paths(f, self.output_dir, self.nchunks, f'{self.name}_')]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Split a FASTQ (or a pair of FASTQs) into chunks.')
+    parser.add_argument('output_dir', nargs='?', help='Directory the chunks are written to.')
+    parser.add_argument('fastq', nargs='*', help='FASTQ file (can be gzipped) and optionally its mate.')
+    parser.add_argument('--chunks', type=int, default=2, help='Number of chunks.')
+    parser.add_argument('--batch-size', type=int, default=10000, help='Reads dealt to a chunk at a time.')
+    parser.add_argument('--prefix', type=str, default='', help='Prefix of the chunk filenames.')
+    parser.add_argument('--version', action='store_true', help='Print the version.')
+    args = parser.parse_args(args)
+    if args.version:
+        print(f'scirnap chunk v{__version__}')
+        return
+    if not args.output_dir or len(args.fastq) not in (1, 2):
+        parser.error('an output directory and one or two FASTQ files are required')
+    split_fastq(args.fastq[0], args.output_dir, args.chunks, args.fastq[1] if len(args.fastq) == 2 else None,
+                args.prefix, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,23 +14,95 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
 #                                                                             #
 ###############################################################################
-from scirnap import BasePipeline
+""" Documentation: https://cutadapt.readthedocs.io/en/stable/ """
+
+import os
+import threading
+
+from scirnap import BasePipeline, PipelineException
+import numpy as np
 import pandas as pd
 
-""" Documentation: https://cutadapt.readthedocs.io/en/stable/ """
+QC_FLAGS = ['pass', 'warn', 'fail']
+
+# Loaded MultiQC tables keyed by (path, size, mtime) so a table is only read again once it changes
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def load_multiqc_table(multiqc_path: str) -> pd.DataFrame:
+    """
+    The MultiQC (e.g. multiqc_fastqc.txt) table indexed by Filename, with the pass/warn/fail columns as categoricals
+    so they compare as small int codes. Cached per process until the file changes.
+    """
+    stat = os.stat(multiqc_path)
+    key = (os.path.abspath(multiqc_path), stat.st_size, stat.st_mtime_ns)
+    with _tables_lock:
+        if key not in _tables:
+            multiqc_df = pd.read_csv(multiqc_path, sep='\t')
+            for col in multiqc_df.columns:
+                if not pd.api.types.is_numeric_dtype(multiqc_df[col]) and multiqc_df[col].dropna().isin(QC_FLAGS).all():
+                    multiqc_df[col] = pd.Categorical(multiqc_df[col], categories=QC_FLAGS, ordered=True)
+            _tables[key] = multiqc_df.set_index('Filename', drop=False)
+        return _tables[key]
+
+
+class QCSelector:
+
+    def __init__(self, multiqc_path: str, data_dir=''):
+        """ Selects files from a MultiQC table, file paths are the Filename column joined to data_dir. """
+        self.multiqc_df = load_multiqc_table(multiqc_path)
+        self.columns = list(self.multiqc_df.columns)
+        # Resolved once so each selection is a single boolean index into the array
+        self.paths = np.array([os.path.join(data_dir, f) for f in self.multiqc_df['Filename'].values], dtype=object)
+
+    def get_mask(self, metrics, flags='fail', how='any') -> np.ndarray:
+        """
+        Boolean mask of the rows where any (how='any') or all (how='all') of metrics have one of flags e.g.
+        get_mask(['adapter_content', 'per_base_n_content'], ['warn', 'fail']).
+        """
+        metrics = [metrics] if isinstance(metrics, str) else list(metrics)
+        flags = [flags] if isinstance(flags, str) else list(flags)
+        missing = [m for m in metrics if m not in self.columns]
+        if missing:
+            raise PipelineException(f'Error: metrics {", ".join(missing)} are not in the MultiQC columns: '
+                                    f'{", ".join(self.columns)}')
+        bad_flags = [f for f in flags if f not in QC_FLAGS]
+        if bad_flags:
+            raise PipelineException(f'Error: flags {", ".join(bad_flags)} are not one of: {", ".join(QC_FLAGS)}')
+        matches = self.multiqc_df[metrics].isin(flags).values
+        return matches.any(axis=1) if how == 'any' else matches.all(axis=1)
+
+    def select(self, metrics, flags='fail', how='any') -> list:
+        """ Paths of the files where any/all of metrics have one of flags, see get_mask. """
+        return list(self.paths[self.get_mask(metrics, flags, how)])
+
+    def query(self, expr: str) -> list:
+        """
+        Paths of the files matching a pandas query over the table e.g.
+        "per_base_n_content == 'fail' or (adapter_content != 'pass' and `Total Sequences` < 1000000)".
+        """
+        return list(self.paths[self.multiqc_df.eval(expr).values.astype(bool)])
 
 
 class Cutadapt(BasePipeline):
 
+    thread_flags = ('-j', '--cores')
+    mem_per_job = '512M'
+
     def __init__(self, data_dir: str, program_location: str, param_str: str, multiqc_path: str, output_dir: str,
-                 s_or_p: str, file_ending='.fq.gz', name='CUTADAPT', dryrun=False, nthreads=None):
+                 s_or_p: str, file_ending='.fq.gz', name='CUTADAPT', dryrun=False, nthreads=None,
+                 mate_pattern=None):
         super().__init__(data_dir, program_location, file_ending=file_ending, name=name, dryrun=dryrun,
                          nthreads=nthreads)
-        if s_or_p not in ['s' or 'p']:
+        if s_or_p not in ['s', 'p']:
             self.u.err_p([f'Error: passed an invalid parameter for s_or_p: {s_or_p}.\n'
                           f'Please use "s" or "p" (s=single ended reads, p=paired ended reads in separate files.)'])
             return
         self.s_or_p = s_or_p
+        # Paired end jobs are given a (R1, R2) tuple, see BasePipeline.pair_files
+        self.paired = s_or_p == 'p'
+        self.mate_pattern = mate_pattern or self.mate_pattern
         self.multiqc_path = multiqc_path
         self.param_str = param_str
         self.output_dir = output_dir
@@ -41,28 +113,46 @@ class Cutadapt(BasePipeline):
     def generate_se_cmd(self, filepath):
         return f'{self.program_location} {self.param_str} -o {self._gen_fname_str(filepath)} {filepath}'
 
-    def generate_pe_cmd(self, filepath):
-        """ """
-        self.u.err_p([f'Error: paired end implementation not yet implemented.'])
-        return
+    def get_output_files(self, filepath) -> list:
+        # One trimmed file per mate for paired end reads
+        if isinstance(filepath, (list, tuple)):
+            return [self._gen_fname_str(f) for f in filepath]
+        return [self._gen_fname_str(filepath)]
+
+    def generate_pe_cmd(self, file_pair):
+        """ Trims both mates of a pair together (-p is the output for R2) so reads stay in sync between the files. """
+        if not isinstance(file_pair, (list, tuple)) or len(file_pair) != 2:
+            raise PipelineException(f'Error: paired end mode needs a pair of files (R1, R2), got: {file_pair}. '
+                                    f'Use pair_files to pair them.')
+        r1, r2 = file_pair
+        return f'{self.program_location} {self.param_str} -o {self._gen_fname_str(r1)} -p {self._gen_fname_str(r2)} ' \
+               f'{r1} {r2}'
 
     def generate_cmd(self, filepath):
         """ """
         if self.s_or_p == 's':
             return self.generate_se_cmd(filepath)
+        return self.generate_pe_cmd(filepath)
+
+    def get_qc_selector(self) -> QCSelector:
+        """ Selector over the MultiQC report, the table is only read once (and again if the report changes). """
+        return QCSelector(self.multiqc_path, self.data_dir)
 
-    def get_qc_files(self, metric: str, flag='fail'):
-        """  Reads through the multi qc report and returns a list of failed (fail) or caution (warn) files. """
-        multiqc_df = pd.read_csv(self.multiqc_path, sep='\t')
-        if metric not in list(multiqc_df.columns):
+    def get_qc_files(self, metric, flag='fail', how='any'):
+        """
+        Reads through the multi qc report and returns a list of failed (fail) or caution (warn) files. metric and flag
+        can also be lists e.g. get_qc_files(['adapter_content', 'overrepresented_sequences'], ['warn', 'fail']) for
+        the files with a warning or failure in any (how='any') or all (how='all') of the metrics.
+        """
+        selector = self.get_qc_selector()
+        metrics = [metric] if isinstance(metric, str) else list(metric)
+        flags = [flag] if isinstance(flag, str) else list(flag)
+        if not all(m in selector.columns for m in metrics):
             self.u.err_p([f'Error: Metric passed to get_qc_files ({metric}) was not in multiqc file columns:\n',
-                          list(multiqc_df.columns)])
+                          selector.columns])
             return
-        if flag not in ['pass', 'warn', 'fail']:
+        if not all(f in QC_FLAGS for f in flags):
             self.u.err_p([f'Error: flag passed to get_qc_files ({flag}) was not an allowed parameter: \n '
                           f'[pass, warn, fail]\nTerminating, please run again.'])
             return
-        files = multiqc_df['Filename'].values[multiqc_df[metric] == flag]
-        # add the directory path to the data
-        file_paths = [f'{self.data_dir}{f}' for f in files]
-        return file_paths
+        return selector.select(metrics, flags, how)
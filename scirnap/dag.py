@@ -0,0 +1,206 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Multi-stage pipelines: wires BasePipeline objects into a DAG which streams files from one stage to the next.
+
+A per_file stage starts a job as soon as one of its inputs is written by the upstream stage (e.g. a sample is aligned
+by Hisat2 as soon as Cutadapt has trimmed it). Stages which need all of their inputs at once (FeatureCounts on every
+BAM, or Pool which merges groups of BAMs) wait until every upstream stage has finished.
+
+    dag = PipelineDAG(JobScheduler(max_cpus=64))
+    dag.add_stage('trim', cutadapt)
+    dag.add_stage('align', hisat2, after='trim')
+    dag.add_stage('counts', featurecounts, after='align', mode='all')
+    dag.run(cutadapt.get_files_in_dir())
+"""
+
+import threading
+
+from sciutil import SciUtil
+
+from scirnap.base import PipelineException
+from scirnap.scheduler import Job, JobScheduler
+
+
+class Stage:
+
+    modes = ['per_file', 'all', 'group']
+
+    def __init__(self, name: str, pipeline, after=None, mode='per_file', group_fn=None):
+        """
+        name: name of the stage, used by other stages to refer to it in after.
+        pipeline: the BasePipeline (e.g. Hisat2) object that generates the cmds for the stage.
+        after: name or list of names of the stages whose outputs are the inputs to this stage (None for the first).
+        mode: per_file (one job per input, started as soon as the input exists), all (one job given every input, e.g.
+              FeatureCounts) or group (one job per group returned by group_fn(inputs), e.g. Pool).
+        """
+        if mode not in self.modes:
+            raise PipelineException(f'Error: stage mode {mode} is not one of: {", ".join(self.modes)}')
+        if mode == 'group' and group_fn is None:
+            raise PipelineException(f'Error: stage {name} is a group stage so needs a group_fn.')
+        self.name, self.pipeline, self.mode, self.group_fn = name, pipeline, mode, group_fn
+        self.after = [after] if isinstance(after, str) else list(after or [])
+        self.upstream, self.downstream = [], []
+        self.inputs, self.jobs = [], []
+        self.pending = 0
+        self.finished = False
+        self.error = None
+
+
+class PipelineDAG:
+
+    def __init__(self, scheduler=None, verbose=True):
+        """ scheduler: JobScheduler shared by every stage (defaults to one using all cores of the machine). """
+        self.scheduler = scheduler or JobScheduler()
+        self.verbose = verbose
+        self.stages = {}
+        self.u = SciUtil()
+        self._lock = threading.RLock()
+        self._done = threading.Event()
+        self._failed_stage = None
+
+    def add_stage(self, name: str, pipeline, after=None, mode='per_file', group_fn=None) -> Stage:
+        if name in self.stages:
+            raise PipelineException(f'Error: a stage called {name} has already been added.')
+        stage = Stage(name, pipeline, after, mode, group_fn)
+        for upstream_name in stage.after:
+            if upstream_name not in self.stages:
+                raise PipelineException(f'Error: stage {name} runs after {upstream_name} which has not been added '
+                                        f'(stages must be added in order).')
+            upstream = self.stages[upstream_name]
+            stage.upstream.append(upstream)
+            upstream.downstream.append(stage)
+        self.stages[name] = stage
+        return stage
+
+    def run(self, file_paths=None) -> dict:
+        """
+        Runs the whole DAG. file_paths are the inputs to the first stage(s), if None each first stage uses the files in
+        its pipeline's data_dir. Returns a dict from stage name to the jobs that were run for it. Raises a
+        PipelineException once the running jobs have finished if a barrier stage could not submit its jobs.
+        """
+        roots = [stage for stage in self.stages.values() if not stage.upstream]
+        if not roots:
+            raise PipelineException('Error: the pipeline has no stages to run.')
+        self._done.clear()
+        self._failed_stage = None
+        for stage in self.stages.values():
+            stage.pipeline.check_inputs()
+        for stage in self.stages.values():
+            stage.pipeline.get_cache()
+            stage.pipeline.add_version_to_logfile()
+        with self._lock:
+            for stage in roots:
+                inputs = file_paths if file_paths is not None else stage.pipeline.get_files_in_dir()
+                if stage.pipeline.paired and stage.mode == 'per_file':
+                    inputs = stage.pipeline.pair_files(inputs)
+                if stage.mode == 'per_file':
+                    for f in inputs:
+                        self._submit(stage, f)
+                else:
+                    stage.inputs.extend(inputs)
+                self._stage_inputs_complete(stage)
+        self._done.wait()
+        for stage in self.stages.values():
+            stage.pipeline.add_jobs_to_logfile(stage.jobs, self.scheduler)
+            stage.pipeline.close_staging()
+            stage.pipeline.logfile.close()
+        failed = self._failed_stage
+        if failed is not None:
+            raise PipelineException(f'Error: stage {failed.name} failed to submit its jobs: {failed.error}') \
+                from failed.error
+        return {name: stage.jobs for name, stage in self.stages.items()}
+
+    def _submit(self, stage: Stage, file_path):
+        pipeline = stage.pipeline
+        cmd = pipeline.generate_cmd(file_path)
+        pipeline.add_to_journal(cmd, 'pending', file_path)
+        # Inputs are prefetched as the jobs are submitted, since only then are they known
+        pipeline.plan_staging([file_path], [cmd])
+        cpus, mem = pipeline.get_scheduler_resources(cmd)
+        job = Job(pipeline._exec_job, (file_path, cmd), name=pipeline._gen_job_name(file_path), cpus=cpus, mem=mem)
+        job.stage, job.file_path = stage, file_path
+        job.add_done_callback(self._job_done)
+        stage.pending += 1
+        stage.jobs.append(job)
+        self.scheduler.submit(job)
+
+    def _job_done(self, job: Job):
+        stage = job.stage
+        with self._lock:
+            stage.pending -= 1
+            try:
+                if job.status == 'done':
+                    outputs = stage.pipeline.get_output_files(job.file_path)
+                    for downstream in stage.downstream:
+                        if downstream.error is not None:
+                            continue
+                        if downstream.mode == 'per_file' and downstream.pipeline.paired:
+                            # e.g. trimmed R1 & R2 aligned as a pair, or each pair of chunks of a split pair of FASTQs
+                            for pair in downstream.pipeline.pair_files(outputs):
+                                self._submit(downstream, pair)
+                        elif downstream.mode == 'per_file':
+                            for f in outputs:
+                                self._submit(downstream, f)
+                        else:
+                            downstream.inputs.extend(outputs)
+                else:
+                    self.u.warn_p([f'Warning: {job.name} failed so its outputs are not passed on:\n{job.error}'])
+            finally:
+                # Even if passing the outputs on failed, so the run still finishes
+                self._check_finished(stage)
+
+    def _stage_inputs_complete(self, stage: Stage):
+        """ Called once every input of the stage is known, barrier (all/group) stages can now submit their jobs. """
+        try:
+            if stage.error is None and stage.mode == 'all' and stage.inputs:
+                self._submit(stage, list(stage.inputs))
+            elif stage.error is None and stage.mode == 'group':
+                for group in stage.group_fn(list(stage.inputs)):
+                    self._submit(stage, group)
+        except Exception as e:
+            self._fail_stage(stage, e)
+        self._check_finished(stage)
+
+    def _fail_stage(self, stage: Stage, error: Exception):
+        """
+        A barrier stage's group_fn or generate_cmd raised: nothing more is submitted for it or the stages downstream of
+        it, which still finish (once any jobs already running are done) so that run returns and raises the error.
+        """
+        self.u.err_p([f'Error: stage {stage.name} failed to submit its jobs: {error}'])
+        stage.error = error
+        if self._failed_stage is None:
+            self._failed_stage = stage
+        failed = list(stage.downstream)
+        while failed:
+            downstream = failed.pop()
+            if downstream.error is None:
+                downstream.error = error
+                failed.extend(downstream.downstream)
+
+    def _check_finished(self, stage: Stage):
+        inputs_complete = all(upstream.finished for upstream in stage.upstream)
+        if stage.finished or stage.pending or not inputs_complete:
+            return
+        stage.finished = True
+        if self.verbose:
+            self.u.dp([f'Finished stage: {stage.name}'])
+        for downstream in stage.downstream:
+            if all(upstream.finished for upstream in downstream.upstream):
+                self._stage_inputs_complete(downstream)
+        if all(s.finished for s in self.stages.values()):
+            self._done.set()
@@ -0,0 +1,192 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Input file discovery.
+
+Directories are listed with os.scandir (which gets the file type from the directory listing rather than a stat per
+entry) and files are matched on glob or regex patterns, optionally recursing into sub directories.
+
+A manifest records the size and mtime of every file found along with the mtime of the directory it was found in. A
+directory's mtime changes whenever a file is added, removed or renamed in it, so on a later run any directory with the
+same mtime is not listed again and its files are taken from the manifest. On a network file system with tens of
+thousands of FASTQ chunks this turns minutes of listing into one stat per directory. The manifest is only written
+again when a directory has changed. Note files rewritten in place (same name) don't change the directory's mtime so
+keep the size and mtime they had when the directory was last listed.
+"""
+
+import fnmatch
+import json
+import os
+import re
+import time
+
+MANIFEST_FILENAME = '.scirnap_manifest.json'
+# A directory changed within this long of being listed may have changed again within the same mtime tick, those are
+# always listed again (as git does for racy index entries)
+RACY_NS = 2 * 10 ** 9
+# Mate of a paired end FASTQ from its name, the group is the mate (1 or 2) e.g. s1_R1.fq.gz, s1_1.fq.gz or
+# s1_L001_R2_001.fastq.gz. The last match in the filename is used.
+DEFAULT_MATE_PATTERN = r'_R?([12])(?=[._]|$)'
+
+
+def compile_pattern(pattern):
+    """
+    Returns a function which tests a path (relative to the data directory) against the pattern, either a glob string
+    (e.g. '*_R1.fq.gz', matched on the filename unless the pattern has a /), a compiled regex (searched in the path) or
+    a function which is returned as is.
+    """
+    if callable(pattern):
+        return pattern
+    if isinstance(pattern, re.Pattern):
+        return lambda path: pattern.search(path) is not None
+    regex = re.compile(fnmatch.translate(pattern))
+    if '/' in pattern:
+        return lambda path: regex.match(path) is not None
+    return lambda path: regex.match(os.path.basename(path)) is not None
+
+
+def ending_pattern(file_ending):
+    """ Files ending in file_ending or file_ending.gz, so .fq matches x.fq.gz but not sidecars like x.fq.gz.md5. """
+    if not file_ending:
+        return lambda path: True
+    endings = (file_ending, f'{file_ending}.gz')
+    return lambda path: path.endswith(endings)
+
+
+class FileManifest:
+
+    def __init__(self, manifest_path=None):
+        """ manifest_path: JSON file the directory listings are kept in, if None every directory is always listed. """
+        self.manifest_path = manifest_path
+        self.dirs = {}
+        self.listed, self.reused = 0, 0
+        self.changed = False  # Whether anything differs from what was loaded, i.e. the manifest needs writing
+        if manifest_path and os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r') as f:
+                    self.dirs = json.load(f)
+            except ValueError:
+                self.dirs = {}  # A corrupt manifest just means listing everything again
+
+    def scan(self, data_dir: str, recursive=False) -> dict:
+        """
+        Returns {path: [size, mtime_ns]} of the files in data_dir (and every sub directory if recursive), paths are
+        relative to data_dir. Hidden files and directories (starting with .) are skipped.
+        """
+        data_dir = os.path.abspath(data_dir)
+        files = {}
+        seen = set()
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            dir_path = os.path.join(data_dir, rel_dir) if rel_dir else data_dir
+            seen.add(dir_path)
+            record = self._get_dir(dir_path)
+            for name, stat in record['files'].items():
+                files[os.path.join(rel_dir, name) if rel_dir else name] = stat
+            if recursive:
+                stack.extend(os.path.join(rel_dir, name) if rel_dir else name for name in record['dirs'])
+        if recursive:
+            # Forget directories which have been removed
+            prefix = data_dir + os.sep
+            for dir_path in [d for d in self.dirs if d.startswith(prefix) and d not in seen]:
+                del self.dirs[dir_path]
+                self.changed = True
+        return files
+
+    @staticmethod
+    def _is_racy(record: dict) -> bool:
+        return record['mtime_ns'] >= record['listed_ns'] - RACY_NS
+
+    def _get_dir(self, dir_path: str) -> dict:
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+        old = self.dirs.get(dir_path)
+        if old and old['mtime_ns'] == mtime_ns and not self._is_racy(old):
+            self.reused += 1
+            return old
+        self.listed += 1
+        record = {'mtime_ns': mtime_ns, 'listed_ns': time.time_ns(), 'files': {}, 'dirs': []}
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        record['dirs'].append(entry.name)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        record['files'][entry.name] = [stat.st_size, stat.st_mtime_ns]
+                except OSError:
+                    continue  # e.g. a broken symlink
+        # A racy directory listed again the same needs no write, unless it is no longer racy (so it is reused next time)
+        if old is None or any(old[key] != record[key] for key in ['mtime_ns', 'files', 'dirs']) or \
+                not self._is_racy(record):
+            self.dirs[dir_path] = record
+            self.changed = True
+        return record
+
+    def save(self):
+        """
+        Written (if anything changed) to a temp file and moved into place so a crash never leaves half a manifest.
+        """
+        if not self.manifest_path or not self.changed:
+            return
+        tmp_path = f'{self.manifest_path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.dirs, f)
+        os.replace(tmp_path, self.manifest_path)
+
+
+def find_files(data_dir: str, pattern, recursive=False, manifest_path=None) -> list:
+    """ Sorted paths (joined to data_dir) of the files matching pattern (see compile_pattern). """
+    match = compile_pattern(pattern)
+    manifest = FileManifest(manifest_path)
+    files = manifest.scan(data_dir, recursive)
+    manifest.save()
+    return sorted(os.path.join(data_dir, path) for path in files if match(path))
+
+
+def get_mate(file_path: str, mate_pattern=DEFAULT_MATE_PATTERN) -> tuple:
+    """ (mate, pair name) of a FASTQ e.g. ('1', 'dir/s1.fq.gz') for dir/s1_R1.fq.gz, (None, None) if it has no mate. """
+    head, filename = os.path.split(file_path)
+    matches = list(re.finditer(mate_pattern, filename))
+    if not matches:
+        return None, None
+    match = matches[-1]
+    return match.group(1), os.path.join(head, filename[:match.start()] + filename[match.end():])
+
+
+def pair_files(file_paths: list, mate_pattern=DEFAULT_MATE_PATTERN) -> tuple:
+    """
+    Pairs the mates of paired end FASTQs by their names (see get_mate), returns the sorted list of (R1, R2) tuples and
+    the list of files which couldn't be paired.
+    """
+    mates = {}
+    unpaired = []
+    for file_path in file_paths:
+        mate, pair_name = get_mate(file_path, mate_pattern)
+        if mate is None or mate in mates.setdefault(pair_name, {}):
+            unpaired.append(file_path)
+        else:
+            mates[pair_name][mate] = file_path
+    pairs = []
+    for pair_name, pair in mates.items():
+        if len(pair) == 2:
+            pairs.append((pair['1'], pair['2']))
+        else:
+            unpaired += pair.values()
+    return sorted(pairs), sorted(unpaired)
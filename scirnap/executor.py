@@ -0,0 +1,154 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Asynchronous execution of shell cmds.
+
+The stdout and stderr of each cmd are written straight to per-job log files by the OS (nothing is buffered in memory)
+and the processes are waited on from the asyncio event loop (through a pidfd on Linux, polling elsewhere), so hundreds
+of cmds can run at once without an OS thread per cmd.
+
+Processes are reaped with wait4 which gives the resource usage of the shell and every process it waited on, i.e. the
+whole of a piped cmd like hisat2 | samtools view | samtools sort.
+
+Cmds are run by bash with pipefail, so a pipe fails if any process in it does (not only the last one) e.g. a hisat2 that
+dies part way through doesn't leave a truncated BAM from samtools sort that looks finished.
+"""
+
+import asyncio
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+
+# ru_maxrss is in kilobytes on Linux and bytes on macOS, ru_inblock/ru_oublock count 512 byte blocks
+_MAXRSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+_BLOCK_SIZE = 512
+# What a cmd is run with, the cmd is appended
+SHELL = ['/bin/bash', '-o', 'pipefail', '-c']
+
+
+class CmdResult:
+
+    def __init__(self, cmd: str, returncode: int, stdout_path: str, stderr_path: str, started: float, finished: float,
+                 rusage=None):
+        self.cmd, self.returncode = cmd, returncode
+        self.stdout_path, self.stderr_path = stdout_path, stderr_path
+        self.started, self.finished = started, finished
+        self.user_time = rusage.ru_utime if rusage else None
+        self.sys_time = rusage.ru_stime if rusage else None
+        # Peak RSS of the largest single process, read/written bytes are what went to storage (not the page cache)
+        self.max_rss = rusage.ru_maxrss * _MAXRSS_UNIT if rusage else None
+        self.read_bytes = rusage.ru_inblock * _BLOCK_SIZE if rusage else None
+        self.write_bytes = rusage.ru_oublock * _BLOCK_SIZE if rusage else None
+
+    @property
+    def wall_time(self):
+        return self.finished - self.started
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def get_metrics(self) -> dict:
+        return {'cmd': self.cmd, 'returncode': self.returncode, 'started': self.started, 'finished': self.finished,
+                'wall_time': self.wall_time, 'user_time': self.user_time, 'sys_time': self.sys_time,
+                'max_rss': self.max_rss, 'read_bytes': self.read_bytes, 'write_bytes': self.write_bytes}
+
+    def __repr__(self):
+        return f'CmdResult(returncode={self.returncode}, wall_time={self.wall_time:.2f}s, cmd={self.cmd!r})'
+
+
+def exit_code(status: int) -> int:
+    """ Return code from a wait status, negative signal number if the process was killed (as in subprocess). """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+async def wait_pid(pid: int) -> tuple:
+    """ Waits for the child process without blocking the event loop and returns its (wait status, rusage). """
+    loop = asyncio.get_running_loop()
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        try:
+            pidfd = os.pidfd_open(pid)
+        except OSError:
+            pidfd = None
+    if pidfd is not None:
+        # The pidfd becomes readable when the process exits
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        return os.wait4(pid, 0)[1:]
+    delay = 0.01
+    while True:
+        wpid, status, rusage = os.wait4(pid, os.WNOHANG)
+        if wpid:
+            return status, rusage
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+
+class AsyncExecutor:
+
+    def __init__(self, log_dir: str, new_session=False):
+        """
+        log_dir: directory the stdout and stderr of each job are written to (created if it doesn't exist).
+        new_session: run each cmd in its own session, so that every process of the cmd is killed if it is cancelled
+                     (but a Ctrl-C in the terminal no longer reaches them).
+        """
+        self.log_dir = log_dir
+        self.new_session = new_session
+
+    def get_log_paths(self, job_name: str) -> tuple:
+        filename = re.sub(r'[^\w.-]+', '_', job_name or 'job')
+        return os.path.join(self.log_dir, f'{filename}.stdout'), os.path.join(self.log_dir, f'{filename}.stderr')
+
+    async def run_cmd(self, cmd: str, job_name=None, cpus=1, mem=0) -> CmdResult:
+        """ cpus and mem (what the job was scheduled with) are only used by executors which run the cmd elsewhere. """
+        os.makedirs(self.log_dir, exist_ok=True)
+        stdout_path, stderr_path = self.get_log_paths(job_name)
+        return await self.run_cmd_to(cmd, stdout_path, stderr_path)
+
+    async def run_cmd_to(self, cmd: str, stdout_path: str, stderr_path: str, cwd=None) -> CmdResult:
+        """ Runs the cmd (in cwd) with its stdout and stderr written to the given files, cancelling kills the cmd. """
+        started = time.time()
+        with open(stdout_path, 'wb') as stdout, open(stderr_path, 'wb') as stderr:
+            proc = subprocess.Popen(SHELL + [cmd], stdout=stdout, stderr=stderr, stdin=subprocess.DEVNULL, cwd=cwd,
+                                    start_new_session=self.new_session)
+        try:
+            status, rusage = await wait_pid(proc.pid)
+        except asyncio.CancelledError:
+            if self.new_session:
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+            proc.wait()
+            raise
+        # Let Popen know the process has been reaped
+        proc.returncode = exit_code(status)
+        return CmdResult(cmd, proc.returncode, stdout_path, stderr_path, started, time.time(), rusage)
+
+    def run(self, cmd: str, job_name=None) -> CmdResult:
+        """ Blocking version of run_cmd, for running a single cmd outside of the scheduler. """
+        return asyncio.run(self.run_cmd(cmd, job_name))
@@ -14,14 +14,214 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
 #                                                                             #
 ###############################################################################
+"""
+FastQC: https://dnacore.missouri.edu/PDF/FastQC_Manual.pdf
 
-from scirnap import BasePipeline
+Native read statistics (read counts, length distribution, per position mean quality, GC content and N rate) for quick
+triage before, or instead of, running FastQC.
 
-""" https://dnacore.missouri.edu/PDF/FastQC_Manual.pdf """
+Reads are read from the (gzipped) FASTQ in large blocks and the statistics of each batch of reads are computed with
+numpy over the concatenated bases/qualities of the batch, rather than per read in python. Files can be sampled (the
+first N reads or a reservoir sample of N reads over the whole file) and are scanned in parallel with a process pool.
+The summary table has the MultiQC multiqc_fastqc.txt columns for the stats it can compute (with pass/warn/fail flags
+using FastQC's thresholds on the mean rather than the quartiles) so it can be used with Cutadapt.get_qc_files.
+"""
+
+import gzip
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+from scirnap import BasePipeline, PipelineException
+
+_READ_BUFFER = 4 * 1024 * 1024
+_FASTQ_EXTENSIONS = ['.gz', '.bz2', '.txt', '.fastq', '.fq', '.csfastq', '.sam', '.bam']
+MULTIQC_COLUMNS = ['Sample', 'Filename', 'File type', 'Encoding', 'Total Sequences', 'Sequence length', '%GC',
+                   'avg_sequence_length', 'per_base_sequence_quality', 'per_sequence_quality_scores',
+                   'per_base_n_content', 'sequence_length_distribution', 'n_rate', 'sampled_sequences']
+
+
+def get_sample_name(filepath: str) -> str:
+    """ FastQC's name for a file: the filename with the compression and file type extensions removed. """
+    filename = os.path.basename(filepath)
+    for ext in _FASTQ_EXTENSIONS:
+        if filename.endswith(ext):
+            filename = filename[:-len(ext)]
+    return filename
+
+
+def _add(total, values):
+    """ Adds two count arrays of (possibly) different lengths, e.g. per position counts of batches of longer reads. """
+    if len(values) > len(total):
+        values, total = total, values
+    total = total.copy()
+    total[:len(values)] += values
+    return total
+
+
+class FastqStats:
+
+    def __init__(self):
+        self.reads, self.bases, self.gc, self.n = 0, 0, 0, 0
+        self.length_counts = np.zeros(0, dtype=np.int64)
+        self.position_counts = np.zeros(0, dtype=np.int64)
+        self.position_quality = np.zeros(0, dtype=np.float64)
+        self.position_n = np.zeros(0, dtype=np.int64)
+        self.gc_counts = np.zeros(101, dtype=np.int64)  # Reads by % GC
+        self.quality_counts = np.zeros(0, dtype=np.int64)  # Reads by mean quality
+
+    def add(self, seqs: list, quals: list):
+        """ Adds a batch of reads (sequence and quality lines without the newline). """
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        seq = np.frombuffer(b''.join(seqs), dtype=np.uint8) & 0xDF  # Upper case
+        qual = np.frombuffer(b''.join(quals), dtype=np.uint8).astype(np.int64) - 33  # Phred+33
+        if len(seq) != len(qual):
+            raise PipelineException('Error: a read has a different number of bases and quality scores.')
+        starts = np.cumsum(lengths) - lengths
+        positions = np.arange(len(seq)) - np.repeat(starts, lengths)
+        is_gc = (seq == ord('G')) | (seq == ord('C'))
+        is_n = seq == ord('N')
+        self.reads += len(seqs)
+        self.bases += len(seq)
+        self.gc += int(is_gc.sum())
+        self.n += int(is_n.sum())
+        self.length_counts = _add(self.length_counts, np.bincount(lengths))
+        self.position_counts = _add(self.position_counts, np.bincount(positions))
+        self.position_quality = _add(self.position_quality, np.bincount(positions, weights=qual))
+        self.position_n = _add(self.position_n, np.bincount(positions[is_n], minlength=lengths.max(initial=0)))
+        # Per read GC % and mean quality, reduceat needs the empty reads left out
+        has_bases = lengths > 0
+        read_starts, read_lengths = starts[has_bases], lengths[has_bases]
+        if len(read_starts):
+            read_gc = np.add.reduceat(is_gc.astype(np.int64), read_starts) * 100 / read_lengths
+            self.gc_counts += np.bincount(np.round(read_gc).astype(np.int64), minlength=101)
+            read_quality = np.add.reduceat(qual, read_starts) / read_lengths
+            self.quality_counts = _add(self.quality_counts, np.bincount(np.round(read_quality).astype(np.int64)))
+
+    @property
+    def mean_quality(self) -> np.ndarray:
+        """ Mean quality at each position of the reads (1 based position = index + 1). """
+        return self.position_quality / np.maximum(self.position_counts, 1)
+
+    @property
+    def n_rate(self) -> np.ndarray:
+        """ Fraction of bases that are N at each position. """
+        return self.position_n / np.maximum(self.position_counts, 1)
+
+    def get_position_df(self) -> pd.DataFrame:
+        return pd.DataFrame({'position': np.arange(1, len(self.position_counts) + 1), 'reads': self.position_counts,
+                             'mean_quality': self.mean_quality, 'n_rate': self.n_rate})
+
+    def get_flags(self) -> dict:
+        """ pass/warn/fail of the FastQC modules these stats cover (FastQC's thresholds, on means not quartiles). """
+        def flag(warn, fail):
+            return 'fail' if fail else 'warn' if warn else 'pass'
+        lengths = np.nonzero(self.length_counts)[0]
+        min_quality = self.mean_quality.min() if len(self.position_counts) else 0
+        modal_quality = self.quality_counts.argmax() if self.quality_counts.any() else 0
+        max_n = self.n_rate.max() if len(self.position_counts) else 0
+        return {'per_base_sequence_quality': flag(min_quality < 25, min_quality < 20),
+                'per_sequence_quality_scores': flag(modal_quality < 27, modal_quality < 20),
+                'per_base_n_content': flag(max_n > 0.05, max_n > 0.2),
+                'sequence_length_distribution': flag(len(lengths) > 1, len(lengths) == 0 or lengths[0] == 0)}
+
+    def get_summary(self, filepath: str) -> dict:
+        """ One row of the MultiQC style table. """
+        lengths = np.nonzero(self.length_counts)[0]
+        length_str = '' if not len(lengths) else str(lengths[0]) if len(lengths) == 1 else \
+            f'{lengths[0]}-{lengths[-1]}'
+        return {'Sample': get_sample_name(filepath), 'Filename': os.path.basename(filepath),
+                'File type': 'Conventional base calls', 'Encoding': 'Sanger / Illumina 1.9',
+                'Total Sequences': self.reads, 'Sequence length': length_str,
+                '%GC': round(100 * self.gc / max(self.bases, 1)),
+                'avg_sequence_length': self.bases / max(self.reads, 1), **self.get_flags(),
+                'n_rate': self.n / max(self.bases, 1)}
+
+
+def _read_batches(filepath: str, batch_size: int):
+    """ Yields (sequences, qualities) of batches of reads, reading the file in large blocks. """
+    raw = gzip.open(filepath, 'rb') if filepath.endswith('.gz') else open(filepath, 'rb')
+    with io.BufferedReader(raw, buffer_size=_READ_BUFFER) as f:
+        while True:
+            lines = list(islice(f, batch_size * 4))
+            if not lines:
+                return
+            if len(lines) % 4 or any(line[:1] != b'@' for line in lines[::4]):
+                raise PipelineException(f'Error: {filepath} is not a FASTQ with 4 line records.')
+            yield [line.rstrip() for line in lines[1::4]], [line.rstrip() for line in lines[3::4]]
+
+
+def scan_fastq(filepath: str, max_reads=None, sample='first', seed=0, batch_size=100000) -> tuple:
+    """
+    Read statistics of a FASTQ (can be gzipped), returns (summary row, FastqStats).
+
+    max_reads: only use this many reads, sample is either first (the first max_reads reads, fast) or reservoir (a
+               uniform random sample of max_reads reads over the whole file, the whole file is read but only the
+               sample's statistics are computed). Total Sequences is the number of reads read, i.e. the whole file
+               for reservoir sampling, sampled_sequences the number the statistics are from.
+    """
+    if sample not in ['first', 'reservoir']:
+        raise PipelineException(f'Error: sample must be first or reservoir, got: {sample}')
+    stats = FastqStats()
+    total = 0
+    if max_reads is None or sample == 'first':
+        for seqs, quals in _read_batches(filepath, batch_size if max_reads is None else min(batch_size, max_reads)):
+            if max_reads is not None:
+                seqs, quals = seqs[:max_reads - stats.reads], quals[:max_reads - stats.reads]
+            stats.add(seqs, quals)
+            total = stats.reads
+            if max_reads is not None and stats.reads >= max_reads:
+                break
+    else:
+        # Algorithm R, the random index of each read in the batch is drawn at once and only reads which land in the
+        # reservoir are touched in python
+        rng = np.random.default_rng(seed)
+        reservoir_seqs, reservoir_quals = [], []
+        for seqs, quals in _read_batches(filepath, batch_size):
+            fill = min(max_reads - len(reservoir_seqs), len(seqs))
+            reservoir_seqs += seqs[:fill]
+            reservoir_quals += quals[:fill]
+            indices = rng.integers(0, np.arange(total + fill, total + len(seqs)) + 1)
+            for i in np.nonzero(indices < max_reads)[0]:
+                reservoir_seqs[indices[i]], reservoir_quals[indices[i]] = seqs[fill + i], quals[fill + i]
+            total += len(seqs)
+        if reservoir_seqs:
+            stats.add(reservoir_seqs, reservoir_quals)
+    summary = stats.get_summary(filepath)
+    summary['sampled_sequences'], summary['Total Sequences'] = stats.reads, total
+    return summary, stats
+
+
+def scan_fastqs(file_paths: list, output_filename=None, nprocesses=None, max_reads=None, sample='first',
+                seed=0) -> tuple:
+    """
+    Scans the FASTQs in parallel (a process per file), returns the MultiQC style summary (one row per file) and a
+    dict from file to its FastqStats. The summary is written (tab separated) to output_filename if given e.g. as
+    multiqc_fastqc.txt for Cutadapt.get_qc_files.
+    """
+    scan = partial(scan_fastq, max_reads=max_reads, sample=sample, seed=seed)
+    if nprocesses == 1 or len(file_paths) < 2:
+        results = [scan(f) for f in file_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=nprocesses) as pool:
+            results = list(pool.map(scan, file_paths))
+    summary_df = pd.DataFrame([summary for summary, _ in results], columns=MULTIQC_COLUMNS)
+    if output_filename:
+        summary_df.to_csv(output_filename, sep='\t', index=False)
+    return summary_df, {f: stats for f, (_, stats) in zip(file_paths, results)}
 
 
 class FastQC(BasePipeline):
 
+    # FastQC allocates 250M per thread
+    thread_flags = ('-t', '--threads')
+    mem_per_job = '250M'
+
     def __init__(self, data_dir: str, program_location: str, output_dir: str, file_ending='fq', name='FASTQC',
                  dryrun=False, nthreads=None):
         super().__init__(data_dir, program_location, output_dir=output_dir, file_ending=file_ending, name=name,
@@ -29,3 +229,24 @@ class FastQC(BasePipeline):
 
     def generate_cmd(self, filepath):
         return f'{self.program_location} -o {self.output_dir} {filepath}'
+
+    def get_output_files(self, filepath) -> list:
+        # FastQC names its reports after the input file with the compression and file type extensions removed
+        filename = get_sample_name(filepath)
+        return [os.path.join(self.output_dir, f'{filename}_fastqc.html'),
+                os.path.join(self.output_dir, f'{filename}_fastqc.zip')]
+
+    def run_native(self, file_paths: list, output_filename=None, nprocesses=None, max_reads=None,
+                   sample='first') -> pd.DataFrame:
+        """
+        Quick QC with the built in read statistics (see scan_fastqs) instead of FastQC, the table is written to
+        output_filename (defaults to multiqc_fastqc.txt in the output directory).
+        """
+        output_filename = output_filename or os.path.join(self.output_dir, 'multiqc_fastqc.txt')
+        os.makedirs(os.path.dirname(output_filename) or '.', exist_ok=True)
+        summary_df, _ = scan_fastqs(file_paths, output_filename, nprocesses or self.nthreads, max_reads, sample)
+        if self.logfile and not self.logfile.closed:
+            self.logfile.write(f'# native qc of {len(file_paths)} files: {output_filename}\n')
+        if self.verbose:
+            self.u.dp(['Read statistics: \n', summary_df[MULTIQC_COLUMNS[:8]].to_string(index=False)])
+        return summary_df
@@ -14,13 +14,137 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
 #                                                                             #
 ###############################################################################
+""" Documentation at: https://pubmed.ncbi.nlm.nih.gov/24227677/ """
 
-from scirnap import BasePipeline
+import os
+
+import numpy as np
+import pandas as pd
+
+from scirnap import BasePipeline, PipelineException
+from scirnap.annotation import GTFIndex
+
+ANNOTATION_COLUMNS = ['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length']
+# Columns of a SAF annotation (-F SAF), featureCounts' simple alternative to a GTF
+SAF_COLUMNS = ['GeneID', 'Chr', 'Start', 'End', 'Strand']
+
+
+class CountMatrix:
+    """ Genes x samples int32 counts (dense numpy array or scipy sparse CSR matrix) from a featureCounts table. """
+
+    def __init__(self, counts, genes, samples, annotation_df: pd.DataFrame):
+        self.counts, self.genes, self.samples = counts, np.asarray(genes), np.asarray(samples)
+        self.annotation_df = annotation_df
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    @property
+    def is_sparse(self):
+        return not isinstance(self.counts, np.ndarray)
+
+    def to_df(self) -> pd.DataFrame:
+        counts = self.counts.toarray() if self.is_sparse else self.counts
+        return pd.DataFrame(counts, index=pd.Index(self.genes, name='Geneid'), columns=self.samples)
+
+
+def _get_cache_paths(counts_path: str) -> tuple:
+    """ (dense counts .npy, sparse counts .npz, genes/samples/annotation .npz) cached next to the featureCounts table. """
+    return f'{counts_path}.counts.npy', f'{counts_path}.counts.npz', f'{counts_path}.index.npz'
+
+
+def _get_sparse():
+    try:
+        import scipy.sparse
+    except ImportError:
+        raise PipelineException('Error: scipy is needed for sparse count matrices, please pip install scipy.')
+    return scipy.sparse
+
+
+def _load_cached_counts(counts_path: str, sparse: bool):
+    dense_path, sparse_path, index_path = _get_cache_paths(counts_path)
+    counts_cache = sparse_path if sparse else dense_path
+    if not os.path.exists(index_path) or not os.path.exists(counts_cache):
+        return None
+    stat = os.stat(counts_path)
+    with np.load(index_path, allow_pickle=False) as index:
+        if index['source_size'] != stat.st_size or index['source_mtime_ns'] != stat.st_mtime_ns:
+            return None  # The table has been re-written since it was cached
+        annotation_df = pd.DataFrame({col: index[col] for col in ANNOTATION_COLUMNS[1:]},
+                                     index=pd.Index(index['genes'], name='Geneid'))
+        genes, samples = index['genes'], index['samples']
+    counts = _get_sparse().load_npz(sparse_path) if sparse else np.load(dense_path, mmap_mode='r')
+    return CountMatrix(counts, genes, samples, annotation_df)
+
+
+def _save_cached_counts(counts_path: str, matrix: CountMatrix):
+    dense_path, sparse_path, index_path = _get_cache_paths(counts_path)
+    stat = os.stat(counts_path)
+    if matrix.is_sparse:
+        _get_sparse().save_npz(sparse_path, matrix.counts)
+    else:
+        np.save(dense_path, matrix.counts)
+    annotation = {col: np.asarray(matrix.annotation_df[col], dtype=str if col != 'Length' else np.int64)
+                  for col in ANNOTATION_COLUMNS[1:]}
+    np.savez(index_path, genes=np.asarray(matrix.genes, dtype=str), samples=np.asarray(matrix.samples, dtype=str),
+             source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns, **annotation)
+
+
+def load_counts(counts_path: str, sparse=False, cache=False, chunksize=10000) -> CountMatrix:
+    """
+    Loads a featureCounts output table as a CountMatrix. The table is read in chunks of rows with explicit dtypes
+    (int32 counts) and the annotation columns (Chr, Start, End, Strand, Length) are kept separate from the counts.
+
+    sparse: return the counts as a scipy.sparse CSR matrix (built chunk by chunk so the dense table is never in memory).
+    cache: save the parsed matrix next to the table (.counts.npy, memory mapped on the next load, or .counts.npz if
+           sparse) and load from there while the table hasn't changed.
+    """
+    if cache:
+        matrix = _load_cached_counts(counts_path, sparse)
+        if matrix is not None:
+            return matrix
+    # featureCounts writes the command it was run with as a comment line before the header
+    skiprows, header = 0, []
+    with open(counts_path, 'r') as f:
+        for line in f:
+            if not line.startswith('#'):
+                header = line.rstrip('\n').split('\t')
+                break
+            skiprows += 1
+    if header[:len(ANNOTATION_COLUMNS)] != ANNOTATION_COLUMNS:
+        raise PipelineException(f'Error: {counts_path} does not look like a featureCounts table, the header starts '
+                                f'with: {header[:len(ANNOTATION_COLUMNS)]}')
+    samples = header[len(ANNOTATION_COLUMNS):]
+    dtypes = {col: str for col in ANNOTATION_COLUMNS}
+    dtypes['Length'] = np.int64
+    dtypes.update({sample: np.int32 for sample in samples})
+    reader = pd.read_csv(counts_path, sep='\t', skiprows=skiprows, header=0, names=header, dtype=dtypes,
+                         chunksize=chunksize, engine='c')
+    annotation_chunks, count_chunks = [], []
+    sp = _get_sparse() if sparse else None
+    for chunk_df in reader:
+        annotation_chunks.append(chunk_df[ANNOTATION_COLUMNS])
+        counts = chunk_df[samples].to_numpy(dtype=np.int32)
+        count_chunks.append(sp.csr_matrix(counts) if sparse else counts)
+    annotation_df = pd.concat(annotation_chunks) if annotation_chunks else pd.DataFrame(columns=ANNOTATION_COLUMNS)
+    annotation_df = annotation_df.set_index('Geneid')
+    if sparse:
+        counts = sp.vstack(count_chunks, format='csr') if count_chunks else sp.csr_matrix((0, len(samples)),
+                                                                                          dtype=np.int32)
+    else:
+        counts = np.concatenate(count_chunks) if count_chunks else np.zeros((0, len(samples)), dtype=np.int32)
+    matrix = CountMatrix(counts, annotation_df.index.values, samples, annotation_df)
+    if cache:
+        _save_cached_counts(counts_path, matrix)
+    return matrix
 
-""" Documentation at: https://pubmed.ncbi.nlm.nih.gov/24227677/ """
 
 class FeatureCounts(BasePipeline):
 
+    thread_flags = ('-T',)
+    mem_per_job = '2G'
+
     def __init__(self, data_dir: str, program_location: str, param_str: str, output_dir: str, gtf_filepath: str,
                  file_ending='.bam', name='FEATURECOUNTS',  dryrun=False, nthreads=None):
         super().__init__(data_dir, program_location, file_ending=file_ending, name=name, dryrun=dryrun,
@@ -32,5 +156,95 @@ class FeatureCounts(BasePipeline):
         self.add_params_to_logfile()
 
     def generate_cmd(self, file_paths):
-        return f'{self.program_location} {self.param_str} -a {self.gtf_filepath} -o {self._gen_fname_str(file_paths[0])}.txt' \
+        return f'{self.program_location} {self.param_str} -a {self.gtf_filepath} -o {self.get_output_files(file_paths)[0]}' \
                f' {" ".join(file_paths)}'
+
+    def get_output_files(self, file_paths) -> list:
+        return [f'{self._gen_fname_str(file_paths[0])}.txt']
+
+    def get_annotation(self) -> GTFIndex:
+        """ Parsed (and cached) index of the GTF, see scirnap.annotation. """
+        return GTFIndex.load(self.gtf_filepath)
+
+    def is_saf(self) -> bool:
+        """ True if the annotation is a SAF file rather than a GTF (-F SAF in the param str). """
+        return (self._get_param_value('-F') or 'GTF').upper() == 'SAF'
+
+    def validate_saf(self) -> bool:
+        """ Checks the SAF has the GeneID, Chr, Start, End and Strand columns, with integer starts and ends. """
+        saf_df = pd.read_csv(self.gtf_filepath, sep='\t', dtype=str)
+        missing = [c for c in SAF_COLUMNS if c not in saf_df.columns]
+        if missing:
+            self.u.err_p([f'Error: the SAF {self.gtf_filepath} has no {", ".join(missing)} column(s), its header '
+                          f'has to be: {" ".join(SAF_COLUMNS)}.'])
+            return False
+        positions = saf_df[['Start', 'End']].apply(pd.to_numeric, errors='coerce')
+        if positions.isna().any().any():
+            self.u.err_p([f'Error: the SAF {self.gtf_filepath} has Start or End values which are not integers.'])
+            return False
+        return True
+
+    def validate_annotation(self) -> bool:
+        """
+        Checks the GTF has the feature type (-t, exon by default) that featureCounts is asked to count, or for a SAF
+        annotation that it has the SAF columns.
+        """
+        if self.is_saf():
+            return self.validate_saf()
+        feature = self._get_param_value('-t') or 'exon'
+        if not self.get_annotation().has_feature(feature):
+            self.u.err_p([f'Error: the GTF {self.gtf_filepath} has no {feature} features (the -t in your param str), '
+                          f'featureCounts would assign no reads.'])
+            return False
+        return True
+
+    def validate_inputs(self) -> bool:
+        return self.validate_annotation()
+
+    def load_counts(self, file_paths, sparse=False, cache=True) -> CountMatrix:
+        """ Loads the table written by featureCounts for file_paths, see load_counts. """
+        return load_counts(self.get_output_files(file_paths)[0], sparse=sparse, cache=cache)
+
+    def run_sharded(self, file_paths, nshards: int, output_path=None, scheduler=None,
+                    check_annotation=True) -> CountMatrix:
+        """
+        Splits the BAMs into nshards groups, runs featureCounts on each group in parallel (through the scheduler, so
+        within the CPU budget) and merges the per shard tables column-wise into one count matrix. A failed shard is
+        reported and left out of the merge rather than failing every sample.
+
+        output_path: where the merged table is written (defaults to <output_dir>/<name>_merged.txt).
+        check_annotation: check the row order of every shard matches the gene order of the GTF (when counting by
+                          gene_id, not for a SAF), otherwise only that the shards match each other.
+        """
+        nshards = max(min(nshards, len(file_paths)), 1)
+        # Contiguous shards so the merged columns keep the order of file_paths
+        shards = [list(shard) for shard in np.array_split(np.array(file_paths, dtype=object), nshards)]
+        jobs = self.run_per_file(shards, scheduler=scheduler)
+        if self.dryrun:
+            return None
+        matrices = []
+        for shard, job in zip(shards, jobs):
+            if job.status != 'done':
+                self.u.warn_p([f'Warning: featureCounts failed on the shard starting with {shard[0]}, its {len(shard)} '
+                               f'samples are left out of the merged matrix:\n{job.error}'])
+                continue
+            matrices.append(self.load_counts(shard, cache=False))
+        if not matrices:
+            raise PipelineException('Error: featureCounts failed on every shard.')
+        genes = matrices[0].genes
+        for matrix in matrices[1:]:
+            if not np.array_equal(matrix.genes, genes):
+                raise PipelineException('Error: the shards have different genes or gene order, they can not be merged.')
+        if check_annotation and not self.is_saf() and (self._get_param_value('-g') or 'gene_id') == 'gene_id':
+            expected = self.get_annotation().get_gene_order(self._get_param_value('-t') or 'exon')
+            if not np.array_equal(genes, expected):
+                raise PipelineException(f'Error: the rows of the featureCounts tables do not match the gene order of '
+                                        f'{self.gtf_filepath}.')
+        merged = CountMatrix(np.concatenate([matrix.counts for matrix in matrices], axis=1), genes,
+                             np.concatenate([matrix.samples for matrix in matrices]), matrices[0].annotation_df)
+        output_path = output_path or os.path.join(self.output_dir, f'{self.name}_merged.txt')
+        merged_df = pd.concat([merged.annotation_df, merged.to_df()], axis=1)
+        merged_df.to_csv(output_path, sep='\t', index_label='Geneid')
+        if self.verbose:
+            self.u.dp([f'Merged {len(matrices)} featureCounts shards ({merged.shape[1]} samples) into: {output_path}'])
+        return merged
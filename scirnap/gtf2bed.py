@@ -14,23 +14,211 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
 #                                                                             #
 ###############################################################################
+"""
+Native GTF to BED12 conversion, output compatible with gffutils' FeatureDB.bed12(transcript, name_field='transcript_id')
+but streamed in a single pass without building a database first.
 
-from scirnap import BasePipeline
+Transcripts are collected per chromosome and written out once the file moves on to the next chromosome, so memory is
+bounded by the largest chromosome. The GTF must therefore have each chromosome in one contiguous block (as GENCODE,
+Ensembl and StringTie GTFs do). Uncompressed GTFs can also be converted with a process pool, one chromosome per task.
+"""
+
+import argparse
+import gzip
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from scirnap import BasePipeline, PipelineException, __version__
+from scirnap.annotation import GTFIndex
 
 # https://gffutils.readthedocs.io/en/latest/index.html
 # https://gffutils.readthedocs.io/en/latest/gtf2bed.html?highlight=gtf2bed
 # version: GFFUtils-0.11.0
 
+_TRANSCRIPT_ID = re.compile(r'transcript_id "([^"]*)"')
+
+
+def _open(gtf_path: str, mode='rt'):
+    return gzip.open(gtf_path, mode) if gtf_path.endswith('.gz') else open(gtf_path, mode)
+
+
+class _Transcript:
+
+    __slots__ = ['chrom', 'strand', 'score', 'start', 'end', 'min_start', 'max_end', 'exons', 'cds_start', 'cds_end']
+
+    def __init__(self, chrom, strand):
+        self.chrom, self.strand, self.score = chrom, strand, '.'
+        self.start = self.end = None  # From the transcript line if there is one
+        self.min_start, self.max_end = None, None  # Extent of all the features (how gffutils infers transcripts)
+        self.exons = []
+        self.cds_start, self.cds_end = None, None
+
+    def add(self, feature: str, start: int, end: int, score: str):
+        self.min_start = start if self.min_start is None else min(self.min_start, start)
+        self.max_end = end if self.max_end is None else max(self.max_end, end)
+        if feature == 'exon':
+            self.exons.append((start, end))
+        elif feature == 'CDS':
+            self.cds_start = start if self.cds_start is None else min(self.cds_start, start)
+            self.cds_end = end if self.cds_end is None else max(self.cds_end, end)
+        elif feature == 'transcript':
+            self.start, self.end, self.score = start, end, score
+
+    def to_bed12(self, name: str) -> str:
+        start = self.start if self.start is not None else self.min_start
+        end = self.end if self.end is not None else self.max_end
+        exons = sorted(self.exons) if self.exons else [(start, end)]
+        # The BED interval is the span of the blocks (gffutils raises an error if these differ from the transcript)
+        chrom_start, chrom_end = exons[0][0] - 1, exons[-1][1]
+        if self.cds_start is not None:
+            thick_start, thick_end = self.cds_start - 1, self.cds_end
+        else:
+            # gffutils doesn't convert thickStart to 0-based when there is no CDS, kept so the outputs match
+            thick_start, thick_end = start, end
+        block_sizes = ','.join(str(e - s + 1) for s, e in exons)
+        block_starts = ','.join(str(s - 1 - chrom_start) for s, e in exons)
+        score = '0' if self.score == '.' else self.score
+        return f'{self.chrom}\t{chrom_start}\t{chrom_end}\t{name}\t{score}\t{self.strand}\t{thick_start}\t' \
+               f'{thick_end}\t0,0,0\t{len(exons)}\t{block_sizes}\t{block_starts}\n'
+
+
+def _parse_lines(lines):
+    """ Yields (chrom, BED12 lines for the chromosome) for each contiguous chromosome block of GTF lines. """
+    transcripts, chrom, seen = {}, None, set()
+    for line in lines:
+        if line.startswith('#'):
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 9:
+            continue
+        match = _TRANSCRIPT_ID.search(fields[8])
+        if match is None:
+            continue  # e.g. gene lines
+        if fields[0] != chrom:
+            if transcripts:
+                yield chrom, ''.join(t.to_bed12(name) for name, t in transcripts.items())
+            if fields[0] in seen:
+                raise PipelineException(f'Error: {fields[0]} is not in one contiguous block in the GTF, please sort '
+                                        f'it by chromosome (e.g. sort -k1,1 -k4,4n) before converting.')
+            chrom = fields[0]
+            seen.add(chrom)
+            transcripts = {}
+        transcript_id = match.group(1)
+        transcript = transcripts.get(transcript_id)
+        if transcript is None:
+            transcript = transcripts[transcript_id] = _Transcript(chrom, fields[6])
+        transcript.add(fields[2], int(fields[3]), int(fields[4]), fields[5])
+    if transcripts:
+        yield chrom, ''.join(t.to_bed12(name) for name, t in transcripts.items())
+
+
+def get_chrom_blocks(gtf_path: str) -> list:
+    """ Byte ranges [(chrom, start, end)] of each contiguous chromosome block in an uncompressed GTF. """
+    blocks = []
+    offset = 0
+    with open(gtf_path, 'rb') as f:
+        for line in f:
+            if not line.startswith(b'#'):
+                chrom = line.split(b'\t', 1)[0]
+                if not blocks or blocks[-1][0] != chrom:
+                    if blocks:
+                        blocks[-1][2] = offset
+                    blocks.append([chrom, offset, None])
+            offset += len(line)
+    if blocks:
+        blocks[-1][2] = offset
+    return [(chrom.decode(), start, end) for chrom, start, end in blocks]
+
+
+def _convert_block(gtf_path: str, start: int, end: int) -> str:
+    with open(gtf_path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).decode().splitlines(keepends=True)
+    return ''.join(bed for chrom, bed in _parse_lines(lines))
+
+
+def gtf_to_bed12(gtf_path: str, output, nprocesses=None):
+    """
+    Converts a GTF (optionally gzipped) to BED12, one line per transcript named by the transcript_id.
+
+    output: path or file object to write the BED to.
+    nprocesses: if set, chromosomes are converted in parallel with a process pool (uncompressed GTFs only).
+    """
+    fout = open(output, 'w') if isinstance(output, str) else output
+    try:
+        if nprocesses and nprocesses > 1 and not gtf_path.endswith('.gz'):
+            blocks = get_chrom_blocks(gtf_path)
+            chroms = [chrom for chrom, start, end in blocks]
+            if len(set(chroms)) != len(chroms):
+                raise PipelineException(f'Error: chromosomes in {gtf_path} are not in contiguous blocks, please sort '
+                                        f'it by chromosome (e.g. sort -k1,1 -k4,4n) before converting.')
+            with ProcessPoolExecutor(max_workers=nprocesses) as pool:
+                # map keeps the chromosome order so the output is the same as the single process one
+                for bed in pool.map(_convert_block, [gtf_path] * len(blocks), [b[1] for b in blocks],
+                                    [b[2] for b in blocks]):
+                    fout.write(bed)
+        else:
+            with _open(gtf_path) as f:
+                for chrom, bed in _parse_lines(f):
+                    fout.write(bed)
+    finally:
+        if isinstance(output, str):
+            fout.close()
+
 
 class GTF2Bed(BasePipeline):
 
     def __init__(self, data_dir: str, program_location: str, output_dir: str,
-                 file_ending='.gtf', name='GTF2BED',  dryrun=False, nthreads=None):
+                 file_ending='.gtf', name='GTF2BED',  dryrun=False, nthreads=None, native=False, nprocesses=None):
+        """
+        native: use scirnap's built in converter (gtf_to_bed12, run in its own python process) instead of the program
+                at program_location, nprocesses is the number of processes it uses.
+        """
+        if native:
+            # Not python -m scirnap.gtf2bed since the package __init__ has already imported this module
+            program_location = f'{sys.executable} -c "import sys; from scirnap.gtf2bed import main; main(sys.argv[1:])"'
+            if nprocesses:
+                program_location += f' --processes {nprocesses}'
         super().__init__(data_dir, program_location, file_ending=file_ending, name=name, dryrun=dryrun,
                          nthreads=nthreads)
         self.output_dir = output_dir
-        self.params = {}
+        self.native, self.nprocesses = native, nprocesses
+        self.cpus_per_job = nprocesses if native and nprocesses else None
+        self.params = {'Native': native, 'Processes': nprocesses}
         self.add_params_to_logfile()
 
     def generate_cmd(self, file_path):
-        return f'{self.program_location} {file_path} > {self._gen_fname_str(file_path)[:-4]}.bed'
+        return f'{self.program_location} {file_path} > {self.get_output_files(file_path)[0]}'
+
+    def get_output_files(self, file_path) -> list:
+        return [f'{self._gen_fname_str(file_path)[:-4]}.bed']
+
+    def validate_output(self, file_path) -> bool:
+        """ Checks the BED made from the GTF at file_path has one line for every transcript in the GTF. """
+        with open(self.get_output_files(file_path)[0], 'r') as f:
+            n_lines = sum(1 for line in f if line.strip())
+        n_transcripts = len(GTFIndex.load(file_path).transcript_ids)
+        if n_lines != n_transcripts:
+            self.u.err_p([f'Error: {n_lines} BED lines but {n_transcripts} transcripts in {file_path}.'])
+            return False
+        return True
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Convert a GTF to BED12 (one line per transcript).')
+    parser.add_argument('gtf', nargs='?', help='GTF file (can be gzipped).')
+    parser.add_argument('output', nargs='?', default=None, help='Output BED file (default: stdout).')
+    parser.add_argument('--processes', type=int, default=None, help='Number of processes (uncompressed GTFs only).')
+    parser.add_argument('--version', action='store_true', help='Print the version.')
+    args = parser.parse_args(args)
+    if args.version:
+        print(f'scirnap gtf2bed v{__version__}')
+        return
+    if not args.gtf:
+        parser.error('the gtf file is required')
+    gtf_to_bed12(args.gtf, args.output or sys.stdout, args.processes)
+
+
+if __name__ == "__main__":
+    main()
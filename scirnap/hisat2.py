@@ -14,72 +14,245 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
 #                                                                             #
 ###############################################################################
+""" 
+Documentation: https://ccb.jhu.edu/software/hisat2/manual.shtml 
+             : http://www.htslib.org/doc/samtools-view.html 
+"""
+
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from scirnap import BasePipeline
+import re
+
+from scirnap import BasePipeline, PipelineException
+from scirnap.scheduler import parse_mem
 
 import os
+import pandas as pd
 
 
-""" 
-Documentation: https://ccb.jhu.edu/software/hisat2/manual.shtml 
-             : http://www.htslib.org/doc/samtools-view.html 
-"""
+# Lines of the HISAT2 summary (both the default and the --new-summary format) and the stat they hold. {} is aligned for
+# single end reads and mates for the mates of pairs which didn't align as a pair.
+_SUMMARY_PATTERNS = [(re.compile(pattern), stat) for pattern, stat in [
+    (r'(\d+) reads; of these:', 'total_reads'),
+    (r'(\d+) \(\S+\) were paired; of these:', 'paired'),
+    (r'(\d+) \(\S+\) were unpaired; of these:', 'unpaired'),
+    (r'(\d+) \(\S+\) aligned concordantly 0 times', 'concordant_0'),
+    (r'(\d+) \(\S+\) aligned concordantly exactly 1 time', 'concordant_1'),
+    (r'(\d+) \(\S+\) aligned concordantly >1 times', 'concordant_multi'),
+    (r'(\d+) \(\S+\) aligned discordantly 1 time', 'discordant_1'),
+    (r'(\d+) pairs aligned 0 times concordantly or discordantly', 'pairs_0'),
+    (r'(\d+) mates make up the pairs; of these:', 'mates'),
+    (r'(\d+) \(\S+\) aligned 0 times', '{}_0'),
+    (r'(\d+) \(\S+\) aligned exactly 1 time', '{}_1'),
+    (r'(\d+) \(\S+\) aligned >1 times', '{}_multi'),
+    (r'([\d.]+)% overall alignment rate', 'overall_rate'),
+    (r'Total reads: (\d+)', 'total_reads'),
+    (r'Total pairs: (\d+)', 'paired'),
+    (r'Total unpaired reads: (\d+)', 'mates'),
+    (r'Aligned concordantly or discordantly 0 time: (\d+)', 'pairs_0'),
+    (r'Aligned concordantly 1 time: (\d+)', 'concordant_1'),
+    (r'Aligned concordantly >1 times: (\d+)', 'concordant_multi'),
+    (r'Aligned discordantly 1 time: (\d+)', 'discordant_1'),
+    (r'Aligned 0 time: (\d+)', '{}_0'),
+    (r'Aligned 1 time: (\d+)', '{}_1'),
+    (r'Aligned >1 times: (\d+)', '{}_multi'),
+    (r'Overall alignment rate: ([\d.]+)%', 'overall_rate'),
+]]
+
+# unique/multi/unaligned are the reads for single end data and the pairs (concordant, unaligned as a pair) for paired
+SUMMARY_COLUMNS = ['file', 'paired', 'total_reads', 'unique', 'multi', 'unaligned', 'overall_rate',
+                   'aligned_0', 'aligned_1', 'aligned_multi', 'concordant_0', 'concordant_1', 'concordant_multi',
+                   'discordant_1', 'pairs_0', 'mates', 'mates_0', 'mates_1', 'mates_multi']
+
+
+def parse_summary(summary_path: str) -> dict:
+    """ Parses one HISAT2 alignment summary file into a dict of SUMMARY_COLUMNS (None for stats it doesn't have). """
+    stats = dict.fromkeys(SUMMARY_COLUMNS)
+    stats['file'] = summary_path
+    with open(summary_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            for pattern, stat in _SUMMARY_PATTERNS:
+                match = pattern.match(line)
+                if match:
+                    stat = stat.format('aligned' if stats['mates'] is None else 'mates')
+                    stats[stat] = float(match.group(1)) if stat == 'overall_rate' else int(match.group(1))
+                    break
+    paired = bool(stats['paired'])
+    if paired and stats['total_reads'] is None:
+        stats['total_reads'] = stats['paired']  # --new-summary only gives the number of pairs
+    stats['paired'] = paired
+    prefix = 'concordant' if paired else 'aligned'
+    stats['unique'], stats['multi'] = stats[f'{prefix}_1'], stats[f'{prefix}_multi']
+    stats['unaligned'] = stats['pairs_0'] if paired else stats['aligned_0']
+    return stats
+
+
+def summarise_summary_files(summary_paths: list, output_filename=None, nthreads=None) -> pd.DataFrame:
+    """
+    Parses HISAT2 summary files concurrently into a typed table (one row per file) and optionally writes it as a TSV
+    or, if output_filename ends with .parquet, as parquet.
+    """
+    with ThreadPoolExecutor(max_workers=nthreads or min(32, len(summary_paths) or 1)) as pool:
+        rows = list(pool.map(parse_summary, summary_paths))
+    summary_df = pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+    summary_df = summary_df.astype({col: 'Int64' for col in SUMMARY_COLUMNS[7:] + ['total_reads', 'unique', 'multi',
+                                                                                  'unaligned']})
+    summary_df = summary_df.astype({'paired': bool, 'overall_rate': float})
+    if output_filename:
+        if output_filename.endswith('.parquet'):
+            summary_df.to_parquet(output_filename, index=False)  # Needs pyarrow or fastparquet
+        else:
+            summary_df.to_csv(output_filename, sep='\t', index=False)
+    return summary_df
 
 
 class Hisat2(BasePipeline):
 
+    # hisat2 -p threads plus the samtools view and samtools sort threads it is piped into, the memory is mainly
+    # the genome index (~4.5G for GRCh38) plus sort_mem for each samtools sort thread
+    thread_flags = ('-p', '--threads')
+    mem_per_job = '5.25G'
+    default_sort_mem = '768M'  # samtools sort's default -m
+
     def __init__(self, data_dir: str, program_location: str, param_str: str, output_dir: str, annotation_idx_dir: str,
-                 s_or_p: str, file_ending='.fq.gz', name='HISAT2', dryrun=False, nthreads=None):
+                 s_or_p: str, file_ending='.fq.gz', name='HISAT2', dryrun=False, nthreads=None,
+                 mate_pattern=None, sort_threads=1, view_threads=1, sort_mem=None, tmp_dir=None, skip_view=False,
+                 cpus_per_job=None):
+        """
+        sort_threads, view_threads: threads (-@) of samtools sort and samtools view.
+        sort_mem: memory per samtools sort thread (-m e.g. 2G), more memory means fewer temp files to merge.
+        tmp_dir: directory samtools sort writes its temp files to (-T) e.g. node local NVMe, rather than the cwd.
+        skip_view: pipe the SAM from hisat2 straight into samtools sort, skipping the BAM compression in between.
+        cpus_per_job: CPU slots given to each job, split between hisat2, view and sort (see set_job_cpus).
+        """
         super().__init__(data_dir, program_location, file_ending=file_ending, name=name, dryrun=dryrun,
                          nthreads=nthreads)
-        if s_or_p not in ['s' or 'p']:
+        self.sort_threads, self.view_threads, self.sort_mem = sort_threads, view_threads, sort_mem
+        self.tmp_dir, self.skip_view = tmp_dir, skip_view
+        self.cpus_per_job = cpus_per_job
+        self._check_job_cpus()
+        if s_or_p not in ['s', 'p']:
             self.u.err_p([f'Error: passed an invalid parameter for s_or_p: {s_or_p}.\n'
                           f'Please use "s" or "p" (s=single ended reads, p=paired ended reads in separate files.)'])
             return
         self.s_or_p = s_or_p
+        # Paired end jobs are given a (R1, R2) tuple, see BasePipeline.pair_files
+        self.paired = s_or_p == 'p'
+        self.mate_pattern = mate_pattern or self.mate_pattern
         self.param_str = param_str
         self.output_dir = output_dir
         self.annotation_idx_dir = annotation_idx_dir
         self.params = {'Param str': self.param_str, 'Single or paired': s_or_p, 'Output dir': output_dir,
-                       'Annotation index': annotation_idx_dir}
+                       'Annotation index': annotation_idx_dir, 'Sort threads': sort_threads,
+                       'View threads': view_threads, 'Sort memory': sort_mem, 'Temp dir': tmp_dir,
+                       'Skip view': skip_view, 'CPUs per job': cpus_per_job}
         self.add_params_to_logfile()
 
+    def set_job_cpus(self, cpus=None, scheduler=None, jobs_at_once=1):
+        """
+        Sets the CPU slots of each job, either cpus or an even share of the CPU budget (the scheduler's, or nthreads
+        without one) between jobs_at_once jobs, see get_thread_split.
+        """
+        if cpus is None:
+            max_cpus = scheduler.max_cpus if scheduler else self.nthreads or 1
+            cpus = max(1, max_cpus // jobs_at_once)
+        self.cpus_per_job = cpus
+        self._check_job_cpus()
+
+    def _check_job_cpus(self):
+        stages = 2 if self.skip_view else 3
+        if self.cpus_per_job is not None and self.cpus_per_job < stages:
+            self.u.warn_p([f'Warning: {self.cpus_per_job} CPUs per job is fewer than the {stages} processes of the '
+                           f'hisat2 | samtools pipe, samtools shares the CPUs of hisat2 rather than getting its own.'])
+
+    def get_thread_split(self) -> tuple:
+        """
+        (hisat2, samtools view, samtools sort) threads of a job. When cpus_per_job is set the job's CPUs are split
+        between the pipe: a quarter to sort, one to view (unless skipped) and the rest to hisat2 (at least one each),
+        with fewer CPUs than processes view and then sort get none (they share the CPUs), so the split never adds up to
+        more than cpus_per_job. Otherwise hisat2 uses -p from the param string and view/sort use
+        view_threads/sort_threads.
+        """
+        if self.cpus_per_job is None:
+            return self._get_threads_in_params(), 0 if self.skip_view else self.view_threads, self.sort_threads
+        cpus = max(1, self.cpus_per_job)
+        view = 0 if self.skip_view else 1
+        sort = max(1, cpus // 4)
+        if 1 + view + sort > cpus:
+            view, sort = 0, min(sort, cpus - 1)
+        return cpus - view - sort, view, sort
+
+    def get_job_resources(self, cmd=None) -> tuple:
+        hisat2, view, sort = self.get_thread_split()
+        cpus = self.cpus_per_job if self.cpus_per_job is not None else hisat2 + view + sort
+        # samtools sort always has one thread's worth of memory, even with no CPU of its own
+        return cpus, parse_mem(self.mem_per_job) + parse_mem(self.sort_mem or self.default_sort_mem) * max(sort, 1)
+
+    def _gen_align_str(self):
+        # With cpus_per_job (e.g. from set_job_cpus) the hisat2 threads replace any -p in the param str, otherwise -p
+        # is left to the param str
+        if self.cpus_per_job is None:
+            return f'{self.program_location} {self.param_str}'
+        param_str = self._strip_params(self.thread_flags)
+        return ' '.join(filter(None, [self.program_location, param_str, f'-p {self.get_thread_split()[0]}']))
+
+    def _gen_sort_str(self, file_out):
+        """ samtools view (unless skipped) & sort that the SAM output of hisat2 is piped into. """
+        _, view, sort = self.get_thread_split()
+        view_str = '' if self.skip_view else 'samtools view -bS' + (f' -@ {view}' if view > 1 else '') + ' | '
+        sort_str = 'samtools sort' + (f' -@ {sort}' if sort > 1 else '')
+        if self.sort_mem:
+            sort_str += f' -m {self.sort_mem}'
+        mkdir_str = ''
+        if self.tmp_dir:
+            sort_str += f' -T {os.path.join(self.tmp_dir, self._get_filename(file_out))}'
+            mkdir_str = f'mkdir -p {self.tmp_dir} && '  # The temp dir may be local to the node the job runs on
+        return mkdir_str, f'{view_str}{sort_str} -o {file_out}.sorted.bam'
+
     def generate_se_cmd(self, filepath):
         file_out = self._gen_fname_str(filepath)
+        mkdir_str, sort_str = self._gen_sort_str(file_out)
         # Run hisat2 > pipe results to SAMTOOLS to compress to bam > sort the bam
-        return f'{self.program_location} {self.param_str} --summary-file {file_out}_summary.txt ' \
+        return f'{mkdir_str}{self._gen_align_str()} --summary-file {file_out}_summary.txt ' \
                f'-x {self.annotation_idx_dir} -U {filepath} | ' \
-               f'samtools view -bS | ' \
-               f'samtools sort -o ' \
-               f'{file_out}.sorted.bam'
+               f'{sort_str}'
 
-    def generate_pe_cmd(self, filepath):
-        """ """
-        self.u.err_p([f'Error: paired end implementation not yet implemented.'])
-        return
+    def get_output_files(self, filepath) -> list:
+        return [f'{self._gen_out_str(filepath)}.sorted.bam']
+
+    def _gen_out_str(self, filepath):
+        # Pairs are named after R1 without the mate e.g. s1_R1.fq.gz & s1_R2.fq.gz -> HISAT2_s1.fq.gz.sorted.bam
+        if isinstance(filepath, (list, tuple)):
+            return self._gen_fname_str(self.get_pair_name(filepath))
+        return self._gen_fname_str(filepath)
+
+    def generate_pe_cmd(self, file_pair):
+        """ Aligns both mates of a pair together (-1 R1 -2 R2) into one sorted BAM. """
+        if not isinstance(file_pair, (list, tuple)) or len(file_pair) != 2:
+            raise PipelineException(f'Error: paired end mode needs a pair of files (R1, R2), got: {file_pair}. '
+                                    f'Use pair_files to pair them.')
+        r1, r2 = file_pair
+        file_out = self._gen_out_str(file_pair)
+        mkdir_str, sort_str = self._gen_sort_str(file_out)
+        return f'{mkdir_str}{self._gen_align_str()} --summary-file {file_out}_summary.txt ' \
+               f'-x {self.annotation_idx_dir} -1 {r1} -2 {r2} | ' \
+               f'{sort_str}'
 
     def generate_cmd(self, filepath):
         """ """
         if self.s_or_p == 's':
             return self.generate_se_cmd(filepath)
+        return self.generate_pe_cmd(filepath)
 
-    def summarise_results(self, output_filename: str):
-        """ """
-        files = os.listdir(self.output_dir)
-        with open(output_filename, 'a+') as fout:
-            for filename in files:
-                if 'summary' in filename:
-                    # Read in the file
-                    with open(os.path.join(self.output_dir, filename), 'r+') as summary:
-                        line_cnt = 0
-                        end = 5
-                        for line in summary:
-                            if line_cnt == end:
-                                try:
-                                    line_str = filename + "\t" + line.split(' ')[0][:-1]
-                                    if self.verbose:
-                                        print(line_str)
-                                    fout.write(line_str)
-                                except:
-                                    end = 14
-                            line_cnt += 1
\ No newline at end of file
+    def summarise_results(self, output_filename=None, nthreads=None) -> pd.DataFrame:
+        """
+        Parses every HISAT2 summary file (*_summary.txt) in the output directory into one table, see
+        summarise_summary_files.
+        """
+        files = [os.path.join(self.output_dir, f) for f in sorted(os.listdir(self.output_dir))
+                 if f.endswith('_summary.txt')]
+        summary_df = summarise_summary_files(files, output_filename, nthreads or self.nthreads)
+        if self.verbose:
+            self.u.dp(['Alignment summary: \n', summary_df[SUMMARY_COLUMNS[:7]].to_string(index=False)])
+        return summary_df
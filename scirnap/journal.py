@@ -0,0 +1,103 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Job journal.
+
+Every state change of every job (pending when it is queued, running for each attempt, then done or failed) is appended
+to a JSON lines file in the output directory as it happens, done and failed are synced to disk so the journal survives
+the driver being killed or the node rebooting. The last line for a job is its state. With resume a re-run skips the
+jobs the journal has as done (whose outputs are still there) and runs everything else, including the jobs that were
+running when the driver died.
+
+Unlike the run cache (scirnap.cache) a job is identified by its cmd alone, the input files aren't checked, so resuming
+also works after the inputs were touched or copied (e.g. staged onto a new node).
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+JOURNAL_FILENAME = '.scirnap_journal.jsonl'
+STATES = ['pending', 'running', 'done', 'failed']
+
+
+def get_job_key(cmd: str) -> str:
+    return hashlib.sha256(cmd.encode()).hexdigest()[:32]
+
+
+class JobJournal:
+
+    def __init__(self, journal_path: str):
+        """ journal_path: the JSON lines file of job states (read if it exists, appended to). """
+        self.journal_path = journal_path
+        self.states = {}
+        self._lock = threading.Lock()
+        self._torn = False
+        if os.path.exists(journal_path):
+            line = ''
+            with open(journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        self._update(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue  # A line cut short when the driver was killed
+            # The next record has to start on a new line if the last one was cut short
+            self._torn = bool(line) and not line.endswith('\n')
+
+    def _update(self, record: dict):
+        # Queuing a job again doesn't undo it having finished, only running it again does
+        previous = self.states.get(record['key'])
+        if record['state'] == 'pending' and previous and previous['state'] == 'done':
+            return
+        self.states[record['key']] = record
+
+    def record(self, cmd: str, state: str, name=None, attempt=0, error=None) -> dict:
+        record = {'key': get_job_key(cmd), 'job': name, 'state': state, 'attempt': attempt, 'time': time.time(),
+                  'cmd': cmd}
+        if error is not None:
+            record['error'] = str(error)[-2000:]
+        with self._lock:
+            self._update(record)
+            with open(self.journal_path, 'a+') as f:
+                f.write(('\n' if self._torn else '') + json.dumps(record) + '\n')
+                self._torn = False
+                if state in ('done', 'failed'):
+                    # Resume trusts done, so make sure it is on disk (survives a reboot, not only the driver dying)
+                    f.flush()
+                    os.fsync(f.fileno())
+        return record
+
+    def get_state(self, cmd: str):
+        """ Last state of the job (None if it isn't in the journal). """
+        record = self.states.get(get_job_key(cmd))
+        return record['state'] if record else None
+
+    def is_done(self, cmd: str, output_files=()) -> bool:
+        """ The job finished in an earlier run and its outputs are all still there. """
+        return self.get_state(cmd) == 'done' and all(os.path.exists(f) for f in output_files)
+
+    def to_df(self) -> pd.DataFrame:
+        """ Last state of every job in the journal. """
+        return pd.DataFrame(list(self.states.values()), columns=['job', 'state', 'attempt', 'time', 'cmd', 'error'])
+
+    def get_unfinished(self) -> list:
+        """ Records of the jobs which were queued or running (e.g. when the driver died) or failed. """
+        return [record for record in self.states.values() if record['state'] != 'done']
@@ -21,7 +21,8 @@ import sys
 from sciutil import SciUtil
 
 from scirnap import __version__
-from scirnap import Hisat2, FeatureCounts, FastQC, StringTie, Pool, Sort, Cutadapt
+from scirnap import Hisat2, FeatureCounts, FastQC, StringTie, Pool, Sort, Cutadapt, FastqChunk, TrimAlign
+from scirnap.workqueue import main as worker_main
 
 
 def print_help():
@@ -29,47 +30,96 @@ def print_help():
     print('\n'.join(lines))
 
 
-def run(args):
+def get_files(t, args):
+    # Options every pipeline has, set here since the constructors don't take them
+    t.resume, t.retries, t.retry_delay = args.resume, args.retries, args.rd
+    if args.queue:
+        t.use_queue(args.queue)
+    if args.scratch:
+        t.use_staging(args.scratch, args.sb, args.sk)
+    files = t.get_files_in_dir(args.pattern, args.recursive, args.manifest)
+    # Paired end reads are run as one job per (R1, R2) pair
+    return t.pair_files(files) if t.paired else files
+
+
+def run(args) -> list:
+    """ Runs the tool, returns the jobs which failed. """
     if args.t == 'cutadapt':
-        t = Cutadapt(args.d, args.c, args.p, args.mp, args.o, args.sp, args.f, args.n, args.dr, args.nt)
-        files = t.get_files_in_dir()
+        t = Cutadapt(args.d, args.c, args.p, args.mp, args.o, args.sp, args.f, args.n, args.dr, args.nt, args.mate)
+        files = get_files(t, args)
         t.run_per_file(files)
     elif args.t == 'fastqc':
         t = FastQC(args.d, args.c, args.o, args.f, args.n, args.dr, args.nt)
-        files = t.get_files_in_dir()
+        files = get_files(t, args)
         t.run_per_file(files)
     elif args.t == 'featurecounts':
         t = FeatureCounts(args.d, args.c, args.p, args.o, args.gtf, args.f, args.n, args.dr, args.nt)
-        files = t.get_files_in_dir()
-        t.run_on_files(files)
+        files = get_files(t, args)
+        if args.ns > 1:
+            t.run_sharded(files, args.ns)
+        else:
+            t.run_on_files(files)
     elif args.t == 'stringtie':
-        t = StringTie(args.d, args.c, args.p, args.o, args.gtf, args.f, args.n, args.dr, args.nt)
-        files = t.get_files_in_dir()
-        t.run_per_file(files)
+        t = StringTie(args.d, args.c, args.p, args.o, args.gtf, args.ctab, args.f or '.bam', args.n or 'STRINGTIE',
+                      args.dr, args.nt)
+        files = get_files(t, args)
+        if args.sw:
+            t.run_workflow(files, args.mps)
+        else:
+            t.run_per_file(files)
     elif args.t == 'hisat2':
-        t = Hisat2(args.d, args.c, args.p, args.o, args.adir, args.sp, args.f, args.n, args.dr, args.nt)
-        files = t.get_files_in_dir()
+        t = Hisat2(args.d, args.c, args.p, args.o, args.adir, args.sp, args.f, args.n, args.dr, args.nt, args.mate,
+                   sort_threads=args.st, sort_mem=args.sm, tmp_dir=args.tmp, skip_view=args.sv, cpus_per_job=args.cpj)
+        if args.jac and not args.cpj:
+            t.set_job_cpus(jobs_at_once=args.jac)
+        files = get_files(t, args)
         t.run_per_file(files)
-    elif args.t == 'pool':
-        t = Pool(args.d, args.c, args.o, args.f, args.n, args.fm, args.dr, args.nt)
-        files = t.get_files_in_dir()
+    elif args.t == 'trimalign':
+        # The trimmed reads are only written (to --kt) if asked for
+        c = Cutadapt(args.d, args.c, args.p, args.mp, args.kt or args.o, args.sp, args.f, dryrun=args.dr,
+                     nthreads=args.nt, mate_pattern=args.mate)
+        h = Hisat2(args.d, args.hc, args.hp, args.o, args.adir, args.sp, args.f, dryrun=args.dr, nthreads=args.nt,
+                   mate_pattern=args.mate, sort_threads=args.st, sort_mem=args.sm, tmp_dir=args.tmp,
+                   skip_view=args.sv, cpus_per_job=args.cpj)
+        if args.jac and not args.cpj:
+            h.set_job_cpus(jobs_at_once=args.jac)
+        t = TrimAlign(c, h, args.n or 'TRIMALIGN', args.kt is not None, args.dr, args.nt)
+        files = get_files(t, args)
         t.run_per_file(files)
+    elif args.t == 'pool':
+        t = Pool(args.d, args.c, args.o, args.f, args.n, None, args.dr, args.nt, args.ms, args.idx, args.st)
+        files = get_files(t, args)
+        # Each job merges a group of files: those of each sample in the sample sheet, the chunks of each FASTQ, or else
+        # all of the files into one BAM
+        if args.ss:
+            groups = t.group_files(files, args.ss, args.kc.split(','), args.sn)
+        elif args.gc:
+            groups = t.group_chunks(files)
+        else:
+            groups = [files] if files else []
+        t.run_per_file(groups)
     elif args.t == 'sort':
-        t = Sort(args.d, args.c, args.o, args.f, args.n, args.dr, args.nt)
-        files = t.get_files_in_dir()
+        t = Sort(args.d, args.c, args.o, args.f, args.n, args.dr, args.nt, args.idx, args.st)
+        files = get_files(t, args)
+        t.run_per_file(files)
+    elif args.t == 'chunk':
+        t = FastqChunk(args.d, args.o, args.nc, args.sp or 's', args.f or '.fq.gz', dryrun=args.dr, nthreads=args.nt,
+                       mate_pattern=args.mate)
+        files = get_files(t, args)
         t.run_per_file(files)
     else:
         print("Command not yet implemented. Please contact us if you wish for that to be implemented.")
+        return []
+    return t.failed_jobs
 
 
 def gen_parser():
     parser = argparse.ArgumentParser(description='scie2g')
-    tools = ['cutadapt', 'fastqc', 'featurecounts', 'stringtie', 'hisat2', 'sort', 'pool']
+    tools = ['cutadapt', 'fastqc', 'featurecounts', 'stringtie', 'hisat2', 'sort', 'pool', 'chunk', 'trimalign']
     parser.add_argument('--t', type=str, help=f'Tool name (one of: {", ".join(tools)})')
 
     parser.add_argument('--d', type=str, help='Directory with data.')
     parser.add_argument('--o', type=str, help='Output directory.')
-    parser.add_argument('--mp', type=str, help='Cutadapt: Path to multiqc file.')
     parser.add_argument('--p', type=str, default="", help='Parameter string (specific to each program)')
 
     parser.add_argument('--c', type=str, help='Program command or location.')
@@ -77,22 +127,76 @@ def gen_parser():
     parser.add_argument('--dr', type=bool, default=False, help='Dry run, defaults to false.')
     parser.add_argument('--nt', type=int, default=1, help='Number of threads (default is 1)')
     parser.add_argument('--n', type=str, default="", help='Name to append to files.')
+    parser.add_argument('--pattern', type=str, default=None, help='Glob of the input files (e.g. "*_R1.fq.gz"), used '
+                                                                  'instead of the file ending. Optional.')
+    parser.add_argument('--recursive', action='store_true', help='Also look for input files in sub directories.')
+    parser.add_argument('--manifest', action='store_true', help='Keep a manifest of the input directories in the '
+                                                                'output directory so re-runs only list changed ones.')
+    parser.add_argument('--resume', action='store_true', help='Only run the jobs which did not finish in the last run '
+                                                              '(from the job journal in the output directory).')
+    parser.add_argument('--queue', type=str, default=None, help='Send the jobs to this work queue directory, to be run '
+                                                                 'by "scirnap worker --queue <dir>" on any node.')
+    parser.add_argument('--scratch', type=str, default=None, help='Node-local scratch directory the inputs and outputs '
+                                                                   'of each job are staged through.')
+    parser.add_argument('--sb', type=str, default='100G', help='Scratch space staging can use (default 100G).')
+    parser.add_argument('--sk', type=int, default=2, help='Jobs whose inputs are copied to scratch ahead of time '
+                                                          '(default 2).')
+    parser.add_argument('--retries', type=int, default=0, help='Times a failed job is retried (default is 0).')
+    parser.add_argument('--rd', type=float, default=10.0, help='Seconds before the first retry, doubled for each '
+                                                               'retry after (default is 10).')
 
     # Cutadapt specific
     parser.add_argument('--mp', type=str, help='Cutadapt: Path to multiqc file.')
     parser.add_argument('--sp', type=str, help='Cutadapt and Hisat2: s or p (single or paired).')
+    parser.add_argument('--mate', type=str, default=None, help='Cutadapt and Hisat2: regex matching the mate in paired '
+                                                               'filenames, its group is 1 or 2 (default _R?([12])).')
 
     # FeatureCounts specific
     parser.add_argument('--gtf', type=str, help='FeatureCounts and Stringtie: path to the GTF (genome annotation) file.')
+    parser.add_argument('--ns', type=int, default=1, help='FeatureCounts: number of shards to split the BAMs into '
+                                                         '(run in parallel and merged, default is 1).')
 
     # Stringtie specific
     parser.add_argument('--ctab', type=str, help='Stringtie: Path to place the CTAB files.')
+    parser.add_argument('--sw', action='store_true', help='Stringtie: assemble each BAM, merge the assemblies, '
+                                                          'quantify against the merged GTF and collate FPKM/TPM/cov '
+                                                          'matrices.')
+    parser.add_argument('--mps', type=str, default='', help='Stringtie: parameter string for --merge (with --sw).')
 
     # hisat2 specific
     parser.add_argument('--adir', type=str, help='Hisat2: Path to directory with the indexs for Hisat2.')
+    parser.add_argument('--sm', type=str, default=None, help='Hisat2: samtools sort memory per thread (e.g. 2G).')
+    parser.add_argument('--tmp', type=str, default=None, help='Hisat2: directory for samtools sort temp files.')
+    parser.add_argument('--sv', action='store_true', help='Hisat2: pipe straight into samtools sort (no view).')
+    parser.add_argument('--cpj', type=int, default=None, help='Hisat2: CPUs per job, split between hisat2 and '
+                                                             'samtools view/sort.')
+    parser.add_argument('--jac', type=int, default=None, help='Hisat2: jobs to run at once, each job gets an even '
+                                                              'share of --nt as its CPUs (instead of --cpj).')
+
+    # Trimalign specific (cutadapt piped into hisat2, --c and --p are cutadapt's)
+    parser.add_argument('--hc', type=str, help='Trimalign: Hisat2 command or location.')
+    parser.add_argument('--hp', type=str, default="", help='Trimalign: Hisat2 parameter string.')
+    parser.add_argument('--kt', type=str, default=None, help='Trimalign: also keep the trimmed reads, in this '
+                                                             'directory.')
+
+    # Chunk specific
+    parser.add_argument('--nc', type=int, default=2, help='Chunk: number of chunks to split each FASTQ (or pair) into.')
 
     # Pooling specific
     # parser.add_argument('--fm', type=str, help='Pool: Dictionary with pooled filenames (in json format).')
+    parser.add_argument('--ms', action='store_true', help='Pool: write the merged BAMs sorted in one pass (inputs are '
+                                                          'checked to be coordinate sorted, no separate Sort needed).')
+    parser.add_argument('--ss', type=str, default=None, help='Pool: sample sheet (e.g. filelist.csv), the files of '
+                                                              'each sample are merged into one BAM named after it.')
+    parser.add_argument('--kc', type=str, default='Barcode', help='Pool: sample sheet column(s) found in the filenames '
+                                                                  '(comma separated, default Barcode).')
+    parser.add_argument('--sn', type=str, default='SampleName', help='Pool: sample sheet column with the sample names '
+                                                                     '(default SampleName).')
+    parser.add_argument('--gc', action='store_true', help='Pool: merge the BAMs aligned from the chunks of each FASTQ '
+                                                          '(see chunk) back into one BAM per FASTQ.')
+    parser.add_argument('--idx', action='store_true', help='Pool and Sort: also index the sorted BAMs.')
+    parser.add_argument('--st', type=int, default=1, help='Pool, Sort and Hisat2: samtools (sort) threads per job '
+                                                                    '(default is 1).')
 
     return parser
 
@@ -105,6 +209,9 @@ def main(args=None):
     if len(sys.argv) == 1:
         print_help()
         sys.exit(0)
+    elif sys.argv[1] == 'worker':
+        if worker_main(sys.argv[2:]):
+            sys.exit(1)
     elif sys.argv[1] in {'-v', '--v', '-version', '--version'}:
         print(f'scirnap v{__version__}')
         sys.exit(0)
@@ -112,7 +219,7 @@ def main(args=None):
         print(f'scirnap v{__version__}')
         args = parser.parse_args(args)
         # Validate the input arguments.
-        tools = ['cutadapt', 'fastqc', 'featurecounts', 'stringtie', 'hisat2', 'sort', 'pool']
+        tools = ['cutadapt', 'fastqc', 'featurecounts', 'stringtie', 'hisat2', 'sort', 'pool', 'chunk', 'trimalign']
         if not args.t in tools:
             u.err_p([f'The command you attempted to run is not in our list, you sent: {args.t},'
                      f'\nPlease choose from one of: {", ".join(tools)}'])
@@ -120,7 +227,10 @@ def main(args=None):
         # Otherwise we have need successful so we can run the program
         u.dp(['Running sci-rnap with tool: ', args.t])
         # RUN!
-        run(args)
+        failed = run(args)
+        if failed:
+            u.err_p([f'Error: {len(failed)} jobs failed:\n', '\n'.join(job.name for job in failed)])
+            sys.exit(1)
     # Done - no errors.
     sys.exit(0)
 
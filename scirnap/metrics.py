@@ -0,0 +1,48 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Per-job resource metrics (wall time, user/sys CPU, peak RSS and bytes read/written) written as JSON lines, one line
+per executed cmd so that the file can be read while a run is still going.
+"""
+
+import json
+import threading
+
+import pandas as pd
+
+
+class MetricsWriter:
+
+    def __init__(self, metrics_path: str):
+        self.metrics_path = metrics_path
+        self._lock = threading.Lock()
+
+    def write(self, record: dict):
+        with self._lock:
+            with open(self.metrics_path, 'a+') as f:
+                f.write(json.dumps(record) + '\n')
+
+
+def read_metrics(metrics_path: str, output_path=None) -> pd.DataFrame:
+    """ Reads a metrics file into a DataFrame, optionally saving it as parquet (output_path ending in .parquet) or csv. """
+    metrics_df = pd.read_json(metrics_path, lines=True)
+    if output_path:
+        if output_path.endswith('.parquet'):
+            metrics_df.to_parquet(output_path, index=False)  # Needs pyarrow or fastparquet
+        else:
+            metrics_df.to_csv(output_path, index=False)
+    return metrics_df
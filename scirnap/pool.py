@@ -14,24 +14,178 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
 #                                                                             #
 ###############################################################################
+""" Pool bam files: http://www.htslib.org/doc/samtools-merge.html """
+
+import gzip
 import os
+import re
+import struct
+import zlib
 
-from scirnap import BasePipeline
+import pandas as pd
+
+from scirnap import BasePipeline, PipelineException
+from scirnap.chunk import get_chunk_source
+from scirnap.scheduler import parse_mem
+
+# Filenames are split into tokens on these to look them up in the sample sheet e.g. HISAT2_run1.ACGTAC.L001.bam
+_TOKEN_SPLIT = re.compile(r'[._\-]')
+
+
+def get_sort_order(bam_path: str) -> str:
+    """
+    Sort order (SO) in the @HD line of a BAM's header: coordinate, queryname, unsorted, or unknown if it isn't set or
+    the file can't be read as a BAM. Only the first BGZF block(s) of the file are decompressed.
+    """
+    try:
+        with gzip.open(bam_path, 'rb') as f:
+            if f.read(4) != b'BAM\x01':
+                return 'unknown'
+            l_text = struct.unpack('<i', f.read(4))[0]
+            # @HD has to be the first line of the header
+            first_line = f.read(min(l_text, 65536)).split(b'\n', 1)[0].decode(errors='replace')
+    except (OSError, EOFError, struct.error, zlib.error):
+        return 'unknown'
+    match = re.search(r'\tSO:(\S+)', first_line) if first_line.startswith('@HD') else None
+    return match.group(1) if match else 'unknown'
+
+
+def read_sample_sheet(sample_sheet) -> pd.DataFrame:
+    """ Sample sheet (e.g. filelist.csv) as a DataFrame of strings, the separator (, or tab) is detected. """
+    if isinstance(sample_sheet, pd.DataFrame):
+        return sample_sheet.astype(str)
+    return pd.read_csv(sample_sheet, sep=None, engine='python', dtype=str)
 
-""" Pool bam files: http://www.htslib.org/doc/samtools-merge.html """
+
+def group_files(file_paths: list, sample_sheet=None, key_columns='Barcode', name_column='SampleName',
+                key_fn=None) -> tuple:
+    """
+    Groups files by sample, returns ({sample name: sorted files}, files which didn't match a sample).
+
+    The sample sheet's key_columns (e.g. 'Barcode' or ['Barcode', 'Lane']) are put in a hash index to name_column, and
+    each file is looked up by the tokens of its filename (split on . _ -), so a file is matched in one pass over its
+    name. key_fn (file path -> key) can be given instead of matching tokens e.g. lambda f: f.split('.')[1], the key is
+    then looked up in the sample sheet if there is one otherwise it is used as the name of the group.
+    """
+    key_columns = [key_columns] if isinstance(key_columns, str) else list(key_columns)
+    sample_names, column_values = None, []
+    if sample_sheet is not None:
+        sheet_df = read_sample_sheet(sample_sheet)
+        missing = [c for c in key_columns + [name_column] if c not in sheet_df.columns]
+        if missing:
+            raise PipelineException(f'Error: the sample sheet has no column(s): {", ".join(missing)}, the columns are: '
+                                    f'{", ".join(sheet_df.columns)}')
+        keys = zip(*[sheet_df[c].values for c in key_columns])
+        sample_names = dict(zip(keys, sheet_df[name_column].values))
+        column_values = [set(sheet_df[c].values) for c in key_columns]
+    elif key_fn is None:
+        raise PipelineException('Error: group_files needs a sample sheet or a key_fn to group the files.')
+
+    groups, unmatched = {}, []
+    for file_path in file_paths:
+        if key_fn is not None:
+            key = key_fn(file_path)
+            name = key if sample_names is None else sample_names.get((key, ) if len(key_columns) == 1 else key)
+        else:
+            tokens = _TOKEN_SPLIT.split(os.path.basename(file_path))
+            key = []
+            for values in column_values:
+                found = [t for t in tokens if t in values]
+                key.append(found[0] if found else None)
+            name = sample_names.get(tuple(key))
+        if name is None:
+            unmatched.append(file_path)
+        else:
+            groups.setdefault(name, []).append(file_path)
+    return {name: sorted(files) for name, files in groups.items()}, unmatched
 
 
 class Pool(BasePipeline):
 
+    mem_per_job = '256M'
+    # Memory samtools sort uses per thread, only needed when unsorted files are merged with merge_sorted
+    sort_mem_per_thread = '768M'
+
     def __init__(self, data_dir: str, program_location: str, output_dir: str, file_ending='.bam', name='BAMPOOL',
-                 filename_map=None, dryrun=False, nthreads=None):
+                 filename_map=None, dryrun=False, nthreads=None, merge_sorted=False, index=False, threads=1):
+        """
+        merge_sorted: write the merged BAMs coordinate sorted (*.sorted.bam) in one pass, instead of merging here and
+                      then running Sort on *.merged.bam. Inputs are checked to be coordinate sorted (e.g. the output of
+                      Hisat2) and are merged directly, any group with an unsorted input is piped through samtools sort.
+        index: also index (.bai) the sorted BAM.
+        threads: number of threads samtools uses to compress (and sort) each merged BAM.
+        """
         super().__init__(data_dir, program_location, output_dir=output_dir, file_ending=file_ending, name=name, dryrun=dryrun,
                          nthreads=nthreads)
         # A map from the first filename to the new filename
         self.filename_map = filename_map
+        self.merge_sorted, self.index, self.threads = merge_sorted, index, threads
+        self.cpus_per_job = threads
+        self.params = {'Merge sorted': merge_sorted, 'Index': index, 'Threads': threads}
+        self.add_params_to_logfile()
+
+    def group_files(self, file_paths: list, sample_sheet=None, key_columns='Barcode', name_column='SampleName',
+                    key_fn=None, min_files=1) -> list:
+        """
+        Groups the files by sample (see group_files) and returns the groups to merge, e.g. for run_per_file or as the
+        group_fn of a PipelineDAG stage. Each merged BAM is named after its sample (set in filename_map). Groups with
+        fewer than min_files files are left out.
+        """
+        groups, unmatched = group_files(file_paths, sample_sheet, key_columns, name_column, key_fn)
+        if unmatched:
+            self.u.warn_p([f'Warning: {len(unmatched)} files did not match a sample, these are not merged:\n',
+                           '\n'.join(unmatched[:20])])
+        groups = {name: files for name, files in sorted(groups.items()) if len(files) >= min_files}
+        self.filename_map = {**(self.filename_map or {}), **{files[0]: name for name, files in groups.items()}}
+        return list(groups.values())
+
+    def group_chunks(self, file_paths: list, min_files=1) -> list:
+        """
+        Groups the BAMs aligned from the chunks of each FASTQ (see scirnap.chunk) so they are merged back into one BAM
+        per FASTQ e.g. HISAT2_s1.chunk000.fq.gz.sorted.bam, ... -> HISAT2_s1.fq.gz.sorted.bam (with merge_sorted).
+        """
+        return self.group_files(file_paths, key_fn=get_chunk_source, min_files=min_files)
 
     def generate_cmd(self, files_to_merge):
         """ Files to merge is a list of files to merge into bams. """
+        if self.merge_sorted:
+            return self.generate_merge_sorted_cmd(files_to_merge)
+        # The job is given threads CPUs, so samtools has to use them
+        threads = f' -@ {self.threads}' if self.threads > 1 else ''
+        return f'{self.program_location} merge{threads} {self.get_output_files(files_to_merge)[0]} ' \
+               f'{" ".join(files_to_merge)}'
+
+    def generate_merge_sorted_cmd(self, files_to_merge):
+        """
+        Merging coordinate sorted BAMs gives a coordinate sorted BAM, so they are merged straight into the output. If
+        any input isn't sorted (or can't be checked e.g. in a dry run before it exists) the merge is streamed
+        uncompressed into samtools sort instead, either way nothing is written but the sorted BAM.
+        """
+        output_file = self.get_output_files(files_to_merge)[0]
+        files = " ".join(files_to_merge)
+        unsorted = [f for f in files_to_merge if get_sort_order(f) != 'coordinate']
+        if not unsorted:
+            cmd = f'{self.program_location} merge -@ {self.threads} {output_file} {files}'
+        else:
+            if not self.dryrun:
+                self.u.warn_p([f'Warning: {len(unsorted)} files are not coordinate sorted so they are sorted while '
+                               f'being merged into {output_file}:\n', '\n'.join(unsorted[:20])])
+            cmd = f'{self.program_location} merge -u - {files} | ' \
+                  f'{self.program_location} sort -@ {self.threads} -o {output_file} -'
+        if self.index:
+            cmd += f' && {self.program_location} index -@ {self.threads} {output_file}'
+        return cmd
+
+    def get_output_files(self, files_to_merge) -> list:
         filename = self.filename_map[files_to_merge[0]] if self.filename_map else self._get_filename(files_to_merge[0])
-        return f'{self.program_location} merge {os.path.join(self.output_dir, filename)}.merged.bam {" ".join(files_to_merge)}'
+        if self.merge_sorted:
+            output_file = f'{os.path.join(self.output_dir, filename)}.sorted.bam'
+            return [output_file, f'{output_file}.bai'] if self.index else [output_file]
+        return [f'{os.path.join(self.output_dir, filename)}.merged.bam']
+
+    def get_job_resources(self, cmd=None) -> tuple:
+        cpus, mem = super().get_job_resources(cmd)
+        if cmd and f'{self.program_location} sort ' in cmd:
+            mem += parse_mem(self.sort_mem_per_thread) * self.threads
+        return cpus, mem
 
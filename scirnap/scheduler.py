@@ -0,0 +1,202 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Resource aware job scheduler.
+
+Each job declares how many CPU slots and how much memory (in bytes) it needs, jobs are only started while both the
+CPU and memory budget of the node still fit. A single scheduler can be shared by several pipelines (e.g. Hisat2 and
+Sort running at the same time) so that they don't oversubscribe the machine.
+
+Jobs run on an asyncio event loop in a background thread. Coroutine functions (e.g. BasePipeline cmds, see
+scirnap.executor) are awaited on the loop directly, plain functions are run in a thread pool.
+"""
+
+import asyncio
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from sciutil import SciUtil
+
+_MEM_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_mem(mem) -> int:
+    """ Converts a memory string (e.g. 768M or 4G, as used by samtools) to bytes. Ints are returned as is. """
+    if mem is None:
+        return 0
+    if isinstance(mem, (int, float)):
+        return int(mem)
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', str(mem).upper())
+    if not match:
+        raise ValueError(f'Could not parse memory value: {mem}')
+    return int(float(match.group(1)) * _MEM_UNITS[match.group(2)])
+
+
+def total_memory() -> int:
+    """ Physical memory of this machine in bytes (0 if it can't be determined). """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+class Job:
+
+    def __init__(self, fn, args=(), name=None, cpus=1, mem=0):
+        self.fn, self.args = fn, args
+        self.name = name or getattr(fn, '__name__', 'job')
+        self.cpus = max(int(cpus or 1), 1)
+        self.mem = parse_mem(mem)
+        self.status = 'pending'
+        self.submitted = self.started = self.finished = None
+        self.result, self.error = None, None
+        self.callbacks = []
+        self._done = threading.Event()
+
+    @property
+    def wait_time(self):
+        """ Seconds the job sat in the queue before it was admitted. """
+        if self.started is None:
+            return None
+        return self.started - self.submitted
+
+    @property
+    def run_time(self):
+        if self.finished is None or self.started is None:
+            return None
+        return self.finished - self.started
+
+    def add_done_callback(self, fn):
+        """ fn(job) is called from the scheduler once the job has finished (whether it succeeded or failed). """
+        self.callbacks.append(fn)
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def done(self):
+        return self._done.is_set()
+
+    async def run_async(self, thread_pool):
+        try:
+            if asyncio.iscoroutinefunction(self.fn):
+                self.result = await self.fn(*self.args)
+            else:
+                self.result = await asyncio.get_running_loop().run_in_executor(thread_pool, self.fn, *self.args)
+            self.status = 'done'
+        except Exception as e:
+            self.error = e
+            self.status = 'failed'
+
+
+class JobScheduler:
+
+    def __init__(self, max_cpus=None, max_mem=None):
+        """
+        max_cpus: number of CPU slots shared by all running jobs (defaults to the number of cores).
+        max_mem: memory shared by all running jobs in bytes or as a string e.g. '256G' (defaults to physical memory).
+        """
+        self.max_cpus = max_cpus or os.cpu_count() or 1
+        self.max_mem = parse_mem(max_mem) or total_memory()
+        self.used_cpus, self.used_mem = 0, 0
+        self.queue, self.jobs = [], []
+        self._lock = threading.Lock()
+        self._loop, self._thread_pool = None, None
+        self.u = SciUtil()
+
+    def _get_loop(self):
+        """ Starts the event loop thread the first time a job is started. Must be called with the lock held. """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            # Every admitted job takes at least one CPU slot so the pool never holds back an admitted job
+            self._thread_pool = ThreadPoolExecutor(max_workers=self.max_cpus)
+            threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        return self._loop
+
+    def _fit(self, job):
+        """ Jobs larger than the whole node are clamped so that they can still run (on their own). """
+        cpus = min(job.cpus, self.max_cpus)
+        mem = min(job.mem, self.max_mem) if self.max_mem else job.mem
+        return cpus, mem
+
+    def _fits(self, job):
+        cpus, mem = self._fit(job)
+        if self.used_cpus + cpus > self.max_cpus:
+            return False
+        if self.max_mem and self.used_mem + mem > self.max_mem:
+            return False
+        return True
+
+    def _schedule(self):
+        """ Starts every queued job which fits in the remaining budget. Must be called with the lock held. """
+        for job in list(self.queue):
+            if self._fits(job):
+                self.queue.remove(job)
+                cpus, mem = self._fit(job)
+                self.used_cpus += cpus
+                self.used_mem += mem
+                job.status = 'running'
+                job.started = time.time()
+                asyncio.run_coroutine_threadsafe(self._run_job(job), self._get_loop())
+
+    async def _run_job(self, job):
+        try:
+            await job.run_async(self._thread_pool)
+            job.finished = time.time()
+            with self._lock:
+                cpus, mem = self._fit(job)
+                self.used_cpus -= cpus
+                self.used_mem -= mem
+                self._schedule()
+            for fn in job.callbacks:
+                # One failing callback mustn't stop the others (e.g. the DAG's bookkeeping)
+                try:
+                    fn(job)
+                except Exception as e:
+                    self.u.err_p([f'Error: a done callback of job {job.name} failed:\n{e!r}'])
+        finally:
+            # Always, otherwise anyone waiting on the job waits forever
+            job._done.set()
+
+    def submit(self, job: Job) -> Job:
+        """ Queues a job, it is started as soon as there is room for it. Safe to call from several threads. """
+        with self._lock:
+            job.submitted = time.time()
+            job.status = 'queued'
+            self.queue.append(job)
+            self.jobs.append(job)
+            self._schedule()
+        return job
+
+    def run(self, jobs: list) -> list:
+        """ Submits the jobs and blocks until all of them have finished. """
+        for job in jobs:
+            self.submit(job)
+        for job in jobs:
+            job.wait()
+        return jobs
+
+    def report(self, jobs=None) -> pd.DataFrame:
+        """ Queue, wait and run times for each job (all jobs the scheduler has seen by default). """
+        rows = []
+        for job in (jobs if jobs is not None else self.jobs):
+            rows.append({'name': job.name, 'status': job.status, 'cpus': job.cpus, 'mem': job.mem,
+                         'submitted': job.submitted, 'wait_time': job.wait_time, 'run_time': job.run_time})
+        return pd.DataFrame(rows, columns=['name', 'status', 'cpus', 'mem', 'submitted', 'wait_time', 'run_time'])
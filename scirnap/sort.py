@@ -14,20 +14,40 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
 #                                                                             #
 ###############################################################################
+""" Pool bam files: http://www.htslib.org/doc/samtools-merge.html """
+
 import os
 from scirnap import BasePipeline
 
-""" Pool bam files: http://www.htslib.org/doc/samtools-merge.html """
-
 
 class Sort(BasePipeline):
 
+    # samtools sort's default memory per thread
+    mem_per_job = '768M'
+
     def __init__(self, data_dir: str, program_location: str, output_dir: str, file_ending='.bam', name='',
-                 dryrun=False, nthreads=None):
+                 dryrun=False, nthreads=None, index=False, threads=1):
+        """ index: also index (.bai) the sorted BAM. threads: number of threads samtools sorts and compresses with. """
         super().__init__(data_dir, program_location, output_dir, file_ending=file_ending, name=name, dryrun=dryrun,
                          nthreads=nthreads)
+        self.index, self.threads = index, threads
+        self.cpus_per_job = threads
 
     def generate_cmd(self, filepath):
         """ sort using samtools: Removes the merged that was placed on the bottom """
+        output_file = self.get_output_files(filepath)[0]
+        threads = f' -@ {self.threads}' if self.threads > 1 else ''
+        cmd = f'{self.program_location} sort{threads} {filepath} -o {output_file}'
+        if self.index:
+            cmd += f' && {self.program_location} index{threads} {output_file}'
+        return cmd
+
+    def get_job_resources(self, cmd=None) -> tuple:
+        # samtools sort uses up to mem_per_job for each thread
+        cpus, mem = super().get_job_resources(cmd)
+        return cpus, mem * self.threads
+
+    def get_output_files(self, filepath) -> list:
         filename = '.'.join(self._get_filename(filepath).split('.')[:-2]) # Remove the previous ending
-        return f'{self.program_location} sort {filepath} -o {os.path.join(self.output_dir, filename)}.sorted.bam'
+        output_file = f'{os.path.join(self.output_dir, filename)}.sorted.bam'
+        return [output_file, f'{output_file}.bai'] if self.index else [output_file]
@@ -0,0 +1,280 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Staging of inputs and outputs through node-local scratch.
+
+The inputs of the next jobs are copied to scratch in background threads (prefetch jobs ahead of the one that is
+running) and each cmd is rewritten to read them from there and write its outputs to a scratch directory, so the tools
+(and e.g. samtools sort's temp files, which go next to its output) only touch local disk. Once the cmd succeeds its
+outputs are copied back to where they belong, hashed as they are written and read back to check the copy, and renamed
+into place. Staged inputs are removed when their job finishes.
+
+Everything staged counts against the budget (bytes of scratch), as does an estimate of each job's outputs (reserved
+along with its inputs, since the tool writes them to scratch before they can be counted). Prefetching stops when the
+budget is full and a job whose inputs and outputs don't fit runs on the original files instead.
+"""
+
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from scirnap.scheduler import parse_mem
+
+_BLOCK = 4 * 1024 * 1024
+
+
+def _hash_file(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def copy_file(src: str, dst: str, verify=True) -> str:
+    """
+    Copies src to dst (through a temp file renamed into place, so dst is never half written), returns the checksum.
+    verify: read the copy back and check it has the same checksum, an OSError is raised if it doesn't.
+    """
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    tmp_path = f'{dst}.scirnap-{os.getpid()}-{threading.get_ident()}.tmp'
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with open(src, 'rb') as fin, open(tmp_path, 'wb') as fout:
+            for block in iter(lambda: fin.read(_BLOCK), b''):
+                h.update(block)
+                fout.write(block)
+            fout.flush()
+            os.fsync(fout.fileno())
+        if verify and _hash_file(tmp_path) != h.hexdigest():
+            raise OSError(f'Checksum of the copy of {src} to {dst} does not match the original.')
+        shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return h.hexdigest()
+
+
+def rewrite_cmd(cmd: str, paths: dict) -> str:
+    """ Replaces every whole occurrence of each path in the cmd (not as part of a longer path) with its new path. """
+    for path in sorted(paths, key=len, reverse=True):
+        cmd = re.sub(rf'(?<![^\s\'"=<>:,]){re.escape(path)}(?![^\s\'";|&<>),])', lambda m: paths[path], cmd)
+    return cmd
+
+
+class Stager:
+
+    def __init__(self, scratch_dir: str, budget='100G', prefetch=2, verify=True, nthreads=2, output_ratio=1.0):
+        """
+        scratch_dir: node-local directory (a temporary directory is made in it and removed by close).
+        budget: scratch space staging can use (bytes or e.g. '500G').
+        prefetch: number of jobs whose inputs are copied ahead of them being run.
+        verify: check the checksum of the outputs once they are copied back.
+        nthreads: threads copying files.
+        output_ratio: scratch reserved for a job's outputs, as a multiple of the size of its inputs.
+        """
+        os.makedirs(scratch_dir, exist_ok=True)
+        self.root = tempfile.mkdtemp(prefix='scirnap_stage_', dir=scratch_dir)
+        self.budget = parse_mem(budget)
+        self.prefetch, self.verify, self.output_ratio = prefetch, verify, output_ratio
+        self.used = 0
+        self.staged = {}  # Original path -> [future of the copy, size, number of jobs using it]
+        self.reserved = {}  # Inputs of a job -> scratch reserved for the outputs of each job with those inputs
+        self.upcoming = deque()  # Inputs of the jobs still to run, in the order they were planned
+        self.prefetched = []
+        self.copied_in = self.copied_out = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=nthreads)
+        self._counter = 0
+
+    def _reserve(self, size: int) -> bool:
+        # Must be called with the lock held
+        if self.used + size > self.budget:
+            return False
+        self.used += size
+        return True
+
+    def _free(self, size: int):
+        with self._lock:
+            self.used -= size
+        self._prefetch()
+
+    def _staged_path(self, path: str) -> str:
+        self._counter += 1
+        return os.path.join(self.root, 'in', str(self._counter), os.path.basename(path))
+
+    def _copy_in(self, path: str, staged_path: str) -> str:
+        copy_file(path, staged_path, verify=False)
+        self.copied_in += 1
+        return staged_path
+
+    def _stage(self, paths: list) -> bool:
+        """
+        Starts copying the files that aren't staged yet, takes a reference to each of them for a job and reserves
+        scratch for the job's outputs, False (and nothing done) if they don't fit.
+        """
+        with self._lock:
+            sizes = {path: self.staged[path][1] if path in self.staged else os.path.getsize(path)
+                     for path in dict.fromkeys(paths)}
+            new = [path for path in sizes if path not in self.staged]
+            output_size = int(sum(sizes.values()) * self.output_ratio)
+            if not self._reserve(sum(sizes[path] for path in new) + output_size):
+                return False
+            for path in new:
+                self.staged[path] = [self._pool.submit(self._copy_in, path, self._staged_path(path)), sizes[path], 0]
+            for path in sizes:
+                self.staged[path][2] += 1
+            self.reserved.setdefault(tuple(paths), []).append(output_size)
+            return True
+
+    def _prefetch(self):
+        """ Stages the inputs of the next jobs (up to prefetch of them) while they fit in the budget. """
+        while True:
+            with self._lock:
+                if len(self.prefetched) >= self.prefetch or not self.upcoming:
+                    return
+                paths = self.upcoming.popleft()
+            try:
+                staged = self._stage(paths)
+            except OSError:
+                continue  # e.g. the file isn't there yet, it is staged when its job runs
+            with self._lock:
+                if staged:
+                    self.prefetched.append(paths)
+                else:
+                    self.upcoming.appendleft(paths)
+                    return
+
+    def plan(self, inputs: list):
+        """ Inputs of each job (a list of files per job) in the order the jobs will run, prefetching starts now. """
+        with self._lock:
+            self.upcoming.extend(list(paths) for paths in inputs)
+        self._prefetch()
+
+    def skip(self, paths: list):
+        """ The job won't run after all (e.g. it is cached), frees what was prefetched for it. """
+        paths = list(paths)
+        with self._lock:
+            prefetched = paths in self.prefetched
+            if prefetched:
+                self.prefetched.remove(paths)
+            elif paths in self.upcoming:
+                self.upcoming.remove(paths)
+        if prefetched:
+            self.release(paths)
+        else:
+            self._prefetch()
+
+    async def stage_in(self, paths: list):
+        """ Waits for the inputs to be staged (staging them if they weren't prefetched), None if they don't fit. """
+        paths = list(paths)
+        with self._lock:
+            prefetched = paths in self.prefetched
+            if prefetched:
+                self.prefetched.remove(paths)
+            elif paths in self.upcoming:
+                self.upcoming.remove(paths)
+        if not prefetched and not self._stage(paths):
+            return None
+        self._prefetch()
+        return {path: await asyncio.wrap_future(self.staged[path][0]) for path in paths}
+
+    def release(self, paths: list):
+        """
+        Drops the job's references to its staged inputs and frees the scratch reserved for its outputs, inputs no
+        other job uses are removed (once copied, without waiting for a copy still running).
+        """
+        with self._lock:
+            reserved = self.reserved.get(tuple(paths))
+            size = reserved.pop() if reserved else 0
+            if reserved == []:
+                del self.reserved[tuple(paths)]
+        for path in dict.fromkeys(paths):
+            with self._lock:
+                staged = self.staged.get(path)
+                if staged is None:
+                    continue
+                staged[2] -= 1
+                if staged[2] > 0:
+                    continue
+                del self.staged[path]
+            staged[0].add_done_callback(lambda future, size=staged[1]: self._remove_staged(future, size))
+        self._free(size)
+
+    def _remove_staged(self, future, size: int):
+        try:
+            os.remove(future.result())
+        except OSError:
+            pass  # The copy failed (or it is gone already)
+        self._free(size)
+
+    def get_output_paths(self, output_files: list) -> dict:
+        """ Scratch path of each output, the outputs in one directory are kept together (e.g. a BAM and its .bai). """
+        with self._lock:
+            self._counter += 1
+            job_dir = os.path.join(self.root, 'out', str(self._counter))
+        dirs = {}
+        paths = {}
+        for output_file in output_files:
+            out_dir = dirs.setdefault(os.path.dirname(output_file), os.path.join(job_dir, str(len(dirs))))
+            os.makedirs(out_dir, exist_ok=True)
+            paths[output_file] = os.path.join(out_dir, os.path.basename(output_file))
+        return paths
+
+    def _copy_out(self, scratch_path: str, output_file: str):
+        try:
+            copy_file(scratch_path, output_file, self.verify)
+            self.copied_out += 1
+        finally:
+            os.remove(scratch_path)
+
+    async def write_back(self, output_paths: dict, paths=None):
+        """
+        Copies the outputs ({output file: scratch path}) back, in the copy threads, then removes them. paths are the
+        job's inputs, outputs larger than what was reserved for them count against the budget until they are copied.
+        """
+        output_paths = {output_file: scratch_path for output_file, scratch_path in output_paths.items()
+                        if os.path.exists(scratch_path)}
+        size = sum(os.path.getsize(scratch_path) for scratch_path in output_paths.values())
+        with self._lock:
+            reserved = self.reserved.get(tuple(paths or ()))
+            extra = max(size - (reserved[-1] if reserved else 0), 0)
+            self.used += extra
+        try:
+            futures = [self._pool.submit(self._copy_out, scratch_path, output_file)
+                       for output_file, scratch_path in output_paths.items()]
+            for future in futures:
+                await asyncio.wrap_future(future)
+        finally:
+            self._free(extra)
+
+    def discard(self, output_paths: dict):
+        """ Removes whatever is left of a job's outputs in scratch (e.g. after the cmd failed). """
+        for scratch_path in output_paths.values():
+            if os.path.exists(scratch_path):
+                os.remove(scratch_path)
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        shutil.rmtree(self.root, ignore_errors=True)
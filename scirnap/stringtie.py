@@ -14,32 +14,222 @@
 #    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
 #                                                                             #
 ###############################################################################
+""" Documentation at: https://ccb.jhu.edu/software/stringtie/ """
+
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import os
 
-from scirnap import BasePipeline
+import numpy as np
+import pandas as pd
+
+from scirnap import BasePipeline, PipelineException
+from scirnap.annotation import GTFIndex
+from scirnap.scheduler import JobScheduler
+
+# Columns of the Ballgown transcript table (t_data.ctab) StringTie writes with -b or -B
+CTAB_COLUMNS = ['t_id', 'chr', 'strand', 'start', 'end', 't_name', 'num_exons', 'length', 'gene_id', 'gene_name',
+                'cov', 'FPKM']
+CTAB_FILENAME = 't_data.ctab'
+MODES = ['quant', 'assemble', 'merge']
+
+
+def read_ctab(ctab_path: str, columns=('t_name', 'cov', 'FPKM')) -> pd.DataFrame:
+    """ Reads only the given columns of a t_data.ctab (with explicit dtypes), e.g. the values for one sample. """
+    dtypes = {'t_id': np.int64, 'start': np.int64, 'end': np.int64, 'num_exons': np.int32, 'length': np.int64,
+              'cov': np.float64, 'FPKM': np.float64, 'TPM': np.float64}
+    columns = list(columns)
+    return pd.read_csv(ctab_path, sep='\t', usecols=columns, dtype={c: dtypes.get(c, str) for c in columns},
+                       engine='c')[columns]
+
+
+def collate_ctabs(ctab_paths: dict, output_prefix=None, nthreads=None) -> dict:
+    """
+    Collates the t_data.ctab of each sample ({sample name: path}) into transcript x sample matrices, returns
+    {'FPKM': df, 'TPM': df, 'cov': df, 'annotation': df} (rows are t_name). The tables are read in parallel and only
+    the value columns are parsed for all but the first. t_data.ctab has no TPM so it is computed from the FPKM
+    (TPM = FPKM / sum(FPKM) * 1e6 per sample, which is how StringTie's TPM relates to its FPKM).
+
+    When every sample was quantified against the same GTF (-e, as in run_workflow) the rows line up and the columns
+    are stacked directly, otherwise the samples are aligned on t_name (0 where a sample doesn't have a transcript).
+    output_prefix: write each matrix to <output_prefix>_<FPKM|TPM|cov>.tsv.
+    """
+    if not ctab_paths:
+        raise PipelineException('Error: no t_data.ctab files to collate.')
+    samples, paths = list(ctab_paths.keys()), list(ctab_paths.values())
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise PipelineException(f'Error: {len(missing)} t_data.ctab files do not exist, e.g. {missing[0]}')
+    with ThreadPoolExecutor(max_workers=nthreads or min(32, len(paths))) as pool:
+        values = list(pool.map(read_ctab, paths))
+    annotation_df = read_ctab(paths[0], CTAB_COLUMNS[:10]).set_index('t_name')
+    t_names = values[0]['t_name'].values
+    if all(np.array_equal(df['t_name'].values, t_names) for df in values[1:]):
+        index = pd.Index(t_names, name='t_name')
+        columns = {col: np.column_stack([df[col].values for df in values]) for col in ['cov', 'FPKM']}
+    else:
+        index = pd.Index(sorted(set().union(*[df['t_name'].values for df in values])), name='t_name')
+        indexed = [df.drop_duplicates('t_name').set_index('t_name').reindex(index, fill_value=0.0) for df in values]
+        columns = {col: np.column_stack([df[col].values for df in indexed]) for col in ['cov', 'FPKM']}
+        annotation_df = annotation_df[~annotation_df.index.duplicated()].reindex(index)
+    fpkm_totals = columns['FPKM'].sum(axis=0)
+    columns['TPM'] = np.divide(columns['FPKM'] * 1e6, fpkm_totals, out=np.zeros_like(columns['FPKM']),
+                               where=fpkm_totals > 0)
+    matrices = {col: pd.DataFrame(columns[col], index=index, columns=samples) for col in ['FPKM', 'TPM', 'cov']}
+    if output_prefix:
+        for col, matrix_df in matrices.items():
+            matrix_df.to_csv(f'{output_prefix}_{col}.tsv', sep='\t')
+    matrices['annotation'] = annotation_df
+    return matrices
 
-""" Documentation at: https://ccb.jhu.edu/software/stringtie/ """
 
 class StringTie(BasePipeline):
 
+    thread_flags = ('-p',)
+    mem_per_job = '2G'
+
     def __init__(self, data_dir: str, program_location: str, param_str: str, output_dir: str, gtf_filepath: str,
                  ctab_filepath: str,
-                 file_ending='.bam', name='STRINGTIE',  dryrun=False, nthreads=None):
+                 file_ending='.bam', name='STRINGTIE',  dryrun=False, nthreads=None, mode='quant'):
+        """
+        mode: quant (default) quantifies each BAM and writes its ctab files to a directory in ctab_filepath, assemble
+              assembles the transcripts of each BAM (with the GTF as a guide) and merge merges the assemblies (a list
+              of GTFs, one job) into one GTF. run_workflow runs all three.
+        """
         super().__init__(data_dir, program_location, file_ending=file_ending, name=name, dryrun=dryrun,
                          nthreads=nthreads)
+        if mode not in MODES:
+            self.u.err_p([f'Error: passed an invalid parameter for mode: {mode}.\n'
+                          f'Please use one of: {", ".join(MODES)}'])
+            return
         self.gtf_filepath = gtf_filepath
         self.output_dir = output_dir
         self.param_str = param_str  # e.g. '-F GTF -t exon -T 10 -s 2 -g gene_id --primary -a '
         self.ctab_filepath = ctab_filepath
-        self.params = {'GTF path': self.gtf_filepath, 'Param str': self.param_str, 'ctab path': ctab_filepath}
+        self.mode = mode
+        self.params = {'GTF path': self.gtf_filepath, 'Param str': self.param_str, 'ctab path': ctab_filepath,
+                       'Mode': mode}
         self.add_params_to_logfile()
 
     def generate_cmd(self, file_path):
-        return f'{self.program_location} {self.param_str} -G {self.gtf_filepath} -o ' \
+        if self.mode == 'merge':
+            return self.generate_merge_cmd(file_path)
+        if self.mode == 'assemble':
+            return f'{self.program_location} {self.param_str} -G {self.gtf_filepath} -o ' \
+                   f'{self._gen_fname_str(file_path)}.gtf {file_path}'
+        # The ctab files go to their own directory (-b) so -B (ctab files next to the -o GTF) isn't passed as well
+        param_str = ' '.join(param for param in self.param_str.split() if param != '-B')
+        return f'{self.program_location} {param_str} -G {self.gtf_filepath} -o ' \
                f'{self._gen_fname_str(file_path)}.gtf -b {self._gen_ctab_str(file_path)}  {file_path} '
 
+    def generate_merge_cmd(self, file_paths):
+        """ Merges the assembled GTFs (file_paths) into one, with the GTF as the reference. """
+        return f'{self.program_location} --merge {self.param_str} -G {self.gtf_filepath} -o ' \
+               f'{self.get_output_files(file_paths)[0]} {" ".join(file_paths)}'
+
+    def get_output_files(self, file_path) -> list:
+        if self.mode == 'merge':
+            return [f'{os.path.join(self.output_dir, self.name)}_merged.gtf']
+        if self.mode == 'assemble':
+            return [f'{self._gen_fname_str(file_path)}.gtf']
+        return [f'{self._gen_fname_str(file_path)}.gtf', os.path.join(self.get_ctab_dir(file_path), CTAB_FILENAME)]
+
+    def get_cache_inputs(self, file_path) -> list:
+        # Samples are quantified again when the GTF changes e.g. a new merged GTF in run_workflow
+        if self.mode == 'quant' and os.path.exists(self.gtf_filepath):
+            return [file_path, self.gtf_filepath]
+        return super().get_cache_inputs(file_path)
+
+    def get_ctab_dir(self, file_path):
+        return os.path.join(self.ctab_filepath, self._get_filename(file_path).split(".")[0])
+
     def _gen_ctab_str(self, file_path):
-        dir_path = os.path.join(self.ctab_filepath, self._get_filename(file_path).split(".")[0])
-        os.mkdir(dir_path)
-        return dir_path
\ No newline at end of file
+        dir_path = self.get_ctab_dir(file_path)
+        # exist_ok so a re-run (or a dry run before it) doesn't fail on the directory of the last run
+        os.makedirs(dir_path, exist_ok=True)
+        return dir_path
+
+    def run_workflow(self, file_paths, merge_param_str='', scheduler=None, collate=True, nthreads=None) -> dict:
+        """
+        Assembles each BAM, merges the assemblies into one GTF (<output_dir>/assembly/<name>_MERGE_merged.gtf) and
+        then quantifies every BAM against the merged GTF (-e, ctab files to ctab_filepath), sharing the scheduler
+        between the jobs. param_str is used for the assembly and the quantification, merge_param_str for the merge.
+        Samples which fail to assemble are left out (with a warning). Returns the collated matrices (see collate)
+        unless collate is False or it is a dry run.
+        """
+        scheduler = scheduler or JobScheduler(max_cpus=self.nthreads or 1)
+        assembly_dir = os.path.join(self.output_dir, 'assembly')
+        if not self.dryrun:
+            os.makedirs(assembly_dir, exist_ok=True)
+        assemble = StringTie(self.data_dir, self.program_location, self.param_str, assembly_dir, self.gtf_filepath,
+                             self.ctab_filepath, self.file_ending, f'{self.name}_ASSEMBLE', self.dryrun, self.nthreads,
+                             mode='assemble')
+        merge = StringTie(self.data_dir, self.program_location, merge_param_str, assembly_dir, self.gtf_filepath,
+                          self.ctab_filepath, '.gtf', f'{self.name}_MERGE', self.dryrun, self.nthreads, mode='merge')
+        assemble.verbose = merge.verbose = self.verbose
+        jobs = assemble.run_per_file(file_paths, scheduler)
+        self.failed_jobs.extend(assemble.failed_jobs)
+        failed = [job for job in jobs if job.status != 'done']
+        if failed:
+            self.u.warn_p([f'Warning: {len(failed)} samples failed to assemble and are left out:\n',
+                           '\n'.join(job.name for job in failed)])
+        assembled = [f for f, job in zip(file_paths, jobs) if job.status == 'done']
+        if not assembled:
+            raise PipelineException('Error: StringTie failed to assemble every sample.')
+        gtfs = [assemble.get_output_files(f)[0] for f in assembled]
+        job = merge.run_per_file([gtfs], scheduler)[0]
+        if job.status != 'done':
+            raise PipelineException(f'Error: StringTie --merge failed:\n{job.error}')
+
+        # Re-quantify every sample against the merged transcripts (only estimating those, -e)
+        merged_gtf = merge.get_output_files(gtfs)[0]
+        flags = self.param_str.split()
+        quant_param_str = ' '.join(flags + ([] if '-e' in flags else ['-e']))
+        quant = StringTie(self.data_dir, self.program_location, quant_param_str, self.output_dir, merged_gtf,
+                          self.ctab_filepath, self.file_ending, f'{self.name}_QUANT', self.dryrun, self.nthreads)
+        quant.verbose = self.verbose
+        self.logfile.write(f'# Merged GTF: {merged_gtf}\n# Quantification param str: {quant_param_str}\n')
+        self.logfile.close()
+        jobs = quant.run_per_file(assembled, scheduler)
+        self.failed_jobs.extend(quant.failed_jobs)
+        if self.dryrun or not collate:
+            return None
+        quantified = [f for f, job in zip(assembled, jobs) if job.status == 'done']
+        if len(quantified) < len(assembled):
+            self.u.warn_p([f'Warning: {len(assembled) - len(quantified)} samples failed to quantify and are left out '
+                           f'of the matrices.'])
+        return self.collate(quantified, nthreads=nthreads)
+
+    def collate(self, file_paths, output_prefix=None, nthreads=None) -> dict:
+        """
+        Collates the ctab files of the quantified file_paths into transcript x sample FPKM, TPM and coverage matrices
+        (see collate_ctabs), written to <output_dir>/<name>_<FPKM|TPM|cov>.tsv by default. Samples are named after
+        their ctab directory.
+        """
+        ctab_paths = {os.path.basename(self.get_ctab_dir(f)): os.path.join(self.get_ctab_dir(f), CTAB_FILENAME)
+                      for f in file_paths}
+        if len(ctab_paths) < len(file_paths):
+            raise PipelineException('Error: several files have the same ctab directory (named by the filename up to '
+                                    'the first "."), their ctab files overwrite each other.')
+        output_prefix = output_prefix or os.path.join(self.output_dir, self.name)
+        matrices = collate_ctabs(ctab_paths, output_prefix, nthreads)
+        if self.verbose:
+            self.u.dp([f'Collated {len(ctab_paths)} samples ({len(matrices["FPKM"])} transcripts) into: '
+                       f'{output_prefix}_FPKM.tsv, _TPM.tsv and _cov.tsv'])
+        return matrices
+
+    def get_annotation(self) -> GTFIndex:
+        """ Parsed (and cached) index of the GTF, see scirnap.annotation. """
+        return GTFIndex.load(self.gtf_filepath)
+
+    def validate_annotation(self) -> bool:
+        """ Checks the GTF has exons with transcript ids, which StringTie needs for the reference (-G). """
+        index = self.get_annotation()
+        exons = index.feature_mask('exon')
+        if not exons.any() or (index.transcript_id[exons] < 0).all():
+            self.u.err_p([f'Error: the GTF {self.gtf_filepath} has no exons with a transcript_id.'])
+            return False
+        return True
+
+    def validate_inputs(self) -> bool:
+        return self.validate_annotation()
@@ -0,0 +1,149 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Trims and aligns each FASTQ (or pair) in one job, streaming the trimmed reads from cutadapt straight into hisat2 so the
+trimmed FASTQ is never compressed, written and read back. Single end reads are piped (cutadapt's stdout into
+hisat2 -U -), the mates of pairs go through FIFOs. Only the sorted BAM is written unless keep_trimmed is set, then
+the trimmed reads are teed out (compressed) to where Cutadapt would have written them.
+
+Every part of the job writes its exit code to a status file in the job's temp directory and the job only succeeds if
+all of them are 0, so a failed trim isn't hidden behind a (truncated) BAM. The FIFOs are set up so that neither
+program is left waiting forever on the other when one fails (or fails to start), see generate_cmd.
+"""
+
+import os
+
+from scirnap import BasePipeline, PipelineException
+from scirnap.cutadapt import Cutadapt
+from scirnap.hisat2 import Hisat2
+
+
+class TrimAlign(BasePipeline):
+
+    # Compresses the trimmed reads teed out with keep_trimmed
+    compress_cmd = 'gzip -1 -c'
+
+    def __init__(self, cutadapt: Cutadapt, hisat2: Hisat2, name='TRIMALIGN', keep_trimmed=False, dryrun=False,
+                 nthreads=None):
+        """
+        cutadapt, hisat2: the trimming and the alignment (param strings, threads, sort options, outputs) as they would
+                          be run as two stages. The BAMs are named and written as hisat2 would (in its output_dir).
+        keep_trimmed: also write the trimmed reads, to cutadapt's output files.
+        """
+        super().__init__(cutadapt.data_dir, hisat2.program_location, output_dir=hisat2.output_dir,
+                         file_ending=cutadapt.file_ending, name=name, dryrun=dryrun, nthreads=nthreads)
+        if cutadapt.s_or_p != hisat2.s_or_p:
+            self.u.err_p([f'Error: cutadapt and hisat2 have to both be single (s) or paired (p) end, got: '
+                          f'{cutadapt.s_or_p} and {hisat2.s_or_p}.'])
+            return
+        self.cutadapt, self.hisat2 = cutadapt, hisat2
+        self.keep_trimmed = keep_trimmed
+        self.paired = cutadapt.paired
+        self.mate_pattern = cutadapt.mate_pattern
+        self.params = {'Cutadapt param str': cutadapt.param_str, 'Hisat2 param str': hisat2.param_str,
+                       'Single or paired': cutadapt.s_or_p, 'Output dir': hisat2.output_dir,
+                       'Keep trimmed': keep_trimmed}
+        self.add_params_to_logfile()
+
+    @property
+    def program_version(self) -> str:
+        """ Versions of both programs, so cached jobs are re-run if either changes. """
+        if self._program_version is None:
+            self._program_version = f'{self.cutadapt.program_version}; {self.hisat2.program_version}'
+        return self._program_version
+
+    def get_output_files(self, filepath) -> list:
+        trimmed = self.cutadapt.get_output_files(filepath) if self.keep_trimmed else []
+        return self.hisat2.get_output_files(filepath) + trimmed
+
+    def get_job_resources(self, cmd=None) -> tuple:
+        """ Both programs run at once so the job needs the CPUs and memory of both (plus a CPU to compress). """
+        trim_cpus, trim_mem = self.cutadapt.get_job_resources()
+        align_cpus, align_mem = self.hisat2.get_job_resources()
+        cpus = self.cpus_per_job or trim_cpus + align_cpus + (1 if self.keep_trimmed else 0)
+        return cpus, trim_mem + align_mem
+
+    def get_tmp_dir(self, filepath) -> str:
+        """ Directory of the job's FIFOs and status files, on hisat2's tmp_dir if it has one. """
+        file_out = self.hisat2._gen_out_str(filepath)
+        tmp_dir = self.hisat2.tmp_dir or os.path.dirname(file_out)
+        return os.path.join(tmp_dir, f'{os.path.basename(file_out)}.trimalign')
+
+    def _gen_bg_str(self, cmd, tmp, status):
+        """ cmd run in the background, writing its exit code to the status file. Its pid is kept to kill it. """
+        return f'{{ {cmd}; echo $? > {tmp}/{status}; }} & pids="$pids $!"; '
+
+    def _gen_keep_str(self, fifo, trimmed_file, tmp, status):
+        """ Writes what is teed into the FIFO to the trimmed file (compressed if it ends in .gz). """
+        compress = self.compress_cmd if trimmed_file.endswith('.gz') else 'cat'
+        return self._gen_bg_str(f'{compress} < {fifo} > {trimmed_file}', tmp, status)
+
+    def generate_cmd(self, filepath):
+        """
+        Single end: cutadapt | [tee] | hisat2 -U - | samtools.
+
+        Paired end: cutadapt writes each mate to a FIFO which is relayed (by cat, or tee when the reads are kept) to
+        a second FIFO hisat2 reads, so it doesn't matter which order cutadapt and hisat2 open their FIFOs in. cutadapt's
+        FIFOs are opened by the shell before it starts so that if it fails before opening them hisat2 still sees EOF,
+        and if hisat2 fails the parts running in the background are killed rather than left writing to a FIFO no one
+        reads.
+        """
+        reads = list(filepath) if isinstance(filepath, (list, tuple)) else [filepath]
+        if self.paired and len(reads) != 2:
+            raise PipelineException(f'Error: paired end mode needs a pair of files (R1, R2), got: {filepath}. '
+                                    f'Use pair_files to pair them.')
+        tmp = self.get_tmp_dir(filepath)
+        file_out = self.hisat2._gen_out_str(filepath)
+        mkdir_str, sort_str = self.hisat2._gen_sort_str(file_out)
+        trimmed = self.cutadapt.get_output_files(filepath)
+        trim_str = f'{self.cutadapt.program_location} {self.cutadapt.param_str}'
+        align_str = f'{self.hisat2._gen_align_str()} --summary-file {file_out}_summary.txt ' \
+                    f'-x {self.hisat2.annotation_idx_dir}'
+        statuses, fifos, cmd = ['cutadapt', 'hisat2', 'sort'], [], ''
+        if self.keep_trimmed:
+            fifos += [f'{tmp}/R{i}.keep.fq' for i in range(1, len(reads) + 1)]
+            for i, trimmed_file in enumerate(trimmed, 1):
+                cmd += self._gen_keep_str(f'{tmp}/R{i}.keep.fq', trimmed_file, tmp, f'keep{i}')
+                statuses.append(f'keep{i}')
+        if not self.paired:
+            # cutadapt writes the trimmed reads (and its report to stderr) to stdout when it isn't given -o
+            tee_str = f'{{ tee {fifos[0]}; echo $? > {tmp}/relay1; }} | ' if self.keep_trimmed else ''
+            statuses += ['relay1'] if self.keep_trimmed else []
+            cmd += f'{{ {trim_str} {reads[0]} 2> {file_out}_cutadapt.txt; echo $? > {tmp}/cutadapt; }} | {tee_str}' \
+                   f'{{ {align_str} -U -; echo $? > {tmp}/hisat2; }} | '
+        else:
+            trim_fifos = [f'{tmp}/R{i}.fq' for i in (1, 2)]
+            align_fifos = [f'{tmp}/R{i}.align.fq' for i in (1, 2)]
+            fifos += trim_fifos + align_fifos
+            for i, (trim_fifo, align_fifo) in enumerate(zip(trim_fifos, align_fifos), 1):
+                relay = f'tee {tmp}/R{i}.keep.fq' if self.keep_trimmed else 'cat'
+                cmd += self._gen_bg_str(f'{relay} < {trim_fifo} > {align_fifo}', tmp, f'relay{i}')
+                statuses.append(f'relay{i}')
+            cmd += self._gen_bg_str(f'exec 3> {trim_fifos[0]} 4> {trim_fifos[1]}; '
+                                    f'{trim_str} -o {trim_fifos[0]} -p {trim_fifos[1]} {reads[0]} {reads[1]} '
+                                    f'> {file_out}_cutadapt.txt 2>&1', tmp, 'cutadapt')
+            cmd += f'{{ {align_str} -1 {align_fifos[0]} -2 {align_fifos[1]}; echo $? > {tmp}/hisat2; }} | '
+        cmd += f'{sort_str}; echo $? > {tmp}/sort; '
+        if fifos:
+            cmd = f'pids=""; {cmd}[ "$(cat {tmp}/hisat2)" = 0 ] || kill $pids 2> /dev/null; wait; '
+        # The job fails unless every part of it exited with 0
+        status_files = ' '.join(f'{tmp}/{s}' for s in statuses)
+        cmd += f'[ "$(cat {status_files} | tr -d \'\\n\')" = {"0" * len(statuses)} ]; status=$?; rm -rf {tmp}; ' \
+               f'[ $status -eq 0 ]'
+        mkdirs = [tmp] + ([self.cutadapt.output_dir] if self.keep_trimmed else [])
+        fifo_str = f' && mkfifo {" ".join(fifos)}' if fifos else ''
+        return f'{mkdir_str}rm -rf {tmp} && mkdir -p {" ".join(mkdirs)}{fifo_str} && {{ {cmd}; }}'
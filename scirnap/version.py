@@ -0,0 +1,118 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Process wide registry of program versions.
+
+`<program> --version` is only run the first time a version is needed and the result is kept for the rest of the
+process, keyed by the resolved path of the executable and its mtime (so an upgraded binary is probed again). Versions
+are also saved to versions.json in the scirnap cache directory so later runs don't need to probe at all.
+"""
+
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+from concurrent.futures import Future
+
+from scirnap.cache import get_cache_dir
+
+VERSION_TIMEOUT = 60  # Seconds to wait for --version before giving up
+
+_versions = {}  # Key -> Future of the version, so a program is probed once while the others are probed at the same time
+_lock = threading.Lock()
+_disk_lock = threading.Lock()
+
+
+def get_program_key(program_location: str) -> str:
+    """ The cmd together with the resolved path and mtime of its executable (the first word of the cmd). """
+    try:
+        executable = shlex.split(program_location)[0]
+    except (ValueError, IndexError):
+        return program_location
+    path = shutil.which(executable)
+    if path is None:
+        return program_location
+    path = os.path.realpath(path)
+    return f'{program_location}\t{path}\t{os.stat(path).st_mtime_ns}'
+
+
+def _get_versions_path() -> str:
+    return os.path.join(get_cache_dir(), 'versions.json')
+
+
+def _read_disk_cache() -> dict:
+    try:
+        with open(_get_versions_path(), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_disk_cache(key: str, version: str):
+    with _disk_lock:
+        versions = _read_disk_cache()
+        versions[key] = version
+        path = _get_versions_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.tmp{os.getpid()}'
+            with open(tmp_path, 'w') as f:
+                json.dump(versions, f, indent=1)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass  # The disk cache is only an optimisation
+
+
+def probe_version(program_location: str) -> str:
+    """ Runs <program> --version, some programs print their version to stderr so that is used if stdout is empty. """
+    try:
+        proc = subprocess.run(f'{program_location} --version', shell=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, timeout=VERSION_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return ''
+    if proc.returncode != 0:
+        return ''
+    return (proc.stdout or proc.stderr).decode(errors='replace').strip()
+
+
+def get_program_version(program_location: str, disk_cache=True) -> str:
+    """ Version of the program ('' if --version didn't return one), probed at most once per executable. """
+    key = get_program_key(program_location)
+    with _lock:
+        future = _versions.get(key)
+        probing = future is None
+        if probing:
+            future = _versions[key] = Future()
+    if not probing:
+        return future.result()  # Waits if another thread is still probing the same program
+    # Probed outside the lock so a slow --version doesn't hold up the versions of other programs
+    try:
+        version = _read_disk_cache().get(key) if disk_cache else None
+        if version is None:
+            version = probe_version(program_location)
+            # Only versions of programs we found on disk are kept, a missing program may be installed later
+            if disk_cache and version and key != program_location:
+                _write_disk_cache(key, version)
+    except Exception as e:
+        with _lock:
+            _versions.pop(key, None)  # The next call tries again
+        future.set_exception(e)
+        raise
+    future.set_result(version)
+    return version
@@ -0,0 +1,403 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Work queue in a shared directory, so the jobs of a pipeline can be run by workers on several nodes.
+
+The driver (a pipeline using QueueExecutor instead of running cmds itself) writes each cmd as a JSON file to
+<queue>/pending. Workers (scirnap worker --queue <queue>, any number, on any node which sees the directory) claim a
+job by renaming it into <queue>/leased, which only one of them can do. The leased file is the lease: the worker touches
+it (its mtime is the heartbeat) while the cmd runs, and a lease which hasn't been touched for lease_timeout seconds
+(the worker died or its node went away) is put back in pending by whichever worker sees it first. A worker which finds
+its lease gone (or replaced, by another worker claiming the re-queued job) kills the cmd. When the cmd exits the
+worker gives the lease up and writes the result to <queue>/done, where the driver picks it up.
+
+Every file is written to <queue>/tmp first and renamed into place so nobody reads a half written job or result. Cmds
+are run in the directory the driver was in, with the worker's environment (so the tools need to be on its PATH).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from sciutil import SciUtil
+
+from scirnap.executor import AsyncExecutor, CmdResult
+from scirnap.scheduler import Job, JobScheduler, parse_mem
+
+DIRS = ['pending', 'leased', 'done', 'tmp']
+STOP_FILENAME = 'STOP'
+
+
+class WorkQueue:
+
+    def __init__(self, queue_dir: str, lease_timeout=60.0, max_attempts=3):
+        """
+        lease_timeout: seconds without a heartbeat before a leased job is put back in the queue.
+        max_attempts: times a job is claimed (i.e. its worker was lost max_attempts - 1 times) before it fails.
+        """
+        self.queue_dir = queue_dir
+        self.lease_timeout, self.max_attempts = lease_timeout, max_attempts
+        for name in DIRS:
+            os.makedirs(os.path.join(queue_dir, name), exist_ok=True)
+
+    def _path(self, name: str, job_id: str) -> str:
+        return os.path.join(self.queue_dir, name, f'{job_id}.json')
+
+    def _write(self, path: str, record: dict):
+        tmp_path = os.path.join(self.queue_dir, 'tmp', f'{uuid.uuid4().hex}.json')
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read(path: str):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def submit(self, cmd: str, name=None, cpus=1, mem=0, cwd=None, stdout_path=None, stderr_path=None) -> str:
+        """ Queues the cmd, returns the job id. Ids sort in the order the jobs were submitted. """
+        job_id = f'{time.time_ns():020d}-{uuid.uuid4().hex[:8]}'
+        record = {'id': job_id, 'cmd': cmd, 'name': name or job_id, 'cpus': cpus, 'mem': mem,
+                  'cwd': cwd or os.getcwd(), 'stdout_path': stdout_path, 'stderr_path': stderr_path, 'attempts': 0,
+                  'submitted': time.time()}
+        self._write(self._path('pending', job_id), record)
+        return job_id
+
+    def claim(self, worker_id: str, max_cpus=None, max_mem=None):
+        """ Leases the oldest pending job that fits in max_cpus and max_mem (None for any), returns it or None. """
+        pending_dir = os.path.join(self.queue_dir, 'pending')
+        for filename in sorted(os.listdir(pending_dir)):
+            if not filename.endswith('.json'):
+                continue
+            record = self._read(os.path.join(pending_dir, filename))
+            if record is None:
+                continue
+            if (max_cpus is not None and record['cpus'] > max_cpus) or (max_mem is not None and
+                                                                         record['mem'] > max_mem):
+                continue
+            try:
+                # The lease starts now (a rename keeps the mtime of when it was queued), then only one rename wins
+                os.utime(os.path.join(pending_dir, filename))
+                os.rename(os.path.join(pending_dir, filename), self._path('leased', record['id']))
+            except FileNotFoundError:
+                continue  # Another worker claimed it
+            record['worker'] = worker_id
+            # The lease file is only ever renamed, a re-queued job is written to a new file (with another inode)
+            record['lease'] = self._get_lease(record['id'])
+            return record
+        return None
+
+    def _get_lease(self, job_id: str):
+        """ Inode of the lease file of the job, None if it isn't leased. """
+        try:
+            return os.stat(self._path('leased', job_id)).st_ino
+        except FileNotFoundError:
+            return None
+
+    def heartbeat(self, job_ids, leases=None) -> list:
+        """
+        Renews the leases of the jobs, returns the ids of any which were lost (expired and re-queued). leases are the
+        lease of each job as claimed (see claim), a lease held by another worker (which claimed the re-queued job) is
+        lost too.
+        """
+        lost = []
+        for job_id, lease in zip(job_ids, leases or [None] * len(job_ids)):
+            if lease is not None and self._get_lease(job_id) != lease:
+                lost.append(job_id)
+                continue
+            try:
+                os.utime(self._path('leased', job_id))
+            except FileNotFoundError:
+                lost.append(job_id)
+        return lost
+
+    def requeue_expired(self) -> list:
+        """ Puts jobs whose lease expired back in the queue (or fails them after max_attempts), returns their ids. """
+        leased_dir = os.path.join(self.queue_dir, 'leased')
+        now, requeued = time.time(), []
+        for filename in os.listdir(leased_dir):
+            path = os.path.join(leased_dir, filename)
+            try:
+                if now - os.stat(path).st_mtime < self.lease_timeout:
+                    continue
+                # Take the lease away first so that only one worker re-queues it
+                taken = os.path.join(self.queue_dir, 'tmp', f'{filename}.{uuid.uuid4().hex}')
+                os.rename(path, taken)
+            except FileNotFoundError:
+                continue
+            try:
+                record = self._read(taken)
+                if record is None:
+                    continue
+                record['attempts'] += 1
+                if record['attempts'] >= self.max_attempts:
+                    self._write(self._path('done', record['id']), {
+                        'id': record['id'], 'returncode': -1, 'started': None, 'finished': time.time(),
+                        'worker': record.get('worker'), 'error': f'the lease of the job expired {record["attempts"]} '
+                                                                 f'times (its worker was lost), giving up.'})
+                else:
+                    self._write(self._path('pending', record['id']), record)
+                requeued.append(record['id'])
+            finally:
+                # Only once the job is re-queued, so its new file can't reuse the inode of the lost lease (see claim)
+                os.remove(taken)
+        return requeued
+
+    def complete(self, record: dict, result: dict) -> bool:
+        """ Gives up the lease and writes the result, False (nothing written) if the lease was lost in the meantime. """
+        taken = os.path.join(self.queue_dir, 'tmp', f'{record["id"]}.done.{uuid.uuid4().hex}')
+        if record.get('lease') is not None and self._get_lease(record['id']) != record['lease']:
+            return False  # It has been re-queued and claimed by another worker
+        try:
+            os.rename(self._path('leased', record['id']), taken)
+        except FileNotFoundError:
+            return False  # It has been re-queued and will be run again
+        self._write(self._path('done', record['id']), {'id': record['id'], **result})
+        os.remove(taken)
+        return True
+
+    def get_result(self, job_id: str):
+        """ Result of the job (removed from the queue) or None if it hasn't finished. """
+        path = self._path('done', job_id)
+        result = self._read(path)
+        if result is not None:
+            os.remove(path)
+        return result
+
+    def get_counts(self) -> dict:
+        return {name: sum(1 for f in os.listdir(os.path.join(self.queue_dir, name)) if f.endswith('.json'))
+                for name in ['pending', 'leased', 'done']}
+
+    def stop(self):
+        """ Asks the workers to exit (once their running jobs are done), until resume is called. """
+        open(os.path.join(self.queue_dir, STOP_FILENAME), 'w').close()
+
+    def resume(self):
+        """ Lets workers run jobs from the queue again after stop. """
+        try:
+            os.remove(os.path.join(self.queue_dir, STOP_FILENAME))
+        except FileNotFoundError:
+            pass
+
+    def is_stopped(self) -> bool:
+        return os.path.exists(os.path.join(self.queue_dir, STOP_FILENAME))
+
+
+class QueueExecutor(AsyncExecutor):
+
+    def __init__(self, queue_dir: str, log_dir: str, poll_interval=1.0, lease_timeout=60.0, max_attempts=3):
+        """
+        Executor which sends each cmd to the work queue in queue_dir and waits for a worker to run it, set it as the
+        executor of a pipeline with BasePipeline.use_queue. The logs are written by the workers to log_dir (which has
+        to be on the shared storage too).
+        """
+        super().__init__(log_dir)
+        self.queue = WorkQueue(queue_dir, lease_timeout, max_attempts)
+        # A queue stopped at the end of an earlier run is used again
+        self.queue.resume()
+        self.poll_interval = poll_interval
+
+    async def run_cmd(self, cmd: str, job_name=None, cpus=1, mem=0) -> CmdResult:
+        os.makedirs(self.log_dir, exist_ok=True)
+        stdout_path, stderr_path = [os.path.abspath(path) for path in self.get_log_paths(job_name)]
+        job_id = self.queue.submit(cmd, job_name, cpus, mem, os.getcwd(), stdout_path, stderr_path)
+        result = self.queue.get_result(job_id)
+        while result is None:
+            await asyncio.sleep(self.poll_interval)
+            result = self.queue.get_result(job_id)
+        if result.get('error'):
+            with open(stderr_path, 'a') as f:
+                f.write(f'scirnap worker {result.get("worker")}: {result["error"]}\n')
+        cmd_result = CmdResult(cmd, result['returncode'], stdout_path, stderr_path, result['started'] or
+                               result['finished'], result['finished'])
+        for key, value in result.get('metrics', {}).items():
+            setattr(cmd_result, key, value)
+        cmd_result.worker = result.get('worker')
+        return cmd_result
+
+
+class Worker:
+
+    def __init__(self, queue_dir: str, cpus=None, mem=None, lease_timeout=60.0, poll_interval=1.0, worker_id=None,
+                 max_attempts=3, verbose=True):
+        """
+        Runs jobs from the work queue in queue_dir, as many at once as fit in cpus and mem (default the whole node).
+        lease_timeout has to be the same for every worker of a queue, the leases are renewed every poll_interval.
+        """
+        self.queue = WorkQueue(queue_dir, lease_timeout, max_attempts)
+        self.scheduler = JobScheduler(max_cpus=cpus, max_mem=mem)
+        # Each cmd in its own session, so that all of it is killed if its lease is lost
+        self.executor = AsyncExecutor(os.path.join(queue_dir, 'logs'), new_session=True)
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.running = {}
+        # The tasks running the cmds (cancelled if the lease is lost) and the ids of the jobs whose lease was lost
+        self.tasks, self.lost = {}, set()
+        self.completed, self.failed = 0, 0
+        self.verbose = verbose
+        self.u = SciUtil()
+        self._lock = threading.Lock()
+
+    def get_free(self) -> tuple:
+        """ CPU slots and memory not taken by the running jobs (jobs larger than the node are clamped to it). """
+        with self._lock:
+            records = list(self.running.values())
+        cpus = self.scheduler.max_cpus - sum(min(r['cpus'], self.scheduler.max_cpus) for r in records)
+        mem = self.scheduler.max_mem - sum(min(r['mem'], self.scheduler.max_mem) for r in records)
+        return cpus, mem
+
+    async def _run(self, record: dict):
+        stdout_path, stderr_path = record['stdout_path'], record['stderr_path']
+        if not stdout_path:
+            stdout_path, stderr_path = self.executor.get_log_paths(f'{record["name"]}-{record["id"]}')
+        result = {'worker': self.worker_id}
+        try:
+            os.makedirs(os.path.dirname(stdout_path) or '.', exist_ok=True)
+            task = asyncio.ensure_future(self.executor.run_cmd_to(record['cmd'], stdout_path, stderr_path,
+                                                                  record['cwd']))
+            with self._lock:
+                self.tasks[record['id']] = (asyncio.get_running_loop(), task)
+                if record['id'] in self.lost:
+                    task.cancel()
+            cmd_result = await task
+            metrics = cmd_result.get_metrics()
+            result.update({'returncode': cmd_result.returncode, 'started': cmd_result.started,
+                           'finished': cmd_result.finished,
+                           'metrics': {k: metrics[k] for k in ['user_time', 'sys_time', 'max_rss', 'read_bytes',
+                                                               'write_bytes']}})
+        except asyncio.CancelledError:
+            # The lease was lost and the cmd killed, it is another worker's job now
+            if self.verbose:
+                self.u.warn_p([f'Warning: lost the lease of {record["name"]} while it ran, it was stopped.'])
+            return None
+        except Exception as e:
+            result.update({'returncode': -1, 'started': None, 'finished': time.time(), 'error': f'{type(e).__name__}: '
+                                                                                               f'{e}'})
+        finally:
+            with self._lock:
+                self.tasks.pop(record['id'], None)
+        if not self.queue.complete(record, result):
+            if self.verbose:
+                self.u.warn_p([f'Warning: lost the lease of {record["name"]} while it ran, it has been re-queued.'])
+            return None
+        return result
+
+    def cancel(self, job_ids):
+        """ Kills the cmds of the jobs whose lease was lost, another worker may already be running them. """
+        with self._lock:
+            for job_id in job_ids:
+                self.lost.add(job_id)
+                loop, task = self.tasks.get(job_id, (None, None))
+                if task is not None:
+                    loop.call_soon_threadsafe(task.cancel)
+
+    def heartbeat(self):
+        """ Renews the leases of the running jobs, and stops any whose lease was lost. """
+        with self._lock:
+            records = list(self.running.values())
+        self.cancel(self.queue.heartbeat([r['id'] for r in records], [r.get('lease') for r in records]))
+
+    def _job_done(self, job: Job):
+        with self._lock:
+            self.running.pop(job.record['id'], None)
+            self.lost.discard(job.record['id'])
+            if job.status == 'done' and job.result is None:
+                return  # Lost, so not completed here
+            self.completed += 1
+            if job.status == 'failed' or job.result['returncode'] != 0:
+                self.failed += 1
+
+    def claim_jobs(self) -> int:
+        """ Claims queued jobs while they fit in what is free (or any one job if nothing is running). """
+        claimed = 0
+        while True:
+            cpus, mem = self.get_free()
+            idle = not self.running
+            if cpus <= 0 and not idle:
+                break
+            record = self.queue.claim(self.worker_id, None if idle else cpus, None if idle else mem)
+            if record is None:
+                break
+            job = Job(self._run, (record, ), name=record['name'], cpus=record['cpus'], mem=record['mem'])
+            job.record = record
+            job.add_done_callback(self._job_done)
+            with self._lock:
+                self.running[record['id']] = record
+            self.scheduler.submit(job)
+            claimed += 1
+        return claimed
+
+    def run(self, max_jobs=None, idle_timeout=None) -> int:
+        """
+        Runs jobs until the queue is stopped (WorkQueue.stop), max_jobs have been run or there has been nothing to
+        run for idle_timeout seconds. Returns the number of jobs run.
+        """
+        if self.verbose:
+            self.u.dp([f'Worker {self.worker_id} running jobs from {self.queue.queue_dir} with CPU budget: ',
+                       self.scheduler.max_cpus, 'memory budget: ', self.scheduler.max_mem])
+        last_busy = time.time()
+        while not self.queue.is_stopped():
+            self.heartbeat()
+            self.queue.requeue_expired()
+            if max_jobs is None or self.completed + len(self.running) < max_jobs:
+                self.claim_jobs()
+            if self.running:
+                last_busy = time.time()
+            elif max_jobs is not None and self.completed >= max_jobs:
+                break
+            elif idle_timeout is not None and time.time() - last_busy > idle_timeout:
+                break
+            time.sleep(self.poll_interval)
+        # Finish what is running (stopping doesn't give the leases up, the jobs would only be run again)
+        while self.running:
+            self.heartbeat()
+            time.sleep(self.poll_interval)
+        if self.verbose:
+            self.u.dp([f'Worker {self.worker_id} finished, ran {self.completed} jobs ({self.failed} failed).'])
+        return self.completed
+
+
+def main(args=None) -> int:
+    """ Runs a worker from the command line, returns the number of jobs which failed. """
+    parser = argparse.ArgumentParser(prog='scirnap worker', description='Run jobs from a scirnap work queue.')
+    parser.add_argument('--queue', type=str, required=True, help='Queue directory (shared by the driver and workers).')
+    parser.add_argument('--cpus', type=int, default=None, help='CPU slots for jobs (default all cores).')
+    parser.add_argument('--mem', type=str, default=None, help='Memory for jobs e.g. 64G (default all memory).')
+    parser.add_argument('--lease', type=float, default=60.0, help='Seconds without a heartbeat before a job is '
+                                                                  're-queued (the same for every worker).')
+    parser.add_argument('--poll', type=float, default=1.0, help='Seconds between checks of the queue.')
+    parser.add_argument('--attempts', type=int, default=3, help='Times a job whose worker was lost is tried.')
+    parser.add_argument('--max-jobs', type=int, default=None, help='Exit after running this many jobs.')
+    parser.add_argument('--idle-exit', type=float, default=None, help='Exit after this many seconds with no jobs.')
+    parser.add_argument('--id', type=str, default=None, help='Name of the worker (default host:pid).')
+    args = parser.parse_args(args)
+    worker = Worker(args.queue, args.cpus, parse_mem(args.mem) or None, args.lease, args.poll, args.id, args.attempts)
+    worker.run(args.max_jobs, args.idle_exit)
+    return worker.failed
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
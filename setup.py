@@ -46,6 +46,7 @@ setup(name='scirnap',
           ]
       },
       install_requires=['pandas', 'numpy', 'sciutil'],
+      extras_require={'sparse': ['scipy']},
       python_requires='>=3.6',
       data_files=[("", ["LICENSE"])]
       )
\ No newline at end of file
@@ -0,0 +1,100 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+"""
+Shared test fixtures: a TestCase that runs each test in its own temp directory, and stand in pipelines which run
+cheap shell cmds (cp, echo) in place of the real tools.
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from scirnap import BasePipeline
+
+
+class TmpDirTestCase(unittest.TestCase):
+    """ Each test runs in a new temp directory (the cwd), which also holds the scirnap cache (SCIRNAP_CACHE_DIR). """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='scirnap_tmp_')
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp_dir)
+        self.env = os.environ.get('SCIRNAP_CACHE_DIR')
+        os.environ['SCIRNAP_CACHE_DIR'] = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        if self.env is None:
+            del os.environ['SCIRNAP_CACHE_DIR']
+        else:
+            os.environ['SCIRNAP_CACHE_DIR'] = self.env
+        shutil.rmtree(self.tmp_dir)
+
+
+def write_files(n: int, data_dir='data', ending='.txt') -> list:
+    """ Writes data_dir/s0<ending> ... holding their own name (s0\\n ...), returns their paths. """
+    os.makedirs(data_dir, exist_ok=True)
+    files = []
+    for i in range(n):
+        files.append(os.path.join(data_dir, f's{i}{ending}'))
+        with open(files[-1], 'w') as f:
+            f.write(f's{i}\n')
+    return files
+
+
+def write_script(path: str, text: str):
+    """ Writes an executable script e.g. a fake tool. """
+    with open(path, 'w') as f:
+        f.write(text)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+class Copy(BasePipeline):
+    """
+    Stand in for a tool, copies each file into the output directory (after delay seconds). prefix: name the copies like
+    a real pipeline (<output_dir>/<name>_<filename>) rather than keeping the filename. runs counts the cmds it ran.
+    """
+
+    def __init__(self, data_dir, output_dir, name='copy', delay=0.0, prefix=True):
+        super().__init__(data_dir, 'cp', output_dir=output_dir, file_ending='.txt', name=name, verbose=False)
+        self.delay, self.prefix = delay, prefix
+        self.runs = 0
+
+    def generate_cmd(self, filepath):
+        cmd = f'cp {filepath} {self.get_output_files(filepath)[0]}'
+        return f'sleep {self.delay} && {cmd}' if self.delay else cmd
+
+    def get_output_files(self, filepath) -> list:
+        if self.prefix:
+            return [self._gen_fname_str(filepath)]
+        return [os.path.join(self.output_dir, self._get_filename(filepath))]
+
+    async def exec_cmd_async(self, cmd, job_name=None):
+        self.runs += 1
+        return await super().exec_cmd_async(cmd, job_name)
+
+
+class Echo(BasePipeline):
+    """ Stand in for a tool which writes to stdout and stderr and takes a moment. """
+
+    def __init__(self, data_dir):
+        super().__init__(data_dir, 'echo', file_ending='.txt', name='echo', verbose=False)
+
+    def generate_cmd(self, filepath):
+        return f'echo out {filepath} && echo err {filepath} 1>&2 && sleep 0.2'
@@ -0,0 +1,112 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+
+import numpy as np
+
+from scirnap import FeatureCounts, PipelineException, StringTie
+from scirnap import annotation
+from scirnap.annotation import GTFIndex
+from tests.helpers import TmpDirTestCase
+
+GTF = """#!genome-build test
+chr1\tsrc\tgene\t100\t900\t.\t+\t.\tgene_id "g2";
+chr1\tsrc\ttranscript\t100\t500\t.\t+\t.\tgene_id "g2"; transcript_id "t1";
+chr1\tsrc\texon\t100\t200\t.\t+\t.\tgene_id "g2"; transcript_id "t1";
+chr1\tsrc\texon\t300\t500\t.\t+\t.\tgene_id "g2"; transcript_id "t1";
+chr1\tsrc\texon\t600\t900\t.\t+\t.\tgene_id "g2"; transcript_id "t2";
+chr2\tsrc\tgene\t10\t50\t.\t-\t.\tgene_id "g1";
+chr2\tsrc\texon\t10\t50\t.\t-\t.\tgene_id "g1"; transcript_id "t3";
+"""
+
+
+class TestAnnotation(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        annotation._loaded.clear()
+        with open('test.gtf', 'w') as f:
+            f.write(GTF)
+
+    def tearDown(self):
+        annotation._loaded.clear()
+        super().tearDown()
+
+    def test_parse(self):
+        index = GTFIndex.parse('test.gtf', chunksize=2)
+        self.assertEqual(len(index), 7)
+        self.assertEqual(list(index.gene_ids), ['g2', 'g1'])
+        self.assertEqual(list(index.transcript_ids), ['t1', 't2', 't3'])
+        self.assertEqual(list(index.chroms), ['chr1', 'chr2'])
+        self.assertEqual(list(index.start[:3]), [100, 100, 100])
+        self.assertEqual(list(index.strand[-2:]), [-1, -1])
+        self.assertEqual(list(index.decode('transcript_id')[:2]), ['', 't1'])
+        self.assertEqual(list(index.get_gene_order('exon')), ['g2', 'g1'])
+        summary_df = index.gene_summary()
+        self.assertEqual(list(summary_df.index), ['g2', 'g1'])
+        self.assertEqual(summary_df.loc['g2', 'n_transcripts'], 2)
+        self.assertEqual(summary_df.loc['g2', 'end'], 900)
+        self.assertEqual(summary_df.loc['g1', 'chrom'], 'chr2')
+
+    def test_cache(self):
+        index = GTFIndex.load('test.gtf')
+        key = GTFIndex.get_key('test.gtf')
+        self.assertTrue(os.path.exists(os.path.join('cache', 'annotation', key, 'start.npy')))
+        # Memoized in the process
+        self.assertIs(GTFIndex.load('test.gtf'), index)
+        # Memory mapped from the cache in a new process
+        annotation._loaded.clear()
+        cached = GTFIndex.load('test.gtf')
+        self.assertIsInstance(cached.start, np.memmap)
+        self.assertEqual(list(cached.gene_ids), ['g2', 'g1'])
+        self.assertTrue(np.array_equal(cached.transcript_id, index.transcript_id))
+
+    def test_hash_in_attribute(self):
+        with open('hash.gtf', 'w') as f:
+            f.write(GTF + 'chr2\tsrc\texon\t60\t90\t.\t-\t.\tgene_id "g#3"; transcript_id "t#4";\n#end\n')
+        index = GTFIndex.parse('hash.gtf')
+        self.assertEqual(len(index), 8)
+        self.assertEqual(list(index.gene_ids), ['g2', 'g1', 'g#3'])
+        self.assertEqual(list(index.transcript_ids), ['t1', 't2', 't3', 't#4'])
+        self.assertEqual(index.end[-1], 90)
+
+    def test_key(self):
+        key = GTFIndex.get_key('test.gtf')
+        self.assertEqual(GTFIndex.get_key('test.gtf'), key)
+        # Same size and contents at either end, but it has been touched
+        stat = os.stat('test.gtf')
+        os.utime('test.gtf', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertNotEqual(GTFIndex.get_key('test.gtf'), key)
+
+    def test_tool_validation(self):
+        os.mkdir('data')
+        fc = FeatureCounts('data', 'featureCounts', '-F GTF -t exon -g gene_id', 'out', 'test.gtf', dryrun=True)
+        self.assertTrue(fc.validate_annotation())
+        fc.param_str = '-t CDS -g gene_id'
+        self.assertFalse(fc.validate_annotation())
+        st = StringTie('data', 'stringtie', '-e', 'out', 'test.gtf', 'ctab', dryrun=True)
+        self.assertTrue(st.validate_annotation())
+        # Checked before any job is submitted
+        fc = FeatureCounts('data', 'featureCounts', '-t CDS -g gene_id', 'out', 'test.gtf')
+        fc.u.err_p = lambda *args: None
+        with self.assertRaises(PipelineException):
+            fc.run_per_file([['data/a.bam']])
+        with self.assertRaisesRegex(PipelineException, 'failed validation'):
+            fc.run_on_files(['data/a.bam'])
+        with self.assertRaisesRegex(PipelineException, 'failed validation'):
+            fc.run_on_file(['data/a.bam'])
@@ -0,0 +1,74 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from benchmarks.run import compare, main, run_benchmarks
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Small enough to run with the tests, this only checks the benchmarks still run against the current code
+TINY = {'files': 4, 'discovery_files': 40, 'jobs': 4, 'e2e_files': 2, 'reads': 100, 'genes': 20, 'samples': 3,
+        'gtf_genes': 8, 'summaries': 4, 'cpus': 2, 'repeats': 1, 'latency': 0, 'output_size': 16}
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='scirnap_tmp_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run_benchmarks(self):
+        output = run_benchmarks(TINY, only=['cmd', 'discovery', 'parsing'], work_dir=self.tmp_dir)
+        results = output['results']
+        for name in ['cmd.hisat2_pe', 'cmd.stringtie', 'cmd.pool_merge_sorted', 'cmd.chunk', 'discovery.pair_files',
+                     'parsing.hisat2_summaries', 'parsing.multiqc_select']:
+            self.assertIn(name, results)
+            self.assertGreater(results[name]['median_s'], 0)
+        self.assertFalse([name for name in results if name.startswith('e2e')])
+        self.assertEqual(output['config']['files'], 4)
+        self.assertEqual(compare(output, output), [])
+
+    def test_end_to_end(self):
+        # Every pipeline on the fake tools, in its own process since the schedulers' threads outlive the runs
+        output_path = os.path.join(self.tmp_dir, 'e2e.json')
+        subprocess.run([sys.executable, '-m', 'benchmarks.run', '--only', 'e2e', '--config', json.dumps(TINY), '-o',
+                        output_path], check=True, cwd=ROOT_DIR, stderr=subprocess.DEVNULL)
+        with open(output_path) as f:
+            output = json.load(f)
+        self.assertIn('e2e.dag', output['results'])
+        self.assertIn('e2e.hisat2_se', output['results'])
+        self.assertEqual(output['results']['e2e.cutadapt_pe']['jobs'], 2)
+
+    def test_compare(self):
+        old = {'config': TINY, 'results': {'a': {'median_s': 1.0}, 'b': {'median_s': 1.0}}}
+        new = {'config': TINY, 'results': {'a': {'median_s': 1.5}, 'b': {'median_s': 1.05}, 'c': {'median_s': 1}}}
+        self.assertEqual(compare(new, old, threshold=0.1), ['a'])
+        old_path = os.path.join(self.tmp_dir, 'old.json')
+        with open(old_path, 'w') as f:
+            json.dump({'config': {}, 'results': {'discovery.pair_files': {'median_s': 1e-9}}}, f)
+        # Anything slower than the earlier results fails the run
+        with self.assertRaises(SystemExit):
+            main(['--only', 'discovery', '--quick', '--repeats', '1', '-o', os.path.join(self.tmp_dir, 'new.json'),
+                  '--compare', old_path])
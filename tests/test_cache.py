@@ -0,0 +1,69 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import time
+
+from scirnap.cache import RunCache, fingerprint, CACHE_FILENAME
+from tests.helpers import Copy, TmpDirTestCase, write_files
+
+
+class TestCache(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('out')
+        write_files(3)
+
+    def test_skip_completed(self):
+        cp = Copy('data', 'out')
+        cp.run_per_file(sorted(cp.get_files_in_dir()))
+        self.assertEqual(cp.runs, 3)
+        self.assertTrue(os.path.exists('out/copy_s0.txt'))
+        self.assertTrue(os.path.exists(os.path.join('out', CACHE_FILENAME)))
+
+        # Nothing changed so nothing is re-run
+        cp = Copy('data', 'out')
+        cp.run_per_file(sorted(cp.get_files_in_dir()))
+        self.assertEqual(cp.runs, 0)
+
+        # Changed input and a deleted output are re-run
+        time.sleep(0.01)
+        with open('data/s1.txt', 'w') as f:
+            f.write('changed\n')
+        os.remove('out/copy_s2.txt')
+        cp = Copy('data', 'out')
+        cp.run_per_file(sorted(cp.get_files_in_dir()))
+        self.assertEqual(cp.runs, 2)
+
+    def test_no_cache(self):
+        cp = Copy('data', 'out')
+        cp.run_per_file(['data/s0.txt'])
+        cp = Copy('data', 'out')
+        cp.use_cache = False
+        cp.run_per_file(['data/s0.txt'])
+        self.assertEqual(cp.runs, 1)
+
+    def test_key(self):
+        cache = RunCache('cache.jsonl', method='hash')
+        key = cache.get_key('data/s0.txt', b'1.0\n', 'cp a b')
+        self.assertEqual(key, cache.get_key(['data/s0.txt'], '1.0', 'cp a b'))
+        self.assertNotEqual(key, cache.get_key('data/s0.txt', b'1.1', 'cp a b'))
+        self.assertNotEqual(key, cache.get_key('data/s0.txt', b'1.0', 'cp a c'))
+        self.assertEqual(fingerprint('missing.txt')[1], None)
+        self.assertFalse(cache.add(key, 'cp a b', ['missing.txt']))
+        self.assertFalse(cache.is_complete(key))
@@ -0,0 +1,101 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import gzip
+import os
+
+from scirnap import BasePipeline, FastqChunk, JobScheduler, PipelineDAG, PipelineException, Pool
+from scirnap.chunk import split_fastq, get_chunk_source
+from tests.helpers import TmpDirTestCase
+
+
+def write_fastq(path, n_reads, mate='1'):
+    with gzip.open(path, 'wt') as f:
+        for i in range(n_reads):
+            f.write(f'@read{i}/{mate}\nACGT\n+\nIIII\n')
+
+
+def read_names(path):
+    with gzip.open(path, 'rt') as f:
+        return [line.split('/')[0] for line in f.readlines()[::4]]
+
+
+class PairedCount(BasePipeline):
+    """ Stand in for an aligner, writes the number of reads in a pair of chunks. """
+
+    paired = True
+
+    def __init__(self, data_dir, output_dir):
+        super().__init__(data_dir, 'echo', output_dir=output_dir, name='count', verbose=False)
+
+    def generate_cmd(self, file_pair):
+        return f'zcat {file_pair[0]} | wc -l > {self.get_output_files(file_pair)[0]}'
+
+    def get_output_files(self, file_pair) -> list:
+        return [f'{self._gen_fname_str(self.get_pair_name(file_pair))}.bam']
+
+
+class TestChunk(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for d in ['data', 'chunks', 'aligned']:
+            os.mkdir(d)
+        write_fastq('data/s1_R1.fq.gz', 1005, '1')
+        write_fastq('data/s1_R2.fq.gz', 1005, '2')
+
+    def test_split(self):
+        chunks = split_fastq('data/s1_R1.fq.gz', 'chunks', 4, batch_size=10)
+        self.assertEqual(chunks[1], 'chunks/s1_R1.chunk001.fq.gz')
+        names = [read_names(c) for c in chunks]
+        # Balanced to within a batch and every read is in exactly one chunk
+        self.assertEqual([len(n) for n in names], [255, 250, 250, 250])
+        self.assertEqual(sorted(n for chunk_names in names for n in chunk_names),
+                         sorted(f'@read{i}' for i in range(1005)))
+
+    def test_split_pairs(self):
+        pairs = split_fastq('data/s1_R1.fq.gz', 'chunks', 3, 'data/s1_R2.fq.gz', batch_size=7)
+        self.assertEqual(pairs[0], ('chunks/s1_R1.chunk000.fq.gz', 'chunks/s1_R2.chunk000.fq.gz'))
+        for r1, r2 in pairs:
+            self.assertEqual(read_names(r1), read_names(r2))
+
+    def test_bad_fastq(self):
+        with gzip.open('data/bad.fq.gz', 'wt') as f:
+            f.write('@read0\nACGT\n+\nIIII\n@read1\nACGT\n')
+        with self.assertRaises(PipelineException):
+            split_fastq('data/bad.fq.gz', 'chunks', 2)
+        write_fastq('data/s2_R2.fq.gz', 10, '2')
+        with self.assertRaises(PipelineException):
+            split_fastq('data/s1_R1.fq.gz', 'chunks', 2, 'data/s2_R2.fq.gz')
+
+    def test_chunk_dag(self):
+        # Each pair of chunks is aligned as its own job, then the BAMs are grouped back by the FASTQ they came from
+        dag = PipelineDAG(JobScheduler(max_cpus=4), verbose=False)
+        chunker = FastqChunk('data', 'chunks', 4, 'p', batch_size=50)
+        chunker.verbose = False
+        dag.add_stage('chunk', chunker)
+        dag.add_stage('align', PairedCount('chunks', 'aligned'), after='chunk')
+        jobs = dag.run()
+        self.assertEqual([job.status for job in jobs['chunk']], ['done'])
+        self.assertEqual(sorted(job.status for job in jobs['align']), ['done'] * 4)
+        bams = sorted(f for job in jobs['align'] for f in job.stage.pipeline.get_output_files(job.file_path))
+        self.assertEqual(bams[0], 'aligned/count_CHUNK_s1.chunk000.fq.gz.bam')
+        pool = Pool('aligned', 'samtools', 'merged', merge_sorted=True, dryrun=True)
+        groups = pool.group_chunks(bams)
+        self.assertEqual(groups, [bams])
+        self.assertEqual(pool.get_output_files(bams), ['merged/count_CHUNK_s1.fq.gz.sorted.bam'])
+        self.assertEqual(get_chunk_source('x/HISAT2_s1.chunk012.fq.gz.sorted.bam'), 'HISAT2_s1.fq.gz')
@@ -20,7 +20,12 @@ import shutil
 import tempfile
 import unittest
 
-from scirnap import Cutadapt
+import pandas as pd
+
+from scirnap import Cutadapt, PipelineException
+from scirnap.cutadapt import QCSelector
+from tests.helpers import TmpDirTestCase
+
 
 class TestCutadapt(unittest.TestCase):
 
@@ -52,3 +57,69 @@ class TestCutadapt(unittest.TestCase):
         # Run dryrun
         cu.run_per_file(files)
 
+
+
+class TestCutadaptPaired(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('data')
+        os.mkdir('trimmed')
+        for sample in ['s1', 's2']:
+            for mate in ['1', '2']:
+                with open(f'data/{sample}_R{mate}.fq.gz', 'w') as f:
+                    f.write(f'{sample} {mate}\n')
+        # Fake cutadapt which copies the mates to -o and -p
+        with open('cutadapt', 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'while [ $# -gt 2 ]; do case $1 in -o) o=$2; shift;; -p) p=$2; shift;; esac; shift; done\n'
+                    'cp $1 $o && cp $2 $p\n')
+        os.chmod('cutadapt', 0o755)
+
+    def test_paired_cmd(self):
+        cu = Cutadapt('data', './cutadapt', '-q 20', None, 'trimmed', 'p', nthreads=2)
+        self.assertTrue(cu.paired)
+        pairs = cu.pair_files(cu.get_files_in_dir())
+        self.assertEqual(pairs, [('data/s1_R1.fq.gz', 'data/s1_R2.fq.gz'), ('data/s2_R1.fq.gz', 'data/s2_R2.fq.gz')])
+        self.assertEqual(cu.generate_cmd(pairs[0]), './cutadapt -q 20 -o trimmed/CUTADAPT_s1_R1.fq.gz '
+                                                    '-p trimmed/CUTADAPT_s1_R2.fq.gz data/s1_R1.fq.gz data/s1_R2.fq.gz')
+        jobs = cu.run_per_file(pairs)
+        # One job per pair
+        self.assertEqual([job.status for job in jobs], ['done', 'done'])
+        with open('trimmed/CUTADAPT_s2_R2.fq.gz') as f:
+            self.assertEqual(f.read(), 's2 2\n')
+
+
+class TestQCSelector(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        flags = ['pass', 'warn', 'fail']
+        pd.DataFrame({'Sample': [f's{i}' for i in range(10000)],
+                      'Filename': [f's{i}.fq.gz' for i in range(10000)],
+                      'Total Sequences': [i * 100 for i in range(10000)],
+                      'adapter_content': [flags[i % 3] for i in range(10000)],
+                      'per_base_n_content': [flags[(i // 3) % 3] for i in range(10000)],
+                      'overrepresented_sequences': ['pass'] * 9999 + ['fail']}
+                     ).to_csv('multiqc_fastqc.txt', sep='\t', index=False)
+
+    def test_get_qc_files(self):
+        cu = Cutadapt('data', 'cutadapt', '', 'multiqc_fastqc.txt', 'trimmed', 's')
+        self.assertEqual(cu.get_qc_files('overrepresented_sequences'), ['data/s9999.fq.gz'])
+        # Fail on any of the metrics
+        files = cu.get_qc_files(['adapter_content', 'per_base_n_content', 'overrepresented_sequences'])
+        self.assertEqual(files[:4], ['data/s2.fq.gz', 'data/s5.fq.gz', 'data/s6.fq.gz', 'data/s7.fq.gz'])
+        self.assertEqual(len(cu.get_qc_files(['adapter_content', 'per_base_n_content'], ['warn', 'fail'], 'all')),
+                         4444)
+        self.assertIsNone(cu.get_qc_files('not_a_metric'))
+        self.assertIsNone(cu.get_qc_files('adapter_content', 'bad'))
+
+    def test_selector(self):
+        selector = QCSelector('multiqc_fastqc.txt', 'data')
+        # The table is only read once
+        self.assertIs(QCSelector('multiqc_fastqc.txt').multiqc_df, selector.multiqc_df)
+        self.assertEqual(str(selector.multiqc_df['adapter_content'].dtype), 'category')
+        self.assertEqual(selector.query("adapter_content == 'fail' and `Total Sequences` < 1000"),
+                         ['data/s2.fq.gz', 'data/s5.fq.gz', 'data/s8.fq.gz'])
+        with self.assertRaises(PipelineException):
+            selector.select('not_a_metric')
@@ -0,0 +1,116 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+from unittest import mock
+
+from scirnap import BasePipeline, JobScheduler, PipelineDAG, PipelineException
+from tests.helpers import Copy, TmpDirTestCase, write_files
+
+
+class Concat(BasePipeline):
+
+    def __init__(self, data_dir, output_dir):
+        super().__init__(data_dir, 'cat', output_dir=output_dir, file_ending='.txt', name='concat', verbose=False)
+
+    def generate_cmd(self, file_paths):
+        return f'cat {" ".join(sorted(file_paths))} > {self.get_output_files(file_paths)[0]}'
+
+    def get_output_files(self, file_paths) -> list:
+        return [os.path.join(self.output_dir, 'all.txt')]
+
+
+class TestDAG(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for d in ['trim', 'align', 'counts']:
+            os.mkdir(d)
+        write_files(4)
+
+    def test_streaming_stages(self):
+        dag = PipelineDAG(JobScheduler(max_cpus=2), verbose=False)
+        dag.add_stage('trim', Copy('data', 'trim', 'trim', delay=0.2, prefix=False))
+        dag.add_stage('align', Copy('trim', 'align', 'align', delay=0.2, prefix=False), after='trim')
+        dag.add_stage('counts', Concat('align', 'counts'), after='align', mode='all')
+        jobs = dag.run(sorted(Copy('data', 'trim', 'x', prefix=False).get_files_in_dir()))
+        self.assertEqual(len(jobs['trim']), 4)
+        self.assertEqual(len(jobs['align']), 4)
+        self.assertEqual(len(jobs['counts']), 1)
+        with open('counts/all.txt') as f:
+            self.assertEqual(f.read(), 's0\ns1\ns2\ns3\n')
+        # The first sample is aligned while the last one is still being trimmed
+        first_align = min(j.started for j in jobs['align'])
+        last_trim = max(j.finished for j in jobs['trim'])
+        self.assertLess(first_align, last_trim)
+
+    def test_staged_stage(self):
+        align = Copy('trim', 'align', 'align', prefix=False)
+        align.use_staging('scratch')
+        stager = align.stager
+        dag = PipelineDAG(JobScheduler(max_cpus=2), verbose=False)
+        dag.add_stage('trim', Copy('data', 'trim', 'trim', prefix=False))
+        dag.add_stage('align', align, after='trim')
+        with mock.patch.object(stager, 'plan', wraps=stager.plan) as plan:
+            jobs = dag.run(sorted(Copy('data', 'trim', 'x', prefix=False).get_files_in_dir()))
+        self.assertTrue(all(job.status == 'done' for job in jobs['align']))
+        # Each align job's input is planned for prefetch as it is submitted
+        self.assertEqual(sorted(call.args[0][0][0] for call in plan.call_args_list),
+                         [f'trim/s{i}.txt' for i in range(4)])
+        self.assertEqual(stager.copied_in, 4)
+        with open('align/s3.txt') as f:
+            self.assertEqual(f.read(), 's3\n')
+
+    def test_failed_submit(self):
+        align = Copy('trim', 'align', 'align', prefix=False)
+        align.generate_cmd = lambda f: 1 / 0
+        dag = PipelineDAG(JobScheduler(max_cpus=2), verbose=False)
+        dag.scheduler.u.err_p = lambda *args: None
+        dag.add_stage('trim', Copy('data', 'trim', 'trim', prefix=False))
+        dag.add_stage('align', align, after='trim')
+        dag.add_stage('counts', Concat('align', 'counts'), after='align', mode='all')
+        # The align jobs can't be made, the run still finishes rather than waiting on them
+        jobs = dag.run(sorted(Copy('data', 'trim', 'x', prefix=False).get_files_in_dir()))
+        self.assertEqual(len(jobs['trim']), 4)
+        self.assertEqual(jobs['align'], [])
+        self.assertEqual(jobs['counts'], [])
+
+    def test_group_stage(self):
+        dag = PipelineDAG(JobScheduler(max_cpus=4), verbose=False)
+        dag.add_stage('trim', Copy('data', 'trim', 'trim', prefix=False))
+        dag.add_stage('pool', Concat('trim', 'counts'), after='trim', mode='group',
+                      group_fn=lambda files: [files])
+        jobs = dag.run(['data/s0.txt', 'data/s1.txt'])
+        self.assertEqual(len(jobs['pool']), 1)
+        self.assertTrue(os.path.exists('counts/all.txt'))
+
+    def test_failed_group_fn(self):
+        def group_fn(files):
+            raise ValueError('no sample sheet')
+
+        dag = PipelineDAG(JobScheduler(max_cpus=4), verbose=False)
+        dag.u.err_p = lambda *args: None
+        dag.add_stage('trim', Copy('data', 'trim', 'trim', prefix=False))
+        dag.add_stage('pool', Concat('trim', 'pool'), after='trim', mode='group', group_fn=group_fn)
+        dag.add_stage('counts', Concat('pool', 'counts'), after='pool', mode='all')
+        # The stages downstream of the group are given up on, and run raises rather than waiting for them
+        with self.assertRaisesRegex(PipelineException, 'pool failed to submit its jobs: no sample sheet'):
+            dag.run(['data/s0.txt', 'data/s1.txt'])
+        self.assertTrue(all(stage.finished for stage in dag.stages.values()))
+        self.assertEqual(len(dag.stages['trim'].jobs), 2)
+        self.assertEqual(dag.stages['pool'].jobs, [])
+        self.assertEqual(dag.stages['counts'].jobs, [])
@@ -0,0 +1,112 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import re
+import unittest
+
+from scirnap import BasePipeline
+from scirnap.discovery import FileManifest, find_files, get_mate, pair_files, MANIFEST_FILENAME
+from tests.helpers import TmpDirTestCase
+
+
+class TestDiscovery(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.makedirs('data/run1')
+        os.makedirs('data/.hidden')
+        for path in ['data/s1_R1.fq.gz', 'data/s1_R2.fq.gz', 'data/s1_R1.fq.gz.md5', 'data/s2.fq',
+                     'data/run1/s3_R1.fq.gz', 'data/.hidden/s4_R1.fq.gz']:
+            with open(path, 'w') as f:
+                f.write('@r\nACGT\n+\nIIII\n')
+        self.make_old('data')
+        self.make_old('data/run1')
+
+
+    @staticmethod
+    def make_old(path):
+        # So the directory isn't treated as having changed just after it was listed
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - 60 * 10 ** 9))
+
+    def test_file_ending(self):
+        pipeline = BasePipeline('data', 'echo', file_ending='.fq', name='fq', logfile='log.txt', verbose=False)
+        # Sidecars like .md5 files are no longer picked up
+        self.assertEqual(pipeline.get_files_in_dir(), ['data/s1_R1.fq.gz', 'data/s1_R2.fq.gz', 'data/s2.fq'])
+        self.assertEqual(pipeline.get_files_in_dir(recursive=True),
+                         ['data/run1/s3_R1.fq.gz', 'data/s1_R1.fq.gz', 'data/s1_R2.fq.gz', 'data/s2.fq'])
+        pipeline.logfile.close()
+
+    def test_patterns(self):
+        self.assertEqual(find_files('data', '*_R1.fq.gz', recursive=True), ['data/run1/s3_R1.fq.gz',
+                                                                            'data/s1_R1.fq.gz'])
+        self.assertEqual(find_files('data', 'run1/*', recursive=True), ['data/run1/s3_R1.fq.gz'])
+        self.assertEqual(find_files('data', re.compile(r'_R\d\.fq\.gz$')), ['data/s1_R1.fq.gz', 'data/s1_R2.fq.gz'])
+
+    def test_manifest(self):
+        manifest = FileManifest('manifest.json')
+        files = manifest.scan('data', recursive=True)
+        manifest.save()
+        self.assertEqual(manifest.listed, 2)
+        self.assertEqual(files['run1/s3_R1.fq.gz'][0], os.path.getsize('data/run1/s3_R1.fq.gz'))
+
+        # Unchanged directories are taken from the manifest
+        manifest = FileManifest('manifest.json')
+        self.assertEqual(manifest.scan('data', recursive=True), files)
+        self.assertEqual((manifest.listed, manifest.reused), (0, 2))
+
+        # Adding a file only lists the directory it was added to
+        with open('data/run1/s5_R1.fq.gz', 'w') as f:
+            f.write('@r\n')
+        manifest = FileManifest('manifest.json')
+        self.assertIn('run1/s5_R1.fq.gz', manifest.scan('data', recursive=True))
+        self.assertEqual((manifest.listed, manifest.reused), (1, 1))
+        manifest.save()
+
+        # The manifest is only written again when a directory changed (not when one changed just now is listed again)
+        os.utime('manifest.json', ns=(0, 0))
+        find_files('data', '*', recursive=True, manifest_path='manifest.json')
+        self.assertEqual(os.stat('manifest.json').st_mtime_ns, 0)
+        self.make_old('data/run1')
+        find_files('data', '*', recursive=True, manifest_path='manifest.json')
+        self.assertNotEqual(os.stat('manifest.json').st_mtime_ns, 0)
+
+    def test_pipeline_manifest(self):
+        pipeline = BasePipeline('data', 'echo', output_dir='out', file_ending='.fq.gz', name='fq',
+                                logfile='log.txt', verbose=False)
+        files = pipeline.get_files_in_dir(use_manifest=True)
+        self.assertTrue(os.path.exists(os.path.join('out', MANIFEST_FILENAME)))
+        self.assertEqual(pipeline.get_files_in_dir(use_manifest=True), files)
+        os.remove('data/s1_R2.fq.gz')
+        self.assertEqual(pipeline.get_files_in_dir(use_manifest=True), ['data/s1_R1.fq.gz'])
+        pipeline.logfile.close()
+
+
+class TestPairing(unittest.TestCase):
+
+    def test_pair_files(self):
+        files = ['d/s2_R2.fq.gz', 'd/s1_R1.fq.gz', 'd/s1_R2.fq.gz', 'd/s2_R1.fq.gz', 'd/s3_R1.fq.gz', 'd/notes.fq.gz']
+        pairs, unpaired = pair_files(files)
+        self.assertEqual(pairs, [('d/s1_R1.fq.gz', 'd/s1_R2.fq.gz'), ('d/s2_R1.fq.gz', 'd/s2_R2.fq.gz')])
+        self.assertEqual(unpaired, ['d/notes.fq.gz', 'd/s3_R1.fq.gz'])
+
+    def test_naming(self):
+        self.assertEqual(get_mate('d/S1_L001_R2_001.fastq.gz'), ('2', 'd/S1_L001_001.fastq.gz'))
+        self.assertEqual(get_mate('s_R1_1.fq'), ('1', 's_R1.fq'))  # The last match is the mate
+        pairs, unpaired = pair_files(['a.1.fq', 'a.2.fq'], mate_pattern=r'\.([12])(?=\.fq)')
+        self.assertEqual(pairs, [('a.1.fq', 'a.2.fq')])
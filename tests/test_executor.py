@@ -0,0 +1,90 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import threading
+
+from scirnap import Job, JobScheduler, PipelineException
+from scirnap.executor import AsyncExecutor
+from scirnap.metrics import read_metrics
+from tests.helpers import Echo, TmpDirTestCase
+
+
+class TestExecutor(TmpDirTestCase):
+
+    def test_stream_to_logs(self):
+        result = AsyncExecutor('logs').run('echo hello && echo oops 1>&2 && exit 3', 'job:1')
+        self.assertEqual(result.returncode, 3)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.stdout_path, os.path.join('logs', 'job_1.stdout'))
+        with open(result.stdout_path) as f:
+            self.assertEqual(f.read(), 'hello\n')
+        with open(result.stderr_path) as f:
+            self.assertEqual(f.read(), 'oops\n')
+
+    def test_many_jobs_few_threads(self):
+        echo = Echo('.')
+        files = [f'f{i}.txt' for i in range(200)]
+        threads = []
+        sched = JobScheduler(max_cpus=200)
+        # Sample the number of threads while every job is running
+        probe = Job(lambda: threads.append(threading.active_count()))
+        jobs = [Job(echo._exec_job, (f, echo.generate_cmd(f)), name=f) for f in files]
+        for job in jobs:
+            sched.submit(job)
+        jobs[0].wait(0.1)
+        sched.run([probe])
+        for job in jobs:
+            job.wait()
+        self.assertTrue(all(job.status == 'done' for job in jobs))
+        self.assertLess(threads[0], 20)
+        with open(jobs[10].result.stderr_path) as f:
+            self.assertEqual(f.read(), 'err f10.txt\n')
+
+    def test_failed_cmd(self):
+        echo = Echo('.')
+        with self.assertRaises(PipelineException):
+            echo.exec_cmd('exit 1')
+        job = JobScheduler(max_cpus=1).run([Job(echo._exec_job, ('a.txt', 'false'))])[0]
+        self.assertEqual(job.status, 'failed')
+
+    def test_failed_pipe(self):
+        # The last process in the pipe succeeds but the one feeding it doesn't, so the job fails and isn't cached
+        self.assertEqual(AsyncExecutor('logs').run('echo reads | (cat; exit 3) | cat > out.bam').returncode, 3)
+        for _ in range(2):
+            echo = Echo('.')
+            echo.get_output_files = lambda f: [f'{f}.bam']
+            echo.generate_cmd = lambda f: f'(echo {f}; exit 1) | sort > {f}.bam'
+            self.assertEqual(echo.run_per_file(['a.txt'])[0].status, 'failed')
+            self.assertTrue(os.path.exists('a.txt.bam'))
+            self.assertEqual(echo.get_journal().get_state(echo.generate_cmd('a.txt')), 'failed')
+
+    def test_pipe_metrics(self):
+        # The rusage covers every process in the pipe, the python reader holds ~50MB
+        cmd = 'head -c 50000000 /dev/zero | python -c "import sys; d = sys.stdin.buffer.read(); print(len(d))"'
+        echo = Echo('.')
+        echo.exec_cmd(cmd, 'pipe')
+        metrics_df = read_metrics(echo.metrics.metrics_path)
+        self.assertEqual(len(metrics_df), 1)
+        row = metrics_df.iloc[0]
+        self.assertEqual(row['job'], 'pipe')
+        self.assertEqual(row['returncode'], 0)
+        self.assertGreater(row['max_rss'], 50000000)
+        self.assertGreater(row['user_time'] + row['sys_time'], 0)
+        self.assertGreaterEqual(row['wall_time'], 0)
+        for col in ['read_bytes', 'write_bytes', 'cpus', 'mem', 'started', 'finished']:
+            self.assertIn(col, metrics_df.columns)
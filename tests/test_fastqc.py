@@ -15,12 +15,17 @@
 #                                                                             #
 ###############################################################################
 
+import gzip
 import os
 import shutil
 import tempfile
 import unittest
 
-from scirnap import FastQC
+import numpy as np
+
+from scirnap import FastQC, Cutadapt
+from scirnap.fastqc import scan_fastq
+from tests.helpers import TmpDirTestCase
 
 class TestFastQC(unittest.TestCase):
 
@@ -48,3 +53,52 @@ class TestFastQC(unittest.TestCase):
                       dryrun=False, nthreads=5)
         files = fqc.get_files_in_dir()
         fqc.run_per_file(files)
+
+
+class TestNativeQC(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('data')
+        # Good reads: 100 reads of 8 bases, half GC, all quality I (40)
+        with gzip.open('data/good.fq.gz', 'wt') as f:
+            for i in range(100):
+                f.write(f'@read{i}\nACGTACGT\n+\nIIIIIIII\n')
+        # Bad reads: different lengths, quality 5 (&) at the end and an N in the last base of every read
+        with open('data/bad.fastq', 'w') as f:
+            for i in range(50):
+                f.write(f'@read{i}\nGGGGN\n+\nIII&&\n@read{i}b\nGGN\n+\nI&&\n')
+
+    def test_scan(self):
+        summary, stats = scan_fastq('data/good.fq.gz', batch_size=30)
+        self.assertEqual(summary['Total Sequences'], 100)
+        self.assertEqual(summary['Sequence length'], '8')
+        self.assertEqual(summary['%GC'], 50)
+        self.assertEqual(summary['per_base_sequence_quality'], 'pass')
+        self.assertTrue(np.allclose(stats.mean_quality, 40))
+
+        summary, stats = scan_fastq('data/bad.fastq')
+        self.assertEqual(summary['Sequence length'], '3-5')
+        self.assertEqual(summary['sequence_length_distribution'], 'warn')
+        self.assertEqual(summary['per_base_n_content'], 'fail')
+        self.assertEqual(summary['per_base_sequence_quality'], 'fail')
+        self.assertEqual(list(stats.position_counts), [100, 100, 100, 50, 50])
+        self.assertEqual(list(stats.n_rate), [0, 0, 0.5, 0, 1])
+        self.assertEqual(summary['avg_sequence_length'], 4)
+
+    def test_sampling(self):
+        summary, stats = scan_fastq('data/bad.fastq', max_reads=10)
+        self.assertEqual((summary['Total Sequences'], summary['sampled_sequences']), (10, 10))
+        summary, stats = scan_fastq('data/bad.fastq', max_reads=20, sample='reservoir', batch_size=7)
+        self.assertEqual((summary['Total Sequences'], summary['sampled_sequences']), (100, 20))
+        # A uniform sample has both read lengths
+        self.assertEqual(summary['Sequence length'], '3-5')
+
+    def test_multiqc_table(self):
+        fqc = FastQC('data', 'fastqc', 'qc', file_ending='fq')
+        fqc.verbose = False
+        summary_df = fqc.run_native(['data/bad.fastq', 'data/good.fq.gz'], nprocesses=2)
+        self.assertEqual(list(summary_df['Sample']), ['bad', 'good'])
+        # The table can be used to select files like a MultiQC report
+        cu = Cutadapt('data/', 'cutadapt', '', 'qc/multiqc_fastqc.txt', 'trimmed', 's')
+        self.assertEqual(cu.get_qc_files('per_base_n_content', 'fail'), ['data/bad.fastq'])
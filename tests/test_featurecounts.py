@@ -17,10 +17,17 @@
 
 import os
 import shutil
+import stat
+import sys
 import tempfile
 import unittest
 
-from scirnap import FeatureCounts
+import numpy as np
+
+from scirnap import FeatureCounts, JobScheduler, PipelineException
+from scirnap import annotation
+from scirnap.featurecounts import load_counts
+from tests.helpers import TmpDirTestCase
 
 
 class TestFeatureCounts(unittest.TestCase):
@@ -53,3 +60,146 @@ class TestFeatureCounts(unittest.TestCase):
         files = cu.get_files_in_dir()
         # Run dryrun
         cu.run_on_files(files)
+
+
+def write_counts(path, genes, samples, counts):
+    with open(path, 'w') as f:
+        f.write('# Program:featureCounts v2.0.1; Command:"featureCounts" "-a" "test.gtf"\n')
+        f.write('\t'.join(['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length'] + samples) + '\n')
+        for i, gene in enumerate(genes):
+            row = [gene, '1;1', '100;300', '200;500', '+;+', '302'] + [str(c) for c in counts[i]]
+            f.write('\t'.join(row) + '\n')
+
+
+class TestLoadCounts(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.counts_path = os.path.join(self.tmp_dir, 'counts.txt')
+        self.counts = np.random.RandomState(0).poisson(0.5, size=(25, 4)).astype(np.int32)
+        self.genes = [f'g{i}' for i in range(25)]
+        self.samples = [f'data/s{i}.bam' for i in range(4)]
+        write_counts(self.counts_path, self.genes, self.samples, self.counts)
+
+    def test_dense(self):
+        matrix = load_counts(self.counts_path, chunksize=7)
+        self.assertEqual(matrix.counts.dtype, np.int32)
+        self.assertTrue(np.array_equal(matrix.counts, self.counts))
+        self.assertEqual(list(matrix.genes), self.genes)
+        self.assertEqual(list(matrix.samples), self.samples)
+        self.assertEqual(matrix.annotation_df.loc['g3', 'Length'], 302)
+        self.assertEqual(matrix.to_df().loc['g3', 'data/s1.bam'], self.counts[3, 1])
+
+    def test_sparse(self):
+        try:
+            import scipy.sparse
+        except ImportError:
+            self.skipTest('scipy is not installed')
+        matrix = load_counts(self.counts_path, sparse=True, chunksize=7)
+        self.assertTrue(matrix.is_sparse)
+        self.assertTrue(np.array_equal(matrix.counts.toarray(), self.counts))
+        cached = load_counts(self.counts_path, sparse=True, cache=True)
+        cached = load_counts(self.counts_path, sparse=True, cache=True)
+        self.assertTrue(np.array_equal(cached.counts.toarray(), self.counts))
+
+    def test_cache(self):
+        load_counts(self.counts_path, cache=True)
+        self.assertTrue(os.path.exists(f'{self.counts_path}.counts.npy'))
+        cached = load_counts(self.counts_path, cache=True)
+        self.assertIsInstance(cached.counts, np.memmap)
+        self.assertTrue(np.array_equal(cached.counts, self.counts))
+        self.assertEqual(list(cached.samples), self.samples)
+        # The cache is ignored once the table changes
+        write_counts(self.counts_path, self.genes[:3], self.samples, self.counts[:3] + 1)
+        os.utime(self.counts_path, ns=(0, 0))
+        changed = load_counts(self.counts_path, cache=True)
+        self.assertEqual(changed.shape, (3, 4))
+
+    def test_not_featurecounts(self):
+        with open(self.counts_path, 'w') as f:
+            f.write('gene\ts1\n')
+        with self.assertRaises(PipelineException):
+            load_counts(self.counts_path)
+
+
+# Stand in for featureCounts: counts = number of characters in the BAM name, fails on BAMs called bad
+FAKE_FEATURECOUNTS = """#!{python}
+import sys
+args = sys.argv[1:]
+if '--version' in args:
+    print('featureCounts v0.0.0')
+    sys.exit(0)
+out = args[args.index('-o') + 1]
+bams = args[args.index('-o') + 2:]
+if any('bad' in b for b in bams):
+    sys.exit(1)
+with open(out, 'w') as f:
+    f.write('# Program:featureCounts v0.0.0\\n')
+    f.write('\\t'.join(['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length'] + bams) + '\\n')
+    for gene in ['g2', 'g1']:
+        f.write('\\t'.join([gene, '1', '1', '10', '+', '10'] + [str(len(b)) for b in bams]) + '\\n')
+"""
+
+GTF = """chr1\tsrc\texon\t1\t10\t.\t+\t.\tgene_id "g2"; transcript_id "t1";
+chr1\tsrc\texon\t20\t30\t.\t+\t.\tgene_id "g1"; transcript_id "t2";
+"""
+
+
+class TestShardedFeatureCounts(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        annotation._loaded.clear()
+        os.mkdir('bams')
+        os.mkdir('out')
+        with open('featureCounts', 'w') as f:
+            f.write(FAKE_FEATURECOUNTS.format(python=sys.executable))
+        os.chmod('featureCounts', os.stat('featureCounts').st_mode | stat.S_IEXEC)
+        with open('test.gtf', 'w') as f:
+            f.write(GTF)
+        self.bams = [f'bams/{"s" * (i + 1)}.bam' for i in range(7)]
+
+    def tearDown(self):
+        annotation._loaded.clear()
+        super().tearDown()
+
+    def test_sharded(self):
+        fc = FeatureCounts('bams', './featureCounts', '-F GTF -t exon -T 2 -g gene_id', 'out', 'test.gtf')
+        fc.verbose = False
+        merged = fc.run_sharded(self.bams, 3, scheduler=JobScheduler(max_cpus=6))
+        self.assertEqual(list(merged.samples), self.bams)
+        self.assertEqual(list(merged.genes), ['g2', 'g1'])
+        self.assertEqual(list(merged.counts[0]), [len(b) for b in self.bams])
+        written = load_counts(os.path.join('out', 'FEATURECOUNTS_merged.txt'))
+        self.assertTrue(np.array_equal(written.counts, merged.counts))
+
+    def test_failed_shard(self):
+        fc = FeatureCounts('bams', './featureCounts', '-T 1', 'out', 'test.gtf')
+        fc.verbose = False
+        merged = fc.run_sharded(self.bams[:4] + ['bams/bad.bam'], 5, scheduler=JobScheduler(max_cpus=4))
+        self.assertEqual(list(merged.samples), self.bams[:4])
+
+    def test_annotation_order(self):
+        with open('test.gtf', 'w') as f:
+            f.write(''.join(reversed(GTF.splitlines(keepends=True))))
+        fc = FeatureCounts('bams', './featureCounts', '-T 1', 'out', 'test.gtf')
+        fc.verbose = False
+        with self.assertRaises(PipelineException):
+            fc.run_sharded(self.bams, 2)
+
+    def test_saf(self):
+        # A SAF annotation isn't parsed as a GTF
+        with open('test.saf', 'w') as f:
+            f.write('GeneID\tChr\tStart\tEnd\tStrand\ng2\tchr1\t1\t10\t+\ng1\tchr1\t20\t30\t+\n')
+        fc = FeatureCounts('bams', './featureCounts', '-F SAF -T 1', 'out', 'test.saf')
+        fc.verbose = False
+        self.assertTrue(fc.validate_inputs())
+        merged = fc.run_sharded(self.bams, 2)
+        self.assertEqual(list(merged.samples), self.bams)
+        # But its columns are checked
+        with open('test.saf', 'w') as f:
+            f.write('GeneID\tChr\tStart\tEnd\ng2\tchr1\t1\t10\n')
+        fc.u.err_p = lambda *args: None
+        self.assertFalse(fc.validate_inputs())
+        with self.assertRaises(PipelineException):
+            fc.run_sharded(self.bams, 2)
@@ -15,12 +15,16 @@
 #                                                                             #
 ###############################################################################
 
+import asyncio
+import gzip
 import os
 import shutil
 import tempfile
 import unittest
 
-from scirnap import GTF2Bed
+from scirnap import GTF2Bed, PipelineException
+from scirnap.gtf2bed import gtf_to_bed12
+from tests.helpers import TmpDirTestCase
 
 
 class TestStringTie(unittest.TestCase):
@@ -49,3 +53,93 @@ class TestStringTie(unittest.TestCase):
         files = cu.get_files_in_dir()
         # Run dryrun
         cu.run_per_file(files)
+
+
+GTF = """#!genome-build test
+chr1\tsrc\tgene\t100\t900\t.\t+\t.\tgene_id "g1";
+chr1\tsrc\ttranscript\t100\t500\t.\t+\t.\tgene_id "g1"; transcript_id "t1";
+chr1\tsrc\texon\t100\t200\t.\t+\t.\tgene_id "g1"; transcript_id "t1";
+chr1\tsrc\texon\t300\t500\t.\t+\t.\tgene_id "g1"; transcript_id "t1";
+chr1\tsrc\tCDS\t150\t200\t.\t+\t0\tgene_id "g1"; transcript_id "t1";
+chr1\tsrc\tCDS\t300\t400\t.\t+\t2\tgene_id "g1"; transcript_id "t1";
+chr1\tsrc\texon\t800\t900\t.\t-\t.\tgene_id "g1"; transcript_id "t2";
+chr1\tsrc\texon\t600\t700\t.\t-\t.\tgene_id "g1"; transcript_id "t2";
+chr2\tsrc\ttranscript\t10\t50\t7\t-\t.\tgene_id "g2"; transcript_id "t3";
+chr2\tsrc\texon\t10\t50\t.\t-\t.\tgene_id "g2"; transcript_id "t3";
+"""
+
+# Output of gffutils' FeatureDB.bed12(transcript, name_field='transcript_id') for the GTF above
+BED = [
+    'chr1\t99\t500\tt1\t0\t+\t149\t400\t0,0,0\t2\t101,201\t0,200',
+    'chr1\t599\t900\tt2\t0\t-\t600\t900\t0,0,0\t2\t101,101\t0,200',
+    'chr2\t9\t50\tt3\t7\t-\t10\t50\t0,0,0\t1\t41\t0',
+]
+
+
+class TestNativeGTF2Bed(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('data')
+        os.mkdir('out')
+        with open('data/test.gtf', 'w') as f:
+            f.write(GTF)
+
+    def test_bed12(self):
+        gtf_to_bed12('data/test.gtf', 'out/test.bed')
+        with open('out/test.bed') as f:
+            self.assertEqual(f.read().splitlines(), BED)
+
+    def test_gzipped_and_parallel(self):
+        with gzip.open('data/test.gtf.gz', 'wt') as f:
+            f.write(GTF)
+        gtf_to_bed12('data/test.gtf.gz', 'out/gz.bed')
+        gtf_to_bed12('data/test.gtf', 'out/parallel.bed', nprocesses=2)
+        for path in ['out/gz.bed', 'out/parallel.bed']:
+            with open(path) as f:
+                self.assertEqual(f.read().splitlines(), BED)
+
+    def test_unsorted(self):
+        lines = GTF.splitlines(keepends=True)
+        with open('data/unsorted.gtf', 'w') as f:
+            f.write(''.join(lines[:3] + lines[-2:] + lines[3:-2]))
+        with self.assertRaises(PipelineException):
+            gtf_to_bed12('data/unsorted.gtf', 'out/unsorted.bed')
+
+    def test_native_pipeline(self):
+        cu = GTF2Bed('data/', None, 'out/', native=True, nprocesses=2)
+        self.assertEqual(cu.get_job_resources()[0], 2)
+        cu.run_per_file(cu.get_files_in_dir())
+        with open(cu.get_output_files('data/test.gtf')[0]) as f:
+            self.assertEqual(f.read().splitlines(), BED)
+
+    def test_validate_output(self):
+        cu = GTF2Bed('data/', None, 'out/', native=True)
+        job = cu.run_per_file(['data/test.gtf'])[0]
+        self.assertEqual(job.status, 'done')
+        self.assertTrue(cu.validate_output('data/test.gtf'))
+        # A BED missing a transcript fails the job
+        cu = GTF2Bed('data/', None, 'out/', native=True)
+        cu.generate_cmd = lambda f: f'{cu.program_location} {f} | awk "NR <= 2" > {cu.get_output_files(f)[0]}'
+        cu.u.err_p = lambda *args: None
+        job = cu.run_per_file(['data/test.gtf'])[0]
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('failed validation', str(job.error))
+        self.assertFalse(cu.validate_output('data/test.gtf'))
+
+    def test_validate_output_off_loop(self):
+        # The BED check parses the GTF, which mustn't hold up the scheduler's event loop (and the other jobs)
+        cu = GTF2Bed('data/', None, 'out/', native=True)
+        validate_output, on_loop = cu.validate_output, []
+
+        def check(file_path):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+            return validate_output(file_path)
+
+        cu.validate_output = check
+        self.assertEqual(cu.run_per_file(['data/test.gtf'])[0].status, 'done')
+        self.assertEqual(on_loop, [False])
@@ -20,7 +20,9 @@ import shutil
 import tempfile
 import unittest
 
-from scirnap import Hisat2, Cutadapt
+from scirnap import Hisat2, Cutadapt, JobScheduler, PipelineDAG, PipelineException
+from scirnap.hisat2 import parse_summary
+from tests.helpers import TmpDirTestCase
 
 
 class TestHisat2(unittest.TestCase):
@@ -63,3 +65,180 @@ class TestHisat2(unittest.TestCase):
         print(files)
         hs.run_per_file(files)
 
+
+SE_SUMMARY = """20000 reads; of these:
+  20000 (100.00%) were unpaired; of these:
+    1247 (6.24%) aligned 0 times
+    18739 (93.69%) aligned exactly 1 time
+    14 (0.07%) aligned >1 times
+93.77% overall alignment rate
+"""
+
+PE_SUMMARY = """10000 reads; of these:
+  10000 (100.00%) were paired; of these:
+    650 (6.50%) aligned concordantly 0 times
+    8823 (88.23%) aligned concordantly exactly 1 time
+    527 (5.27%) aligned concordantly >1 times
+    ----
+    650 pairs aligned concordantly 0 times; of these:
+      34 (5.23%) aligned discordantly 1 time
+    ----
+    616 pairs aligned 0 times concordantly or discordantly; of these:
+      1232 mates make up the pairs; of these:
+        660 (53.57%) aligned 0 times
+        571 (46.35%) aligned exactly 1 time
+        1 (0.08%) aligned >1 times
+96.70% overall alignment rate
+"""
+
+NEW_SUMMARY = """HISAT2 summary stats:
+\tTotal reads: 20000
+\t\tAligned 0 time: 1247 (6.24%)
+\t\tAligned 1 time: 18739 (93.69%)
+\t\tAligned >1 times: 14 (0.07%)
+\tOverall alignment rate: 93.77%
+"""
+
+
+class TestHisat2Summary(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('data')
+        os.mkdir('out')
+        for name, summary in [('se', SE_SUMMARY), ('pe', PE_SUMMARY), ('new', NEW_SUMMARY)]:
+            with open(f'out/HISAT2_{name}.fq.gz_summary.txt', 'w') as f:
+                f.write(summary)
+        # Not a summary file, used to be picked up by the substring match
+        with open('out/summary_notes.md', 'w') as f:
+            f.write('notes')
+
+    def test_parse_single_end(self):
+        for name in ['se', 'new']:
+            stats = parse_summary(f'out/HISAT2_{name}.fq.gz_summary.txt')
+            self.assertFalse(stats['paired'])
+            self.assertEqual(stats['total_reads'], 20000)
+            self.assertEqual(stats['unique'], 18739)
+            self.assertEqual(stats['multi'], 14)
+            self.assertEqual(stats['unaligned'], 1247)
+            self.assertEqual(stats['overall_rate'], 93.77)
+
+    def test_parse_paired_end(self):
+        stats = parse_summary('out/HISAT2_pe.fq.gz_summary.txt')
+        self.assertTrue(stats['paired'])
+        self.assertEqual(stats['total_reads'], 10000)
+        self.assertEqual(stats['unique'], 8823)
+        self.assertEqual(stats['multi'], 527)
+        self.assertEqual(stats['discordant_1'], 34)
+        self.assertEqual(stats['unaligned'], 616)
+        self.assertEqual(stats['mates'], 1232)
+        self.assertEqual(stats['mates_0'], 660)
+        self.assertIsNone(stats['aligned_0'])
+        self.assertEqual(stats['overall_rate'], 96.7)
+
+    def test_summarise_results(self):
+        hs = Hisat2('data', 'hisat2', '-p 2', 'out', 'genome', 's', dryrun=True)
+        summary_df = hs.summarise_results('summary.tsv', nthreads=2)
+        self.assertEqual(len(summary_df), 3)
+        self.assertEqual(str(summary_df['total_reads'].dtype), 'Int64')
+        with open('summary.tsv') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith('file\tpaired\ttotal_reads'))
+
+
+
+class TestHisat2Pipe(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('data')
+
+    def test_default_pipe(self):
+        hs = Hisat2('data', 'hisat2', '-p 4', 'out', 'genome', 's')
+        self.assertEqual(hs.generate_cmd('data/a.fq.gz'), 'hisat2 -p 4 --summary-file out/HISAT2_a.fq.gz_summary.txt '
+                                                          '-x genome -U data/a.fq.gz | samtools view -bS | '
+                                                          'samtools sort -o out/HISAT2_a.fq.gz.sorted.bam')
+        self.assertEqual(hs.get_job_resources(), (6, 6 * 1024 ** 3))
+
+    def test_sort_settings(self):
+        hs = Hisat2('data', 'hisat2', '-p 8', 'out', 'genome', 's', sort_threads=4, sort_mem='2G',
+                    tmp_dir='/scratch/tmp', skip_view=True)
+        self.assertEqual(hs.generate_cmd('data/a.fq.gz'),
+                         'mkdir -p /scratch/tmp && hisat2 -p 8 --summary-file out/HISAT2_a.fq.gz_summary.txt -x genome '
+                         '-U data/a.fq.gz | samtools sort -@ 4 -m 2G -T /scratch/tmp/HISAT2_a.fq.gz '
+                         '-o out/HISAT2_a.fq.gz.sorted.bam')
+        self.assertEqual(hs.get_job_resources(), (12, int(5.25 * 1024 ** 3) + 4 * 2 * 1024 ** 3))
+
+    def test_job_cpus(self):
+        # The scheduler's 32 CPUs are shared by 2 jobs at once, each job's 16 are split between the pipe
+        hs = Hisat2('data', 'hisat2', '-k 5', 'out', 'genome', 'p')
+        hs.set_job_cpus(scheduler=JobScheduler(max_cpus=32), jobs_at_once=2)
+        self.assertEqual(hs.get_thread_split(), (11, 1, 4))
+        cmd = hs.generate_cmd(('data/a_R1.fq.gz', 'data/a_R2.fq.gz'))
+        self.assertTrue(cmd.startswith('hisat2 -k 5 -p 11 --summary-file'))
+        self.assertIn('| samtools view -bS | samtools sort -@ 4 -o', cmd)
+        self.assertEqual(hs.get_job_resources(cmd), (16, int(5.25 * 1024 ** 3) + 4 * 768 * 1024 ** 2))
+
+    def test_job_cpus_replace_threads(self):
+        # The -p (or --threads) in the param str is replaced rather than given twice
+        for param_str in ['-p 8 -k 5', '-k 5 --threads=8', '-k 5 -p 8']:
+            hs = Hisat2('data', 'hisat2', param_str, 'out', 'genome', 's', nthreads=12)
+            hs.set_job_cpus(jobs_at_once=2)
+            self.assertEqual(hs.cpus_per_job, 6)
+            cmd = hs.generate_cmd('data/a.fq.gz')
+            self.assertTrue(cmd.startswith('hisat2 -k 5 -p 4 --summary-file'), cmd)
+        hs = Hisat2('data', 'hisat2', '-p 8', 'out', 'genome', 's', cpus_per_job=6)
+        self.assertTrue(hs.generate_cmd('data/a.fq.gz').startswith('hisat2 -p 4 --summary-file'))
+
+    def test_job_cpus_small(self):
+        # The split never adds up to more than the job's CPUs, samtools shares them when there are too few
+        warnings = []
+        for cpus, skip_view, split in [(1, False, (1, 0, 0)), (2, False, (1, 0, 1)), (3, False, (1, 1, 1)),
+                                       (1, True, (1, 0, 0)), (2, True, (1, 0, 1))]:
+            hs = Hisat2('data', 'hisat2', '', 'out', 'genome', 's', skip_view=skip_view)
+            hs.u.warn_p = warnings.append
+            hs.set_job_cpus(cpus)
+            self.assertEqual(hs.get_thread_split(), split)
+            self.assertLessEqual(sum(split), cpus)
+            self.assertEqual(hs.get_job_resources(), (cpus, int(5.25 * 1024 ** 3) + 768 * 1024 ** 2))
+        self.assertEqual(len(warnings), 3)
+        cmd = hs.generate_cmd('data/a.fq.gz')
+        self.assertTrue(cmd.startswith('hisat2 -p 1 --summary-file'))
+        self.assertIn('| samtools sort -o', cmd)
+
+
+class TestHisat2Paired(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for d in ['data', 'trimmed', 'aligned']:
+            os.mkdir(d)
+        for sample in ['s1', 's2']:
+            for mate in ['1', '2']:
+                with open(f'data/{sample}_R{mate}.fq.gz', 'w') as f:
+                    f.write(f'{sample} {mate}\n')
+
+    def test_paired_cmd(self):
+        hs = Hisat2('data', 'hisat2', '-p 4', 'aligned', 'idx/genome', 'p')
+        cmd = hs.generate_cmd(('data/s1_R1.fq.gz', 'data/s1_R2.fq.gz'))
+        self.assertIn('-x idx/genome -1 data/s1_R1.fq.gz -2 data/s1_R2.fq.gz |', cmd)
+        self.assertIn('--summary-file aligned/HISAT2_s1.fq.gz_summary.txt', cmd)
+        self.assertEqual(hs.get_output_files(('data/s1_R1.fq.gz', 'data/s1_R2.fq.gz')),
+                         ['aligned/HISAT2_s1.fq.gz.sorted.bam'])
+        with self.assertRaises(PipelineException):
+            hs.generate_cmd('data/s1_R1.fq.gz')
+
+    def test_paired_dag(self):
+        # The trimmed mates of each pair are passed on to Hisat2 together
+        cu = Cutadapt('data', 'cutadapt', '', None, 'trimmed', 'p', dryrun=True)
+        hs = Hisat2('trimmed', 'hisat2', '', 'aligned', 'idx/genome', 'p', dryrun=True)
+        cu.verbose, hs.verbose = False, False
+        dag = PipelineDAG(JobScheduler(max_cpus=4), verbose=False)
+        dag.add_stage('trim', cu)
+        dag.add_stage('align', hs, after='trim')
+        jobs = dag.run()
+        self.assertEqual(len(jobs['trim']), 2)
+        self.assertEqual(sorted(job.file_path for job in jobs['align']),
+                         [('trimmed/CUTADAPT_s1_R1.fq.gz', 'trimmed/CUTADAPT_s1_R2.fq.gz'),
+                          ('trimmed/CUTADAPT_s2_R1.fq.gz', 'trimmed/CUTADAPT_s2_R2.fq.gz')])
@@ -0,0 +1,108 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+import json
+import os
+
+from scirnap import BasePipeline, JobScheduler
+from scirnap.journal import JobJournal, JOURNAL_FILENAME
+from tests.helpers import TmpDirTestCase, write_files
+
+
+class Flaky(BasePipeline):
+    """ Copies each file, the first fails cmds (per file) exit with an error. """
+
+    def __init__(self, data_dir, output_dir, fails=0):
+        super().__init__(data_dir, 'cp', output_dir=output_dir, file_ending='.txt', name='flaky', verbose=False)
+        self.fails = fails
+        self.u.warn_p = lambda *args: None
+
+    def generate_cmd(self, filepath):
+        count = f'{self.get_output_files(filepath)[0]}.attempts'
+        return f'echo x >> {count} && [ $(wc -l < {count}) -gt {self.fails} ] && ' \
+               f'cp {filepath} {self.get_output_files(filepath)[0]}'
+
+    def get_output_files(self, filepath) -> list:
+        return [self._gen_fname_str(filepath)]
+
+
+class TestJournal(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('out')
+        self.files = write_files(3)
+
+    def get_records(self):
+        with open(os.path.join('out', JOURNAL_FILENAME)) as f:
+            return [json.loads(line) for line in f]
+
+    def test_states(self):
+        jobs = Flaky('data', 'out').run_per_file(self.files, JobScheduler(max_cpus=2))
+        self.assertTrue(all(job.status == 'done' for job in jobs))
+        records = self.get_records()
+        self.assertEqual([r['state'] for r in records if r['job'] == 'flaky:s1.txt'], ['pending', 'running', 'done'])
+        journal = JobJournal(os.path.join('out', JOURNAL_FILENAME))
+        self.assertEqual(list(journal.to_df()['state']), ['done'] * 3)
+        self.assertEqual(journal.get_unfinished(), [])
+
+    def test_retries(self):
+        flaky = Flaky('data', 'out', fails=2)
+        flaky.retries, flaky.retry_delay = 2, 0.01
+        jobs = flaky.run_per_file(self.files[:1])
+        self.assertEqual(jobs[0].status, 'done')
+        states = [(r['state'], r['attempt']) for r in self.get_records()]
+        self.assertEqual(states, [('pending', 0), ('running', 0), ('failed', 0), ('running', 1), ('failed', 1),
+                                  ('running', 2), ('done', 2)])
+        self.assertIn('exited with code 1', self.get_records()[2]['error'])
+
+    def test_retries_run_out(self):
+        flaky = Flaky('data', 'out', fails=2)
+        flaky.retries, flaky.retry_delay = 1, 0.01
+        job = flaky.run_per_file(self.files[:1])[0]
+        self.assertEqual(job.status, 'failed')
+        journal = JobJournal(os.path.join('out', JOURNAL_FILENAME))
+        self.assertEqual(journal.get_state(flaky.generate_cmd(self.files[0])), 'failed')
+        self.assertEqual(len(journal.get_unfinished()), 1)
+
+    def test_resume(self):
+        Flaky('data', 'out').run_per_file(self.files[:2])
+        # The driver died while s1 was running again (its last line was cut short), s2 was still queued
+        flaky = Flaky('data', 'out')
+        journal = JobJournal(os.path.join('out', JOURNAL_FILENAME))
+        journal.record(flaky.generate_cmd(self.files[2]), 'pending')
+        journal.record(flaky.generate_cmd(self.files[1]), 'running')
+        with open(os.path.join('out', JOURNAL_FILENAME), 'a') as f:
+            f.write(json.dumps({'key': 'x', 'state': 'running'})[:-5])
+        # The inputs were touched so the run cache can't be used, only the journal
+        for f in self.files:
+            os.utime(f, ns=(1, 1))
+        flaky.resume = True
+        jobs = flaky.run_per_file(self.files)
+        self.assertTrue(all(job.status == 'done' for job in jobs))
+        self.assertIsNone(jobs[0].result)
+        self.assertIsNotNone(jobs[1].result)
+        self.assertIsNotNone(jobs[2].result)
+        with open('out/flaky_s0.txt.attempts') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        journal = JobJournal(os.path.join('out', JOURNAL_FILENAME))
+        self.assertEqual(list(journal.to_df()['state']), ['done'] * 3)
+
+        # A done job whose outputs have gone is run again
+        os.remove('out/flaky_s0.txt')
+        flaky = Flaky('data', 'out')
+        flaky.resume = True
+        self.assertIsNotNone(flaky.run_per_file(self.files[:1])[0].result)
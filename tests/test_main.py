@@ -0,0 +1,79 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+import os
+import stat
+import sys
+from unittest import mock
+
+import pandas as pd
+
+from scirnap.main import main
+from tests.helpers import TmpDirTestCase, write_script
+
+# Fake samtools: logs each call and writes the merged BAM
+FAKE_SAMTOOLS = """#!{python}
+import sys
+args = sys.argv[1:]
+if '--version' in args:
+    print('samtools 1.0-fake')
+    sys.exit(0)
+with open('calls.log', 'a') as f:
+    f.write(' '.join(args) + '\\n')
+open(args[1], 'w').close()
+"""
+
+
+class TestMain(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with open('samtools', 'w') as f:
+            f.write(FAKE_SAMTOOLS.format(python=sys.executable))
+        os.chmod('samtools', os.stat('samtools').st_mode | stat.S_IEXEC)
+        os.mkdir('bams')
+        os.mkdir('merged')
+        for name in ['run1.ACGT.bam', 'run2.ACGT.bam', 'run1.TTGA.bam']:
+            open(os.path.join('bams', name), 'w').close()
+
+    def exec_main(self, *args) -> int:
+        argv = ['scirnap', '--t', 'pool', '--d', 'bams', '--c', './samtools', '--o', 'merged', '--f', '.bam', *args]
+        with mock.patch.object(sys, 'argv', argv), self.assertRaises(SystemExit) as exit_code:
+            main()
+        return exit_code.exception.code
+
+    def run_main(self, *args):
+        self.assertEqual(self.exec_main(*args), 0)
+        with open('calls.log') as f:
+            return sorted(line.split() for line in f)
+
+    def test_pool_all(self):
+        # Without a sample sheet every file is merged into one BAM
+        calls = self.run_main()
+        self.assertEqual(calls, [['merge', 'merged/run1.ACGT.bam.merged.bam', 'bams/run1.ACGT.bam',
+                                  'bams/run1.TTGA.bam', 'bams/run2.ACGT.bam']])
+
+    def test_pool_sample_sheet(self):
+        pd.DataFrame({'Barcode': ['ACGT', 'TTGA'], 'SampleName': ['s1', 's2']}).to_csv('filelist.csv', index=False)
+        calls = self.run_main('--ss', 'filelist.csv')
+        self.assertEqual(calls, [['merge', 'merged/s1.merged.bam', 'bams/run1.ACGT.bam', 'bams/run2.ACGT.bam'],
+                                 ['merge', 'merged/s2.merged.bam', 'bams/run1.TTGA.bam']])
+
+    def test_failed_exit_code(self):
+        # Every merge fails, which the exit code has to tell a workflow manager
+        write_script('samtools', '#!/bin/sh\nexit 2\n')
+        pd.DataFrame({'Barcode': ['ACGT', 'TTGA'], 'SampleName': ['s1', 's2']}).to_csv('filelist.csv', index=False)
+        self.assertEqual(self.exec_main('--ss', 'filelist.csv'), 1)
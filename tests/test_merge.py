@@ -15,13 +15,17 @@
 #                                                                             #
 ###############################################################################
 
+import gzip
 import os
 import shutil
+import struct
 import tempfile
 import unittest
 import pandas as pd
 
-from scirnap import Pool
+from scirnap import Pool, PipelineException
+from scirnap.pool import group_files, get_sort_order
+from tests.helpers import TmpDirTestCase
 
 
 class TestMerge(unittest.TestCase):
@@ -53,33 +57,95 @@ class TestMerge(unittest.TestCase):
         fqc.run_on_file(files)
 
     def test_merge_on_barcode(self):
-        pairs = []
-        found = []
         data_dir = 'data/hisat2/'
-        file_name_df = pd.read_csv('data/fastq/filelist.csv')
-        file_name_map = {}
-        barcodes = file_name_df['Barcode'].values
-        b_i = 0
-        for sample_name in file_name_df['SampleName'].values:
-            file_name_map[barcodes[b_i]] = sample_name
-            b_i += 1
-        files = os.listdir(data_dir)
-        file_to_newname = {}
-        for f in files:
-            if 'summary' not in f:
-                file_id = f.split('.')[1]
-                if file_id not in found:
-                    for pair in files:
-                        if 'summary' not in pair:
-                            pair_id = pair.split('.')[1]
-                            if pair_id == file_id and f != pair:
-                                pairs.append([os.path.join(data_dir, f), os.path.join(data_dir, pair)])
-                                found.append(file_id)
-                                file_to_newname[os.path.join(data_dir, f)] = file_name_map[file_id]
-                                print(f, pair)
-                                break
         fqc = Pool('data/hisat2/',
                     'software/samtools/./samtools',
                     'data/merged_bams_nodta/',
-                    filename_map=file_to_newname, name='bampool', dryrun=False, nthreads=None)
+                    name='bampool', dryrun=False, nthreads=None)
+        files = [os.path.join(data_dir, f) for f in os.listdir(data_dir) if 'summary' not in f]
+        # Files are named <name>.<barcode>.<...>, merge the pairs with the same barcode & name them after the sample
+        pairs = fqc.group_files(files, 'data/fastq/filelist.csv', key_fn=lambda f: os.path.basename(f).split('.')[1],
+                                min_files=2)
         fqc.run_per_file(pairs)
+
+
+class TestPoolGroups(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        pd.DataFrame({'Barcode': ['ACGT', 'ACGT', 'TTGA', 'TTGA'], 'Lane': ['L001', 'L002', 'L001', 'L002'],
+                      'SampleName': ['s1', 's2', 's3', 's3']}).to_csv('filelist.csv', index=False)
+
+    def test_group_on_sample_sheet(self):
+        files = ['bams/run1.TTGA.L002.bam', 'bams/run1.ACGT.L001.bam', 'bams/run2.ACGT.L001.bam',
+                 'bams/run1.TTGA.L001.bam', 'bams/run1.ACGT.L002.bam', 'bams/run1.GGGG.L001.bam']
+        groups, unmatched = group_files(files, 'filelist.csv', key_columns=['Barcode', 'Lane'])
+        self.assertEqual(groups, {'s1': ['bams/run1.ACGT.L001.bam', 'bams/run2.ACGT.L001.bam'],
+                                  's2': ['bams/run1.ACGT.L002.bam'],
+                                  's3': ['bams/run1.TTGA.L001.bam', 'bams/run1.TTGA.L002.bam']})
+        self.assertEqual(unmatched, ['bams/run1.GGGG.L001.bam'])
+
+    def test_pool_groups(self):
+        pool = Pool('.', 'samtools', 'merged', dryrun=True)
+        files = [f'bams/run{i}.{b}.L00{lane}.bam' for i in range(5000) for b in ['ACGT', 'TTGA'] for lane in [1, 2]]
+        groups = pool.group_files(files, 'filelist.csv', key_columns=['Barcode', 'Lane'])
+        # Groups of any size, here 5000 files for s1 and s2 and 10000 for s3
+        self.assertEqual(sorted(len(g) for g in groups), [5000, 5000, 10000])
+        s3 = [g for g in groups if 'TTGA' in g[0]][0]
+        self.assertEqual(pool.get_output_files(s3), [os.path.join('merged', 's3.merged.bam')])
+        self.assertEqual(len(pool.group_files(files, key_fn=lambda f: f.split('.')[1], min_files=2)), 2)
+        jobs = pool.run_per_file(groups)
+        self.assertEqual([job.status for job in jobs], ['done'] * 3)
+
+    def test_missing_column(self):
+        with self.assertRaises(PipelineException):
+            group_files(['a.bam'], 'filelist.csv', key_columns='Sample')
+
+
+def write_bam_header(bam_path, sort_order):
+    # Just the start of a BAM: magic, header text, no references or reads (gzip reads BGZF and plain gzip the same)
+    text = f'@HD\tVN:1.6\tSO:{sort_order}\n@SQ\tSN:chr1\tLN:1000\n'.encode()
+    with gzip.open(bam_path, 'wb') as f:
+        f.write(b'BAM\x01' + struct.pack('<i', len(text)) + text + struct.pack('<i', 0))
+
+
+class TestPoolMergeSorted(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('bams')
+        for name, sort_order in [('a', 'coordinate'), ('b', 'coordinate'), ('c', 'queryname')]:
+            write_bam_header(f'bams/{name}.sorted.bam', sort_order)
+        with open('bams/d.sam', 'w') as f:
+            f.write('@HD\tVN:1.6\tSO:coordinate\n')
+
+    def test_sort_order(self):
+        self.assertEqual(get_sort_order('bams/a.sorted.bam'), 'coordinate')
+        self.assertEqual(get_sort_order('bams/c.sorted.bam'), 'queryname')
+        self.assertEqual(get_sort_order('bams/d.sam'), 'unknown')
+        self.assertEqual(get_sort_order('bams/missing.bam'), 'unknown')
+
+    def test_merge_sorted(self):
+        pool = Pool('bams', 'samtools', 'merged', merge_sorted=True, index=True, threads=4,
+                    filename_map={'bams/a.sorted.bam': 's1', 'bams/b.sorted.bam': 's2'})
+        # Sorted inputs are merged straight into the sorted output
+        cmd = pool.generate_cmd(['bams/a.sorted.bam', 'bams/b.sorted.bam'])
+        self.assertEqual(cmd, 'samtools merge -@ 4 merged/s1.sorted.bam bams/a.sorted.bam bams/b.sorted.bam && '
+                              'samtools index -@ 4 merged/s1.sorted.bam')
+        self.assertEqual(pool.get_output_files(['bams/a.sorted.bam']),
+                         ['merged/s1.sorted.bam', 'merged/s1.sorted.bam.bai'])
+        self.assertEqual(pool.get_job_resources(cmd), (4, 256 * 1024 ** 2))
+        # Any unsorted input and the merge goes through samtools sort
+        cmd = pool.generate_cmd(['bams/b.sorted.bam', 'bams/c.sorted.bam'])
+        self.assertEqual(cmd, 'samtools merge -u - bams/b.sorted.bam bams/c.sorted.bam | '
+                              'samtools sort -@ 4 -o merged/s2.sorted.bam - && samtools index -@ 4 merged/s2.sorted.bam')
+        self.assertEqual(pool.get_job_resources(cmd), (4, (256 + 4 * 768) * 1024 ** 2))
+        pool.logfile.close()
+
+    def test_merge_threads(self):
+        # The CPUs the job is given are used by samtools merge
+        pool = Pool('bams', 'samtools', 'merged', threads=4, filename_map={'bams/a.sorted.bam': 's1'})
+        cmd = pool.generate_cmd(['bams/a.sorted.bam', 'bams/b.sorted.bam'])
+        self.assertEqual(cmd, 'samtools merge -@ 4 merged/s1.merged.bam bams/a.sorted.bam bams/b.sorted.bam')
+        self.assertEqual(pool.get_job_resources(cmd), (4, 256 * 1024 ** 2))
+        pool.logfile.close()
@@ -0,0 +1,91 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import threading
+import time
+
+from scirnap import Job, JobScheduler, Hisat2
+from tests.helpers import TmpDirTestCase
+
+
+class TestScheduler(TmpDirTestCase):
+
+    def test_cpu_budget(self):
+        running, peak = [], []
+        lock = threading.Lock()
+
+        def work(cpus):
+            with lock:
+                running.append(cpus)
+                peak.append(sum(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(cpus)
+
+        sched = JobScheduler(max_cpus=8, max_mem='10G')
+        jobs = [Job(work, (c,), cpus=c) for c in [4, 4, 2, 6, 1, 1, 3]]
+        sched.run(jobs)
+        self.assertTrue(all(j.status == 'done' for j in jobs))
+        self.assertLessEqual(max(peak), 8)
+        report = sched.report()
+        self.assertEqual(len(report), 7)
+        self.assertTrue((report['run_time'] >= 0.05).all())
+
+    def test_mem_budget(self):
+        sched = JobScheduler(max_cpus=8, max_mem='4G')
+        jobs = [Job(time.sleep, (0.05,), mem='3G') for _ in range(3)]
+        start = time.time()
+        sched.run(jobs)
+        # Only one job fits in memory at a time
+        self.assertGreaterEqual(time.time() - start, 0.15)
+
+    def test_oversized_job(self):
+        sched = JobScheduler(max_cpus=2, max_mem='1G')
+        job = sched.run([Job(lambda: 'ok', cpus=12, mem='8G')])[0]
+        self.assertEqual(job.result, 'ok')
+
+    def test_failed_job(self):
+        sched = JobScheduler(max_cpus=2)
+        job = sched.run([Job(lambda: 1 / 0)])[0]
+        self.assertEqual(job.status, 'failed')
+        self.assertIsInstance(job.error, ZeroDivisionError)
+
+    def test_failed_callback(self):
+        sched = JobScheduler(max_cpus=2)
+        sched.u.err_p = lambda *args: None
+        called = []
+        job = Job(lambda: 'ok')
+        job.add_done_callback(lambda j: 1 / 0)
+        job.add_done_callback(called.append)
+        sched.submit(job)
+        # The job is still done and the callbacks after the failed one are still called
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(called, [job])
+        self.assertEqual(sched.used_cpus, 0)
+
+    def test_job_resources(self):
+        os.mkdir('data')
+        hs = Hisat2('data', 'hisat2', '-k 5 -p 10 -q ', 'out', 'genome', 's', dryrun=True)
+        cpus, mem = hs.get_job_resources()
+        self.assertEqual(cpus, 12)
+        self.assertEqual(mem, 6 * 1024 ** 3)
+        hs.cpus_per_job = 4
+        self.assertEqual(hs.get_job_resources()[0], 4)
+        jobs = hs.run_per_file(['data/a.fq.gz', 'data/b.fq.gz'], scheduler=JobScheduler(max_cpus=16))
+        self.assertEqual([j.status for j in jobs], ['done', 'done'])
@@ -22,6 +22,7 @@ import unittest
 
 
 from scirnap import Sort
+from tests.helpers import TmpDirTestCase
 
 
 class TestSort(unittest.TestCase):
@@ -49,3 +50,14 @@ class TestSort(unittest.TestCase):
                    name='sort', dryrun=False, nthreads=1)
         files = fqc.get_files_in_dir()
         fqc.run_per_file(files)
+
+
+class TestSortThreads(TmpDirTestCase):
+
+    def test_sort_threads(self):
+        fqc = Sort('.', 'samtools', 'sorted', name='sort', threads=4, index=True)
+        self.assertEqual(fqc.generate_cmd('merged/s1.merged.bam'), 'samtools sort -@ 4 merged/s1.merged.bam -o '
+                                                                   'sorted/s1.sorted.bam && samtools index -@ 4 '
+                                                                   'sorted/s1.sorted.bam')
+        self.assertEqual(fqc.get_job_resources(), (4, 4 * 768 * 1024 ** 2))
+        fqc.logfile.close()
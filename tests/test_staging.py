@@ -0,0 +1,190 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+import asyncio
+import os
+import threading
+import time
+from unittest import mock
+
+from scirnap import BasePipeline, JobScheduler
+from scirnap.staging import Stager, copy_file, rewrite_cmd
+from tests.helpers import TmpDirTestCase
+
+
+class Index(BasePipeline):
+    """ Copies a BAM-like file and writes an index next to it, as samtools sort && samtools index would. """
+
+    def __init__(self, data_dir, output_dir):
+        super().__init__(data_dir, 'cp', output_dir=output_dir, file_ending='.bam', name='idx', verbose=False)
+        self.u.warn_p = lambda *args: None
+
+    def generate_cmd(self, filepath):
+        output_file = self.get_output_files(filepath)[0]
+        return f'cp {filepath} {output_file} && echo {filepath} > {output_file}.bai'
+
+    def get_output_files(self, filepath) -> list:
+        output_file = f'{self._gen_fname_str(filepath)}.sorted.bam'
+        return [output_file, f'{output_file}.bai']
+
+
+class TestStaging(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('data')
+        os.mkdir('out')
+        self.files = []
+        for i in range(5):
+            self.files.append(f'data/s{i}.bam')
+            with open(self.files[-1], 'w') as f:
+                f.write(f's{i}' * 100)
+
+    def test_rewrite_cmd(self):
+        cmd = 'cp data/a.bam out/a.bam && samtools index out/a.bam -o out/a.bam.bai >out/a.bam.log; cat "data/a.bam"'
+        rewritten = rewrite_cmd(cmd, {'data/a.bam': '/s/in/a.bam', 'out/a.bam': '/s/out/a.bam',
+                                      'out/a.bam.bai': '/s/out/a.bam.bai'})
+        # out/a.bam.log isn't an output so it is left alone
+        self.assertEqual(rewritten, 'cp /s/in/a.bam /s/out/a.bam && samtools index /s/out/a.bam -o /s/out/a.bam.bai '
+                                    '>out/a.bam.log; cat "/s/in/a.bam"')
+        self.assertEqual(rewrite_cmd('cat xdata/a.bam data/a.bamx', {'data/a.bam': 'z'}), 'cat xdata/a.bam data/a.bamx')
+
+    def test_copy_file(self):
+        self.assertEqual(len(copy_file(self.files[0], 'copy/s0.bam')), 32)
+        with open('copy/s0.bam') as f:
+            self.assertEqual(f.read(), 's0' * 100)
+        with mock.patch('scirnap.staging._hash_file', return_value='corrupt'):
+            with self.assertRaises(OSError):
+                copy_file(self.files[1], 'copy/s1.bam')
+        self.assertEqual(os.listdir('copy'), ['s0.bam'])
+
+    def test_staged_run(self):
+        idx = Index('data', 'out')
+        idx.use_staging('scratch', budget='1M', prefetch=2)
+        stager = idx.stager
+        jobs = idx.run_per_file(self.files, JobScheduler(max_cpus=2))
+        self.assertTrue(all(job.status == 'done' for job in jobs))
+        self.assertEqual((stager.copied_in, stager.copied_out), (5, 10))
+        for f in self.files:
+            name = os.path.basename(f)
+            with open(f'out/idx_{name}.sorted.bam') as out:
+                self.assertEqual(out.read(), name[:2] * 100)
+            with open(f'out/idx_{name}.sorted.bam.bai') as out:
+                # The cmd read the staged copy
+                self.assertTrue(out.read().startswith(stager.root))
+        # Nothing is left in scratch once the run is over
+        self.assertEqual(os.listdir('scratch'), [])
+        self.assertEqual(stager.used, 0)
+
+    def test_over_budget(self):
+        idx = Index('data', 'out')
+        idx.use_staging('scratch', budget=100, prefetch=2)
+        stager = idx.stager
+        jobs = idx.run_per_file(self.files)
+        self.assertTrue(all(job.status == 'done' for job in jobs))
+        self.assertEqual(stager.copied_in, 0)
+        with open('out/idx_s0.bam.sorted.bam.bai') as out:
+            self.assertEqual(out.read(), 'data/s0.bam\n')
+
+    def test_failed_cmd(self):
+        idx = Index('data', 'out')
+        idx.use_staging('scratch')
+        idx.generate_cmd = lambda f: f'cp {f} {idx.get_output_files(f)[0]} && exit 1'
+        job = idx.run_per_file(self.files[:1])[0]
+        self.assertEqual(job.status, 'failed')
+        self.assertFalse(os.path.exists('out/idx_s0.bam.sorted.bam'))
+        self.assertEqual(os.listdir('scratch'), [])
+
+    def test_prefetch(self):
+        stager = Stager('scratch', budget=900, prefetch=2)
+        stager.plan([[f] for f in self.files])
+        # Two jobs ahead are staged, both fit in the budget (with as much again for their outputs)
+        self.assertEqual(stager.prefetched, [[self.files[0]], [self.files[1]]])
+        staged = asyncio.run(stager.stage_in([self.files[0]]))
+        self.assertTrue(staged[self.files[0]].startswith(stager.root))
+        # The running job still holds its inputs so the third doesn't fit yet
+        self.assertEqual(stager.prefetched, [[self.files[1]]])
+        self.assertEqual(stager.used, 800)
+        stager.release([self.files[0]])
+        self.assertFalse(os.path.exists(staged[self.files[0]]))
+        self.assertEqual(stager.prefetched, [[self.files[1]], [self.files[2]]])
+        stager.close()
+        self.assertFalse(os.path.exists(stager.root))
+
+    def test_skip(self):
+        stager = Stager('scratch', budget=900, prefetch=2, nthreads=1)
+        stager.plan([[f] for f in self.files])
+        # A prefetched job that is skipped frees its inputs for the next
+        stager.skip([self.files[0]])
+        stager._pool.submit(lambda: None).result()  # The skipped input is removed once its copy is done
+        self.assertEqual(stager.prefetched, [[self.files[1]], [self.files[2]]])
+        self.assertEqual(stager.used, 800)
+        stager.skip([self.files[4]])
+        self.assertEqual(list(stager.upcoming), [[self.files[3]]])
+        stager.close()
+
+    def test_cached_jobs_not_staged(self):
+        Index('data', 'out').run_per_file(self.files[:3])
+        idx = Index('data', 'out')
+        idx.use_staging('scratch', budget=900, prefetch=2)
+        stager = idx.stager
+        jobs = idx.run_per_file(self.files)
+        self.assertTrue(all(job.status == 'done' for job in jobs))
+        # Only the two jobs that ran were staged, so neither fell back to the shared inputs
+        self.assertEqual(stager.copied_in, 2)
+        for f in self.files[3:]:
+            with open(f'out/idx_{os.path.basename(f)}.sorted.bam.bai') as out:
+                self.assertTrue(out.read().startswith(stager.root))
+        self.assertEqual(stager.used, 0)
+        self.assertEqual(os.listdir('scratch'), [])
+
+    def test_outputs_reserved(self):
+        # The inputs of two jobs fit, but not with their outputs
+        stager = Stager('scratch', budget=700, prefetch=2, nthreads=1)
+        stager.plan([[f] for f in self.files])
+        self.assertEqual(stager.prefetched, [[self.files[0]]])
+        self.assertEqual(stager.used, 400)
+        asyncio.run(stager.stage_in([self.files[0]]))
+        # Outputs larger than reserved count for the rest until they have been copied back
+        output_paths = stager.get_output_paths(['out/s0.bam'])
+        with open(output_paths['out/s0.bam'], 'w') as f:
+            f.write('x' * 500)
+        used = []
+        with mock.patch('scirnap.staging.copy_file', side_effect=lambda *args: used.append(stager.used)):
+            asyncio.run(stager.write_back(output_paths, [self.files[0]]))
+        self.assertEqual(used, [700])
+        self.assertEqual(stager.used, 400)
+        stager.release([self.files[0]])
+        stager._pool.submit(lambda: None).result()
+        self.assertEqual(stager.prefetched, [[self.files[1]]])
+        self.assertEqual(stager.used, 400)
+        stager.close()
+
+    def test_release_while_copying(self):
+        stager = Stager('scratch', budget=900, prefetch=1, nthreads=1)
+        copied, copy_in = threading.Event(), stager._copy_in
+        stager._copy_in = lambda path, staged_path: copied.wait(10) and copy_in(path, staged_path)
+        stager.plan([[self.files[0]]])
+        # Skipping the job doesn't wait for its copy, the copy is removed (and its space freed) once it is done
+        started = time.time()
+        stager.skip([self.files[0]])
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual(stager.used, 200)
+        copied.set()
+        stager._pool.submit(lambda: None).result()
+        self.assertEqual(stager.used, 0)
+        self.assertEqual(os.listdir(os.path.join(stager.root, 'in', '1')), [])
+        stager.close()
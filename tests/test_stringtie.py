@@ -17,10 +17,17 @@
 
 import os
 import shutil
+import stat
+import sys
 import tempfile
 import unittest
 
-from scirnap import StringTie
+import numpy as np
+import pandas as pd
+
+from scirnap import JobScheduler, StringTie
+from scirnap.stringtie import CTAB_COLUMNS, collate_ctabs
+from tests.helpers import TmpDirTestCase
 
 
 class TestStringTie(unittest.TestCase):
@@ -54,3 +61,116 @@ class TestStringTie(unittest.TestCase):
         files = cu.get_files_in_dir()
         # Run dryrun
         cu.run_per_file(files)
+
+
+# Fake stringtie: assembles (one line per call to a log), merges and quantifies, the ctab values depend on the BAM name
+FAKE_STRINGTIE = """#!{python}
+import os
+import sys
+args = sys.argv[1:]
+if '--version' in args:
+    print('2.0.0-fake')
+    sys.exit(0)
+out = args[args.index('-o') + 1]
+with open('calls.log', 'a') as f:
+    f.write(' '.join(args) + '\\n')
+if 'bad' in args[-1]:
+    sys.exit(1)
+with open(out, 'w') as f:
+    f.write({gtf!r})
+if '-b' in args:
+    n = len(os.path.basename(args[-1]))
+    with open(os.path.join(args[args.index('-b') + 1], 't_data.ctab'), 'w') as f:
+        f.write('\\t'.join({columns}) + '\\n')
+        for i, t in enumerate(['t1', 't2', 't3']):
+            f.write(f'{{i + 1}}\\tchr1\\t+\\t1\\t100\\t{{t}}\\t2\\t100\\tg1\\tG1\\t{{n * (i + 1)}}.5\\t{{n + i}}.0\\n')
+"""
+
+
+GTF = '# gtf\nchr1\tfake\texon\t1\t100\t.\t+\t.\tgene_id "g1"; transcript_id "t1";\n'
+
+
+def write_ctab(path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ctab_df = pd.DataFrame([[i + 1, 'chr1', '+', 1, 100, t, 1, 100, 'g1', 'G1', cov, fpkm]
+                            for i, (t, cov, fpkm) in enumerate(rows)], columns=CTAB_COLUMNS)
+    ctab_df.to_csv(path, sep='\t', index=False)
+
+
+class TestStringTieWorkflow(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with open('stringtie', 'w') as f:
+            f.write(FAKE_STRINGTIE.format(python=sys.executable, columns=CTAB_COLUMNS, gtf=GTF))
+        with open('ref.gtf', 'w') as f:
+            f.write(GTF)
+        os.chmod('stringtie', os.stat('stringtie').st_mode | stat.S_IEXEC)
+        os.mkdir('bams')
+        self.bams = []
+        for name in ['s1', 'sample2', 'bad3']:
+            self.bams.append(f'bams/{name}.sorted.bam')
+            open(self.bams[-1], 'w').close()
+
+    def get_stringtie(self):
+        st = StringTie('bams', './stringtie', '-p 2', 'out', 'ref.gtf', 'ctab')
+        st.verbose = False
+        st.u.warn_p = lambda *args: None
+        return st
+
+    def get_calls(self):
+        with open('calls.log') as f:
+            return [line.split() for line in f]
+
+    def test_rerun_ctab_dir(self):
+        st = self.get_stringtie()
+        st.generate_cmd(self.bams[0])
+        cmd = st.generate_cmd(self.bams[0])
+        self.assertTrue(os.path.isdir('ctab/s1'))
+        self.assertIn('-b ctab/s1', cmd)
+        st.param_str = '-p 2 -B -e'
+        self.assertTrue(st.generate_cmd(self.bams[0]).startswith('./stringtie -p 2 -e -G ref.gtf'))
+        self.assertEqual(st.get_output_files(self.bams[0]), ['out/STRINGTIE_s1.sorted.bam.gtf', 'ctab/s1/t_data.ctab'])
+
+    def test_workflow(self):
+        st = self.get_stringtie()
+        matrices = st.run_workflow(self.bams, '-F 0.5', scheduler=JobScheduler(max_cpus=4))
+        # The quantification is its own StringTie, this one is left as it was
+        self.assertEqual((st.gtf_filepath, st.param_str), ('ref.gtf', '-p 2'))
+        calls = self.get_calls()
+        # Assemble all three (bad3 fails), merge the two that assembled, quantify those two against the merged GTF
+        merge = [call for call in calls if '--merge' in call]
+        self.assertEqual(len(merge), 1)
+        self.assertEqual(merge[0][-2:], ['out/assembly/STRINGTIE_ASSEMBLE_s1.sorted.bam.gtf',
+                                         'out/assembly/STRINGTIE_ASSEMBLE_sample2.sorted.bam.gtf'])
+        self.assertIn('-F 0.5 -G ref.gtf', ' '.join(merge[0]))
+        quant = [call for call in calls if '-b' in call]
+        self.assertEqual(len(quant), 2)
+        self.assertIn('-p 2 -e -G out/assembly/STRINGTIE_MERGE_merged.gtf', ' '.join(quant[0]))
+        # The ctab files are written to their own directory (-b) so -B isn't passed too
+        self.assertNotIn('-B', quant[0])
+        self.assertEqual(len(calls), 6)
+
+        self.assertEqual(list(matrices['FPKM'].columns), ['s1', 'sample2'])
+        self.assertEqual(list(matrices['FPKM'].index), ['t1', 't2', 't3'])
+        self.assertEqual(list(matrices['FPKM']['s1']), [13.0, 14.0, 15.0])
+        self.assertEqual(list(matrices['cov']['sample2']), [18.5, 36.5, 54.5])
+        self.assertAlmostEqual(matrices['TPM']['s1'].sum(), 1e6)
+        self.assertAlmostEqual(matrices['TPM']['s1']['t1'], 13 / 42 * 1e6)
+        self.assertEqual(matrices['annotation'].loc['t2', 'gene_id'], 'g1')
+        written = pd.read_csv('out/STRINGTIE_TPM.tsv', sep='\t', index_col=0)
+        self.assertTrue(np.allclose(written.values, matrices['TPM'].values))
+
+        # Re-run: nothing has changed so only the failed sample is tried again
+        self.get_stringtie().run_workflow(self.bams, '-F 0.5', scheduler=JobScheduler(max_cpus=4))
+        self.assertEqual(len(self.get_calls()), 7)
+
+    def test_collate_unaligned(self):
+        write_ctab('c/a/t_data.ctab', [('t1', 1.0, 10.0), ('t2', 2.0, 30.0)])
+        write_ctab('c/b/t_data.ctab', [('t2', 4.0, 5.0), ('t3', 5.0, 15.0)])
+        matrices = collate_ctabs({'a': 'c/a/t_data.ctab', 'b': 'c/b/t_data.ctab'}, nthreads=2)
+        self.assertEqual(list(matrices['FPKM'].index), ['t1', 't2', 't3'])
+        self.assertEqual(matrices['FPKM'].values.tolist(), [[10.0, 0.0], [30.0, 5.0], [0.0, 15.0]])
+        self.assertEqual(matrices['TPM']['b'].tolist(), [0.0, 250000.0, 750000.0])
+        self.assertEqual(matrices['annotation'].index.tolist(), ['t1', 't2', 't3'])
+        self.assertFalse(os.path.exists('c_FPKM.tsv'))
@@ -0,0 +1,182 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+import gzip
+import os
+import stat
+import sys
+
+from scirnap import Cutadapt, Hisat2, TrimAlign
+from tests.helpers import TmpDirTestCase
+
+# Stand-ins that stream records like the real tools: cutadapt trims every read to 10 bases, hisat2 writes a line per
+# read it aligns and samtools sort writes what it is given. --fail makes a tool exit before opening its reads and
+# --fail-late makes hisat2 exit part way through them.
+FAKE_TOOL = '''#!{python}
+import gzip
+import os
+import shutil
+import sys
+
+tool, args = os.path.basename(sys.argv[0]), sys.argv[1:]
+if '--version' in args:
+    print(f'{{tool}} 1.0')
+    sys.exit(0)
+if '--fail' in args:
+    sys.exit(2)
+
+
+def value(flag):
+    return args[args.index(flag) + 1] if flag in args else None
+
+
+def records(path):
+    f = sys.stdin if path == '-' else gzip.open(path, 'rt') if path.endswith('.gz') else open(path)
+    lines = f.read().splitlines()
+    return [lines[i:i + 4] for i in range(0, len(lines), 4)]
+
+
+if tool == 'cutadapt':
+    outputs = [open(value('-o'), 'w') if value('-o') else sys.stdout]
+    outputs += [open(value('-p'), 'w')] if value('-p') else []
+    for path, out in zip([a for a in args if a.endswith('.fq.gz')], outputs):
+        for name, seq, sep, qual in records(path):
+            out.write(f'{{name}}\\n{{seq[:10]}}\\n{{sep}}\\n{{qual[:10]}}\\n')
+        out.close()
+    print('=== Summary ===', file=sys.stderr if not value('-o') else sys.stdout)
+elif tool == 'hisat2':
+    reads = [value('-U')] if value('-U') else [value('-1'), value('-2')]
+    if '--fail-late' in args:
+        with open(reads[0]) as f:
+            f.readline()
+        sys.exit(3)
+    mates = [records(path) for path in reads]
+    for mate, recs in enumerate(mates, 1):
+        for name, seq, _, _ in recs:
+            print(f'{{name[1:]}}\\t{{mate}}\\t{{seq}}')
+    with open(value('--summary-file'), 'w') as f:
+        f.write(f'{{len(mates[0])}} reads; of these:\\n')
+elif tool == 'samtools':
+    if args[0] == 'view':
+        shutil.copyfileobj(sys.stdin, sys.stdout)
+    elif args[0] == 'sort':
+        with open(value('-o'), 'w') as f:
+            shutil.copyfileobj(sys.stdin, f)
+'''
+
+
+class TestTrimAlign(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.environ['PATH']
+        os.mkdir('bin')
+        os.mkdir('data')
+        for tool in ['cutadapt', 'hisat2', 'samtools']:
+            with open(f'bin/{tool}', 'w') as f:
+                f.write(FAKE_TOOL.format(python=sys.executable))
+            os.chmod(f'bin/{tool}', os.stat(f'bin/{tool}').st_mode | stat.S_IEXEC)
+        os.environ['PATH'] = f'{os.path.abspath("bin")}{os.pathsep}{self.path}'
+        for sample in ['s0', 's1']:
+            for mate in '12':
+                with gzip.open(f'data/{sample}_R{mate}.fq.gz', 'wt') as f:
+                    for i in range(500):
+                        f.write(f'@{sample}.{i}/{mate}\n{"ACGT" * 10}\n+\n{"I" * 40}\n')
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        super().tearDown()
+
+    def get_trim_align(self, s_or_p, trim_params='-q 20', align_params='', **kwargs):
+        cutadapt = Cutadapt('data', 'cutadapt', trim_params, None, 'trimmed', s_or_p)
+        hisat2 = Hisat2('data', 'hisat2', align_params, 'bam', 'idx/genome', s_or_p)
+        trim_align = TrimAlign(cutadapt, hisat2, **kwargs)
+        trim_align.verbose = False
+        return trim_align
+
+    def test_single_end(self):
+        trim_align = self.get_trim_align('s')
+        files = ['data/s0_R1.fq.gz', 'data/s1_R1.fq.gz']
+        cmd = trim_align.generate_cmd(files[0])
+        self.assertIn('{ cutadapt -q 20 data/s0_R1.fq.gz 2> bam/HISAT2_s0_R1.fq.gz_cutadapt.txt;', cmd)
+        self.assertIn(' -U -;', cmd)
+        self.assertNotIn('mkfifo', cmd)
+        jobs = trim_align.run_per_file(files)
+        self.assertTrue(all(job.status == 'done' for job in jobs))
+        with open('bam/HISAT2_s0_R1.fq.gz.sorted.bam') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 500)
+        self.assertEqual(lines[0], 's0.0/1\t1\tACGTACGTAC')
+        # Only the BAM (and the logs) is written, no trimmed reads
+        self.assertFalse(os.path.exists('trimmed'))
+        self.assertEqual(sorted(os.listdir('bam')), ['.scirnap_cache.jsonl', '.scirnap_journal.jsonl',
+                                                     'HISAT2_s0_R1.fq.gz.sorted.bam', 'HISAT2_s0_R1.fq.gz_cutadapt.txt',
+                                                     'HISAT2_s0_R1.fq.gz_summary.txt', 'HISAT2_s1_R1.fq.gz.sorted.bam',
+                                                     'HISAT2_s1_R1.fq.gz_cutadapt.txt',
+                                                     'HISAT2_s1_R1.fq.gz_summary.txt'])
+
+    def test_paired_end_keep_trimmed(self):
+        trim_align = self.get_trim_align('p', keep_trimmed=True)
+        pairs = trim_align.pair_files(trim_align.get_files_in_dir())
+        self.assertEqual(trim_align.get_output_files(pairs[0]), ['bam/HISAT2_s0.fq.gz.sorted.bam',
+                                                                 'trimmed/CUTADAPT_s0_R1.fq.gz',
+                                                                 'trimmed/CUTADAPT_s0_R2.fq.gz'])
+        jobs = trim_align.run_per_file(pairs)
+        self.assertTrue(all(job.status == 'done' for job in jobs))
+        with open('bam/HISAT2_s1.fq.gz.sorted.bam') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(lines[500], 's1.0/2\t2\tACGTACGTAC')
+        # The trimmed reads that were aligned were also kept
+        with gzip.open('trimmed/CUTADAPT_s1_R2.fq.gz', 'rt') as f:
+            self.assertEqual(f.read().splitlines()[:4], ['@s1.0/2', 'ACGTACGTAC', '+', 'IIIIIIIIII'])
+        with open('bam/HISAT2_s1.fq.gz_cutadapt.txt') as f:
+            self.assertEqual(f.read(), '=== Summary ===\n')
+        self.assertFalse(os.path.exists(trim_align.get_tmp_dir(pairs[0])))
+
+    def test_other_modes(self):
+        for s_or_p, keep_trimmed, n_reads in [('s', True, 500), ('p', False, 1000)]:
+            trim_align = self.get_trim_align(s_or_p, keep_trimmed=keep_trimmed)
+            files = trim_align.get_files_in_dir()
+            files = trim_align.pair_files(files) if s_or_p == 'p' else [f for f in files if '_R1' in f]
+            jobs = trim_align.run_per_file(files)
+            self.assertTrue(all(job.status == 'done' for job in jobs))
+            for output_file in trim_align.get_output_files(files[0]):
+                with (gzip.open(output_file, 'rt') if output_file.endswith('.gz') else open(output_file)) as f:
+                    self.assertEqual(len(f.read().splitlines()), n_reads * (4 if output_file.endswith('.gz') else 1))
+        self.assertEqual(sorted(os.listdir('trimmed')), ['CUTADAPT_s0_R1.fq.gz', 'CUTADAPT_s1_R1.fq.gz'])
+
+    def test_failed(self):
+        # Neither side is left waiting on a FIFO when the other fails, or never opens it
+        for trim_params, align_params, keep_trimmed in [('--fail', '', False), ('', '--fail', False),
+                                                        ('--fail', '', True), ('', '--fail', True),
+                                                        ('', '--fail-late', True)]:
+            trim_align = self.get_trim_align('p', trim_params, align_params, keep_trimmed=keep_trimmed)
+            pairs = trim_align.pair_files(trim_align.get_files_in_dir())
+            job = trim_align.run_per_file(pairs[:1])[0]
+            self.assertEqual(job.status, 'failed')
+            self.assertFalse(os.path.exists(trim_align.get_tmp_dir(pairs[0])))
+
+    def test_failed_trim(self):
+        # The BAM is written but the job still fails since cutadapt did
+        trim_align = self.get_trim_align('s', '--fail')
+        job = trim_align.run_per_file(['data/s0_R1.fq.gz'])[0]
+        self.assertEqual(job.status, 'failed')
+
+    def test_resources(self):
+        trim_align = self.get_trim_align('p', '-j 2', '-p 4', keep_trimmed=True)
+        self.assertEqual(trim_align.get_job_resources(), (2 + 6 + 1, 512 * 2 ** 20 + int(5.25 * 2 ** 30) +
+                                                          768 * 2 ** 20))
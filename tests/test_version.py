@@ -0,0 +1,110 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+
+import os
+import threading
+import time
+
+from scirnap import BasePipeline
+from scirnap import version
+from tests.helpers import TmpDirTestCase
+
+
+class TestVersion(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('data')
+        version._versions.clear()
+        # Fake program which counts how many times its version was asked for
+        self.program = os.path.join(self.tmp_dir, 'fake_tool')
+        self.write_program('1.0')
+
+    def tearDown(self):
+        version._versions.clear()
+        super().tearDown()
+
+    def write_program(self, program_version):
+        with open(self.program, 'w') as f:
+            f.write(f'#!/bin/sh\necho probed >> {self.tmp_dir}/probes\necho "fake_tool {program_version}"\n')
+        os.chmod(self.program, 0o755)
+
+    def get_probes(self):
+        if not os.path.exists(os.path.join(self.tmp_dir, 'probes')):
+            return 0
+        with open(os.path.join(self.tmp_dir, 'probes')) as f:
+            return len(f.readlines())
+
+    def test_lazy(self):
+        pipeline = BasePipeline('data', self.program, logfile='log.txt', name='fake', verbose=False)
+        # Nothing is run until the version is needed
+        self.assertEqual(self.get_probes(), 0)
+        self.assertEqual(pipeline.program_version, 'fake_tool 1.0')
+        pipeline.add_version_to_logfile()
+        pipeline.logfile.close()
+        with open('log.txt') as f:
+            self.assertIn('# program version: fake_tool 1.0\n', f.read())
+
+    def test_probed_once(self):
+        for i in range(5):
+            pipeline = BasePipeline('data', self.program, logfile=f'log{i}.txt', name='fake', verbose=False)
+            self.assertEqual(pipeline.program_version, 'fake_tool 1.0')
+            pipeline.logfile.close()
+        self.assertEqual(self.get_probes(), 1)
+
+    def test_disk_cache(self):
+        self.assertEqual(version.get_program_version(self.program), 'fake_tool 1.0')
+        version._versions.clear()  # i.e. a new process
+        self.assertEqual(version.get_program_version(self.program), 'fake_tool 1.0')
+        self.assertEqual(self.get_probes(), 1)
+        version._versions.clear()
+        self.assertEqual(version.get_program_version(self.program, disk_cache=False), 'fake_tool 1.0')
+        self.assertEqual(self.get_probes(), 2)
+
+    def test_reprobed_on_change(self):
+        self.assertEqual(version.get_program_version(self.program), 'fake_tool 1.0')
+        # Upgrading the program changes its mtime so the version is probed again
+        self.write_program('2.0')
+        stat = os.stat(self.program)
+        os.utime(self.program, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(version.get_program_version(self.program), 'fake_tool 2.0')
+        self.assertEqual(self.get_probes(), 2)
+
+    def test_missing_program(self):
+        self.assertEqual(version.get_program_version(os.path.join(self.tmp_dir, 'not_a_tool')), '')
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'cache', 'versions.json')))
+
+    def test_probed_concurrently(self):
+        slow = os.path.join(self.tmp_dir, 'slow_tool')
+        with open(slow, 'w') as f:
+            f.write(f'#!/bin/sh\nsleep 1\necho probed >> {self.tmp_dir}/probes\necho "slow_tool 1.0"\n')
+        os.chmod(slow, 0o755)
+        versions = []
+        threads = [threading.Thread(target=lambda: versions.append(version.get_program_version(slow)))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        # Another program isn't held up while the slow one is probed
+        start = time.time()
+        self.assertEqual(version.get_program_version(self.program), 'fake_tool 1.0')
+        self.assertLess(time.time() - start, 0.5)
+        for thread in threads:
+            thread.join()
+        # and the slow one is probed once for all three threads
+        self.assertEqual(versions, ['slow_tool 1.0'] * 3)
+        self.assertEqual(self.get_probes(), 2)
@@ -0,0 +1,162 @@
+###############################################################################
+#                                                                             #
+#    This program is free software: you can redistribute it and/or modify     #
+#    it under the terms of the GNU General Public License as published by     #
+#    the Free Software Foundation, either version 3 of the License, or        #
+#    (at your option) any later version.                                      #
+#                                                                             #
+#    This program is distributed in the hope that it will be useful,          #
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of           #
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the            #
+#    GNU General Public License for more details.                             #
+#                                                                             #
+#    You should have received a copy of the GNU General Public License        #
+#    along with this program. If not, see <http://www.gnu.org/licenses/>.     #
+#                                                                             #
+###############################################################################
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from scirnap import JobScheduler
+from scirnap.workqueue import QueueExecutor, WorkQueue, Worker
+from tests.helpers import Copy, TmpDirTestCase, write_files
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestWorkQueue(TmpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        os.mkdir('out')
+        self.files = write_files(12)
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.kill()
+            worker.wait()
+        super().tearDown()
+
+    def start_worker(self, name, cpus=2):
+        env = {**os.environ, 'PYTHONPATH': ROOT_DIR}
+        self.workers.append(subprocess.Popen([sys.executable, '-m', 'scirnap', 'worker', '--queue', 'queue', '--cpus',
+                                              str(cpus), '--poll', '0.05', '--lease', '5', '--id', name,
+                                              '--idle-exit', '30'], env=env, stdout=subprocess.DEVNULL,
+                                             stderr=subprocess.DEVNULL))
+
+    def test_local_workers(self):
+        for i in range(3):
+            self.start_worker(f'w{i}')
+        # Slow enough that every worker gets some of the jobs
+        copy = Copy('data', 'out', delay=0.2)
+        copy.mem_per_job = '1M'
+        copy.use_queue('queue', poll_interval=0.05)
+        scheduler = JobScheduler(max_cpus=6, max_mem='1G')
+        jobs = copy.run_per_file(self.files, scheduler)
+        self.assertTrue(all(job.status == 'done' for job in jobs))
+        # The queued jobs take no memory here, the scheduler (which may be shared) is left as it was
+        self.assertEqual([job.mem for job in jobs], [0] * len(jobs))
+        self.assertEqual(scheduler.max_mem, 1024 ** 3)
+        for f in self.files:
+            with open(f'out/copy_{os.path.basename(f)}') as out:
+                self.assertEqual(out.read(), f'{os.path.basename(f)[:-4]}\n')
+        # Every worker ran some of the jobs
+        self.assertEqual({job.result.worker for job in jobs}, {'w0', 'w1', 'w2'})
+        self.assertEqual(WorkQueue('queue').get_counts(), {'pending': 0, 'leased': 0, 'done': 0})
+        WorkQueue('queue').stop()
+        for worker in self.workers:
+            self.assertEqual(worker.wait(timeout=10), 0)
+
+    def test_failed_cmd(self):
+        self.start_worker('w0')
+        copy = Copy('data', 'out')
+        copy.use_queue('queue', poll_interval=0.05)
+        copy.generate_cmd = lambda f: 'echo oops >&2 && exit 3'
+        job = copy.run_per_file(self.files[:1])[0]
+        self.assertEqual(job.status, 'failed')
+        self.assertIn('exited with code 3', str(job.error))
+        with open(os.path.join(copy.executor.log_dir, 'copy_s0.txt.stderr')) as f:
+            self.assertEqual(f.read(), 'oops\n')
+        # The worker exits with an error since one of its jobs failed
+        WorkQueue('queue').stop()
+        self.assertEqual(self.workers[0].wait(timeout=10), 1)
+
+    def test_claim_once(self):
+        queue = WorkQueue('queue')
+        job_ids = [queue.submit(f'echo {i}') for i in range(20)]
+        with ThreadPoolExecutor(8) as pool:
+            claimed = list(pool.map(lambda i: queue.claim(f'w{i}'), range(40)))
+        claimed = [record['id'] for record in claimed if record]
+        self.assertEqual(sorted(claimed), job_ids)
+        # Too big for the worker
+        queue.submit('echo big', cpus=8)
+        self.assertIsNone(queue.claim('w', max_cpus=4))
+        self.assertIsNotNone(queue.claim('w', max_cpus=8))
+
+    def test_expired_lease(self):
+        queue = WorkQueue('queue', lease_timeout=1, max_attempts=2)
+        job_id = queue.submit('echo hi', name='lost')
+        record = queue.claim('dead')
+        self.assertEqual(queue.requeue_expired(), [])
+        # The worker died: no heartbeat so the lease expires and the job goes back in the queue
+        leased = os.path.join('queue', 'leased', f'{job_id}.json')
+        os.utime(leased, (time.time() - 5, time.time() - 5))
+        self.assertEqual(queue.requeue_expired(), [job_id])
+        self.assertEqual(queue.get_counts(), {'pending': 1, 'leased': 0, 'done': 0})
+        # The dead worker coming back can't complete or renew it
+        self.assertFalse(queue.complete(record, {'returncode': 0}))
+        self.assertEqual(queue.heartbeat([job_id]), [job_id])
+
+        # A live worker runs it
+        worker = Worker('queue', cpus=1, poll_interval=0.01, lease_timeout=1, verbose=False)
+        self.assertEqual(worker.run(max_jobs=1), 1)
+        result = queue.get_result(job_id)
+        self.assertEqual(result['returncode'], 0)
+        self.assertIsNone(queue.get_result(job_id))
+
+        # Lost too many times
+        job_id = queue.submit('echo hi')
+        for _ in range(2):
+            queue.claim('dead')
+            os.utime(os.path.join('queue', 'leased', f'{job_id}.json'), (0, 0))
+            queue.requeue_expired()
+        result = queue.get_result(job_id)
+        self.assertEqual(result['returncode'], -1)
+        self.assertIn('expired 2 times', result['error'])
+
+    def test_lost_lease_stops_cmd(self):
+        queue = WorkQueue('queue')
+        job_id = queue.submit('echo $$ > pid && sleep 30 && touch finished', name='slow')
+        worker = Worker('queue', cpus=1, poll_interval=0.2, verbose=False)
+        thread = threading.Thread(target=worker.run, kwargs={'idle_timeout': 0.5})
+        thread.start()
+        while not os.path.exists('pid') or not open('pid').read():
+            time.sleep(0.01)
+        # The lease is taken away (as if it expired) and the job is claimed by another worker, whose lease it is now
+        self.assertEqual(WorkQueue('queue', lease_timeout=0).requeue_expired(), [job_id])
+        self.assertEqual(queue.claim('other')['id'], job_id)
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive())
+        # The cmd was killed rather than left writing the same outputs, and the other worker's lease is untouched
+        with open('pid') as f:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(int(f.read()), 0)
+        self.assertFalse(os.path.exists('finished'))
+        self.assertEqual(worker.completed, 0)
+        self.assertEqual(queue.get_counts(), {'pending': 0, 'leased': 1, 'done': 0})
+
+    def test_resume(self):
+        queue = WorkQueue('queue')
+        queue.stop()
+        self.assertTrue(queue.is_stopped())
+        queue.resume()
+        self.assertFalse(queue.is_stopped())
+        # A driver using the queue again resumes it
+        queue.stop()
+        QueueExecutor('queue', 'logs')
+        self.assertFalse(queue.is_stopped())